@@ -0,0 +1,272 @@
+
+# Some common functions for managing the accounts on the BMCs of the lab machines in
+# bulk, eg. to rotate the credentials of the standard users across the whole fleet.
+#
+# The work is done in three steps, each across all machines concurrently:
+#
+# - Scan:   The account slots of each BMC are read once.  (Desired passwords aren't
+#           tried out by logging in with them, as every wrong guess counts towards
+#           iDRAC's failed-login lockout and IP blocking.)
+# - Plan:   The creates, deletes, password and role changes needed on each BMC are
+#           worked out locally from the scan results, allocating empty slots for new
+#           accounts without going back to the BMC.
+# - Apply:  The changes are made (one at a time on any one BMC), then the accounts are
+#           read back with the session they were changed with to check they came out
+#           as intended, and one new credential per BMC is tried with a fresh session.
+
+# Assumes: Python 3.6+
+
+import time
+import yaml
+
+from lab_common import *
+
+# The standard-user entries in the global section of the machine creds db.
+std_user_creds_entries = ["bmc", "bmc-admin", "bmc-mgmt", "bmc-root", "bmc-default"]
+
+def load_account_spec(pathname):
+
+   # The spec of desired accounts is in the same form as the machine creds db, ie. a
+   # global section with entries for the standard users, each with a username and
+   # password.  An entry can also have a role, needed if the account might have to be
+   # created.  Standard users not in the spec are left alone.
+
+   try:
+      with open(pathname, "r") as stream:
+         spec = yaml.safe_load(stream)
+   except FileNotFoundError:
+      die("Account spec file not found: %s" % pathname)
+
+   try:
+      entries = spec["global"]
+      desired = dict()
+      for entry_name, entry in entries.items():
+         if entry_name not in std_user_creds_entries:
+            die("Account spec entry \"%s\" is not a standard user." % entry_name)
+         desired[entry_name] = {
+            "username": entry["username"],
+            "password": entry["password"],
+            "role":     entry.get("role")
+         }
+   except (KeyError, TypeError, AttributeError):
+      die("Account spec not as expected (global section with username/password entries).")
+
+   return desired
+
+def write_updated_creds(creds_pathname, desired, out_pathname):
+
+   # Writes a copy of the machine creds db with the global entries for the standard
+   # users in the spec updated.  Its full of passwords, so only we get to read it.
+
+   with open(creds_pathname, "r") as stream:
+      creds_info = yaml.safe_load(stream)
+
+   global_creds = creds_info.setdefault("global", dict())
+   for entry_name, d in desired.items():
+      entry = global_creds.setdefault(entry_name, dict())
+      entry["username"] = d["username"]
+      entry["password"] = d["password"]
+
+   fd = os.open(out_pathname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+   with os.fdopen(fd, "w") as stream:
+      yaml.safe_dump(creds_info, stream, default_flow_style=False)
+
+def describe_account_change(change):
+   op = change["op"]
+   if op == "create":
+      return "create \"%s\" (%s) in slot %s" % (change["user"], change["role"], change["slot"])
+   elif op == "delete":
+      return "delete \"%s\" from slot %s" % (change["user"], change["slot"])
+   else:
+      what = []
+      if change.get("password") is not None:
+         what.append("password")
+      if change.get("role") is not None:
+         what.append("role to %s" % change["role"])
+      return "set %s of \"%s\" in slot %s" % (" and ".join(what), change["user"], change["slot"])
+
+class AccountRotator:
+
+   # How long (secs) to give a BMC to take a new password before trying it out, so as
+   # not to rack up a failed login just for being quick.
+   trial_login_delay = 5
+
+   def __init__(self, args, desired, delete_users=None):
+
+      # desired is a dict indexed by creds entry name as returned by load_account_spec().
+
+      self.args = args
+      self.desired = desired
+      self.delete_users = delete_users if delete_users is not None else []
+
+      # BMC connections opened during the scan, reused when applying.
+      self.connections = dict()
+
+   @staticmethod
+   def _creds_work(machine, user_name, password):
+
+      # The session is closed right away, as iDRAC doesn't have many to go around.  Not
+      # getting through to the BMC (BMCConnectionError) counts as the creds not working.
+      # (Each failed attempt counts towards iDRAC's lockout, so use sparingly.)
+
+      try:
+         with LabBMCConnection(machine, username=user_name, password=password):
+            return True
+      except BMCRequestError:
+         return False
+
+   @staticmethod
+   def _check_account(bmc_conn, change):
+
+      # Reads back the account a change was made to, returning why it isn't as intended
+      # or None if it is.
+
+      slot_res = bmc_conn.get_resource(change["slot_res_id"], cacheable=False)
+      if slot_res.get("UserName") != change["user"]:
+         return "Account slot has user \"%s\" rather than the expected one." % slot_res.get("UserName")
+      if not slot_res.get("Enabled", True):
+         return "Account is not enabled."
+      if slot_res.get("Locked", False):
+         return "Account is locked."
+      role = change.get("role")
+      if role is not None and (slot_res.get("RoleId") or "").lower() != role.lower():
+         return "Account has role %s rather than %s." % (slot_res.get("RoleId"), role)
+      return None
+
+   def scan_machine(self, machine):
+
+      bmc_conn = LabBMCConnection.create_connection(machine, self.args, default_to_admin=True)
+      self.connections[machine] = bmc_conn
+
+      slots = []
+      for slot_res in bmc_conn.get_account_slots():
+         slots.append({
+            "id":     slot_res["Id"],
+            "res_id": slot_res["@odata.id"],
+            "user":   slot_res["UserName"],
+            "role":   slot_res.get("RoleId")
+         })
+
+      # The only desired password known to work already is the one we logged in with.
+      # Those of the other accounts are set regardless.
+
+      creds_ok = dict()
+      for d in self.desired.values():
+         if d["username"] == bmc_conn.username and d["password"] == bmc_conn.password:
+            creds_ok[d["username"]] = True
+
+      return {"login_user": bmc_conn.username, "slots": slots, "creds_ok": creds_ok}
+
+   def plan_machine(self, machine, scan):
+
+      # Returns the list of changes needed on a machine, in the order they should be made.
+      # Raises BMCError if the desired accounts can't be had (eg. no room).
+
+      slots = scan["slots"]
+      login_user = scan["login_user"]
+      by_user = {s["user"]: s for s in slots if s["user"] != ""}
+
+      # Slot 1 isn't usable on iDRAC (see BMCConnection._get_accounts).
+      free_slots = [s for s in slots if s["user"] == "" and s["id"] != "1"]
+
+      changes = []
+
+      # Deletes go first so their slots can be reused.
+
+      desired_users = [d["username"] for d in self.desired.values()]
+      for user_name in self.delete_users:
+         if user_name not in by_user:
+            continue
+         if user_name in ["root", login_user] or user_name in desired_users:
+            raise BMCError("Refusing to delete account \"%s\"." % user_name)
+         slot = by_user[user_name]
+         changes.append({"op": "delete", "user": user_name, "slot": slot["id"], "slot_res_id": slot["res_id"]})
+         free_slots.insert(0, slot)
+
+      own_change = None
+      for entry_name in sorted(self.desired.keys()):
+         d = self.desired[entry_name]
+         user_name = d["username"]
+         role = d["role"]
+         slot = by_user.get(user_name)
+         if slot is None:
+            if role is None:
+               raise BMCError("Account \"%s\" needs creating but spec entry %s has no role." %
+                              (user_name, entry_name))
+            if not free_slots:
+               raise BMCError("No room available for new account \"%s\"." % user_name)
+            slot = free_slots.pop(0)
+            changes.append({"op": "create", "user": user_name, "slot": slot["id"], "slot_res_id": slot["res_id"],
+                            "password": d["password"], "role": role})
+            continue
+
+         change = {"op": "update", "user": user_name, "slot": slot["id"], "slot_res_id": slot["res_id"],
+                   "password": None, "role": None}
+         if not scan["creds_ok"].get(user_name, False):
+            change["password"] = d["password"]
+         if role is not None and (slot["role"] or "").lower() != role.lower():
+            change["role"] = role
+         if change["password"] is None and change["role"] is None:
+            continue
+
+         # Change the account we're logged in as last, in case it upsets our session.
+         if user_name == login_user:
+            own_change = change
+         else:
+            changes.append(change)
+      #
+      if own_change is not None:
+         changes.append(own_change)
+
+      return changes
+
+   def apply_machine(self, machine, changes):
+
+      # Makes the changes, then verifies the resulting accounts by reading them back and
+      # (at most) one of the new credentials with a fresh session.  Returns a list of
+      # (change, error-message-or-None) tuples.
+
+      bmc_conn = self.connections[machine]
+
+      results = []
+      failed = False
+      for change in changes:
+         if failed:
+            results.append((change, "Not attempted due to earlier failure."))
+            continue
+         try:
+            op = change["op"]
+            dbg("[%s] Applying: %s" % (machine, describe_account_change(change)), level=2)
+            if op == "create":
+               bmc_conn.fill_account_slot(change["slot_res_id"], change["user"], change["password"], change["role"])
+            elif op == "delete":
+               bmc_conn.clear_account_slot(change["slot_res_id"])
+            else:
+               bmc_conn.update_account_slot(change["slot_res_id"], password=change["password"],
+                                            role=change["role"])
+            results.append((change, None))
+         except BMCError as exc:
+            results.append((change, str(exc)))
+            failed = True
+      #
+
+      trial_ix = None
+      for ix, (change, error) in enumerate(results):
+         if error is not None or change["op"] == "delete":
+            continue
+         try:
+            error = self._check_account(bmc_conn, change)
+         except BMCError as exc:
+            error = "Could not read back account: %s" % exc
+         if error is not None:
+            results[ix] = (change, error)
+         elif trial_ix is None and change.get("password") is not None:
+            trial_ix = ix
+
+      if trial_ix is not None:
+         change = results[trial_ix][0]
+         time.sleep(self.trial_login_delay)
+         if not self._creds_work(machine, change["user"], change["password"]):
+            results[trial_ix] = (change, "Could not open a session with the new credentials.")
+
+      return results
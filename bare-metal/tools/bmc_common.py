@@ -7,22 +7,169 @@
 
 # Assumes: Python 3.6+
 
+import atexit
+import copy
 import json
 import requests
+import signal
 import sys
+import threading
 import time
 import urllib3
+import weakref
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 from misc_utils import *
+from metrics_utils import *
 
 urllib3.disable_warnings()
 
+# Metrics on BMC responsiveness.  Labelled by BMC (host:port) so slow or overloaded
+# BMCs stand out.
+
+_bmc_requests = metrics.counter("acm_lab_bmc_requests_total",
+   "Redfish requests made to BMCs (including retries), by response status code.",
+   ["bmc", "method", "code"])
+_bmc_request_secs = metrics.histogram("acm_lab_bmc_request_duration_seconds",
+   "Time taken by BMCs to respond to Redfish requests.",
+   ["bmc", "method"], buckets=request_latency_buckets)
+_bmc_request_failures = metrics.counter("acm_lab_bmc_request_failures_total",
+   "Redfish requests that got no response from the BMC (connection errors, timeouts).",
+   ["bmc", "method", "exception"])
+_bmc_request_retries = metrics.counter("acm_lab_bmc_request_retries_total",
+   "Redfish requests retried because the BMC said it was not ready, by message id.",
+   ["bmc", "reason"])
+_bmc_sessions_opened = metrics.counter("acm_lab_bmc_sessions_opened_total",
+   "Sessions opened with BMCs.", ["bmc"])
+_bmc_sessions_open = metrics.gauge("acm_lab_bmc_sessions_open",
+   "Sessions with BMCs currently held open.", ["bmc"])
+_bmc_coalesced_reads = metrics.counter("acm_lab_bmc_coalesced_reads_total",
+   "Resource reads answered without a request of their own, by reason (in-flight, fresh).",
+   ["bmc", "reason"])
+_bmc_bootstrap_secs = metrics.histogram("acm_lab_bmc_bootstrap_duration_seconds",
+   "Time taken to connect to BMCs (service root and session) and to discover their system.",
+   ["bmc", "step"], buckets=request_latency_buckets)
+
+# Where the Redfish service root is assumed to be, rather than asking /redfish first.
+# Its where the Redfish spec says it is, and where every BMC we have puts it.
+default_svc_root_path = "/redfish/v1"
+
+def _has_property_path(res, prop_path):
+
+   # Property paths are as used in $select, eg. "Attributes/BootMode".
+
+   for prop in prop_path.split("/"):
+      if not isinstance(res, dict) or prop not in res:
+         return False
+      res = res[prop]
+   return True
+
 def _get_resource_id(res):
    return res["@odata.id"]
 
 def _resp_json(resp):
    return dict() if resp.text == "" else resp.json()
 
+class _ResourceRead:
+
+   # A read of a resource that is in progress, which other threads wanting the same
+   # resource wait for rather than reading it themselves.
+
+   def __init__(self):
+      self.done = threading.Event()
+      self.res = None
+      self.exc = None
+
+def _run_in_parallel(*funcs):
+
+   # Calls the funcs concurrently, returning a list of (result, exception) tuples, one
+   # per func, with exception None for those that returned normally.
+
+   def call(func):
+      try:
+         return (func(), None)
+      except Exception as exc:
+         return (None, exc)
+
+   with ThreadPoolExecutor(max_workers=len(funcs)) as pool:
+      return list(pool.map(call, funcs))
+
+# --- Making sure BMC sessions get closed ---
+#
+# iDRAC has only a handful of session slots, so sessions left open (eg. by a tool that
+# died, or exited before its connections were garbage collected) get in the way of new
+# logins until they time out.  So besides connections being closed when done with (see
+# BMCConnection.close, and its use as a context manager), whatever sessions are still
+# open are closed at exit, including exits due to SIGTERM or SIGHUP for tools that ask
+# for that (see install_exit_signal_handlers).
+
+_connections_with_sessions = weakref.WeakSet()
+_connections_lock = threading.RLock()
+
+# Set once we're exiting due to a signal, after which BMC requests are refused, other
+# than those of the threads closing our sessions.
+_exiting_on_signal = threading.Event()
+_session_closer_state = threading.local()
+
+def close_all_bmc_sessions(max_parallel=32):
+
+   # Closes the sessions of all connections that have one open, concurrently.
+
+   with _connections_lock:
+      conns = list(_connections_with_sessions)
+   if not conns:
+      return
+
+   def close(conn):
+      _session_closer_state.closing = True
+      try:
+         conn.deadline = None
+         conn._close_open_sessions()
+      except Exception as exc:
+         dbg("Ignoring exception closing BMC session: %s" % exc, level=3)
+
+   # (Plain threads, as executors refuse new work once the interpreter is exiting.)
+
+   dbg("Closing %d BMC sessions still open." % len(conns), level=3)
+   for i in range(0, len(conns), max_parallel):
+      threads = [threading.Thread(target=close, args=(conn,)) for conn in conns[i:i + max_parallel]]
+      for t in threads:
+         t.start()
+      for t in threads:
+         t.join()
+
+def _exit_on_signal(signum, frame):
+
+   # Stops the other threads making BMC requests (eg. changing passwords after we were
+   # told to stop), then exits by way of SystemExit in the main thread (where handlers
+   # run), so that the usual interpreter shutdown closes our sessions and does the other
+   # atexit cleanups (eg. writing out metrics).  They can't be done from here, as the
+   # code we interrupted may hold the locks they need.  Threads still making requests get
+   # errors for them, so wind down rather than hold up the exit.  (Further signals are
+   # ignored while we exit.)
+
+   if _exiting_on_signal.is_set():
+      return
+   _exiting_on_signal.set()
+   raise SystemExit(128 + signum)
+
+def install_exit_signal_handlers(signums=(signal.SIGTERM, signal.SIGHUP)):
+
+   # Has the signals (those whose handling hasn't already been changed) cause an exit
+   # that closes our sessions rather than just killing us.  For tools to call from their
+   # main(), as handlers can only be installed from the main thread.
+
+   if threading.current_thread() is not threading.main_thread():
+      return
+   for signum in signums:
+      if signal.getsignal(signum) == signal.SIG_DFL:
+         signal.signal(signum, _exit_on_signal)
+
+atexit.register(close_all_bmc_sessions)
+
 def dbg_echo_resource(name_line_pfx, res, level=1):
    if get_dbg_volume_level() >= level:
       dbg("%s \"%s\":\n%s"% (name_line_pfx, res["Name"], json_dumps(res)), level=level)
@@ -58,8 +205,8 @@ class BMCRequestError(BMCError):
 
          msg_id = None
          resp_json = {}
-         if resp.text is not None:
-            resp_content_type = resp.headers.get("content-type")
+         if resp.text:
+            resp_content_type = resp.headers.get("content-type", "")
             resp_content_type = resp_content_type.split(";")[0]
             if resp_content_type  == "application/json":
                resp_json = resp.json()
@@ -97,6 +244,22 @@ class BMCRequestError(BMCError):
    def msg_id(self):
       return self.message_id
 
+class BMCTimeoutError(BMCRequestError):
+
+   # A request that timed out, or that wasn't made because the connection's deadline
+   # (see BMCConnection.set_deadline) had passed.
+
+   def __init__(self, connection, msg):
+      super().__init__(connection, msg=msg)
+
+class BMCConnectionError(BMCRequestError):
+
+   # A request that failed for want of a working connection to the BMC (eg. it refused
+   # or reset the connection, or the TLS handshake or the response was cut short).
+
+   def __init__(self, connection, msg):
+      super().__init__(connection, msg=msg)
+
 # All Redfish DMTF Task states:
 #
 # New, Pending
@@ -146,7 +309,9 @@ def task_failed(task_res):
 # is very vague on the meaning/application of these states.  The meaning/use of
 # Interrupted and Exception are particularly unclear...are they final states?
 
-_job_states_waiting    = ["New", "Pending"]
+# (Scheduled isn't a DMTF state, but its what Dell's own jobs show while waiting.)
+
+_job_states_waiting    = ["New", "Pending", "Scheduled"]
 _job_states_in_prog    = ["Service", "Running", "Starting", "Stopping", "Cancelling"]
 _job_states_paused     = ["Suspended", "UserIntervention"]
 _job_states_mysterious = ["Exception"]
@@ -173,14 +338,234 @@ def job_completed_successfully(job_res):
 def job_failed(job_res):
    return job_res["JobState"] in _job_state_completed and job_res["JobStatus"] in ["Critical"]
 
+# OData $filter expressions selecting the same jobs as the above tests, for use as
+# server-side filters when iterating over a Jobs collection.
+
+def _odata_any_of(prop, values):
+   return " or ".join("%s eq '%s'" % (prop, v) for v in values)
+
+def job_filter_is_in_progress():
+   return _odata_any_of("JobState", _job_states_in_prog)
+
+def job_filter_has_ended():
+   return _odata_any_of("JobState", _job_states_final)
+
+def job_filter_completed_successfully():
+   return "(%s) and JobStatus eq 'OK'" % _odata_any_of("JobState", _job_state_completed)
+
+def job_filter_failed():
+   return "(%s) and JobStatus eq 'Critical'" % _odata_any_of("JobState", _job_state_completed)
+
+# Waiting for BMCs to be ready.
+#
+# A probe is a callable (typically one of the probe_* methods of a BMCConnection) that
+# returns True if the BMC is ready in some sense and False if not.  A probe that raises
+# a BMC or transport error is considered to have returned False.  Waits poll the probe
+# with an increasing interval until it succeeds, the deadline passes or the wait is
+# cancelled (by setting the threading.Event passed as cancel_event).  Time is as per the
+# clock passed (see Clock in misc_utils), real time by default.
+
+class BMCWaitTimeout(BMCError):
+   pass
+
+class BMCWaitCancelled(BMCError):
+   pass
+
+def _probe_succeeds(probe):
+   try:
+      return probe()
+   except (BMCError, requests.exceptions.RequestException) as exc:
+      dbg("Probe raised exception, treating as not ready: %s" % exc, level=9)
+      return False
+
+def wait_until_ready(probe, what, timeout=600, interval=1, max_interval=10, backoff=1.5,
+                     cancel_event=None, progress=None, progress_interval=30, clock=system_clock):
+
+   # Waits until the probe succeeds, returning the number of seconds waited.  Raises
+   # BMCWaitTimeout if it hasn't succeeded within timeout secs.  If provided, progress is
+   # called with a message when we start waiting (ie. the first probe fails) and then
+   # every progress_interval secs.  What describes what we're waiting for, for messages.
+
+   cancel_event = cancel_event if cancel_event is not None else clock.event()
+   start_time = clock.now()
+   deadline = start_time + timeout
+   next_progress_time = None
+
+   while True:
+      if cancel_event.is_set():
+         raise BMCWaitCancelled("Wait for %s was cancelled." % what)
+      if _probe_succeeds(probe):
+         return clock.now() - start_time
+
+      current_time = clock.now()
+      if current_time >= deadline:
+         raise BMCWaitTimeout("Timed out after %d seconds waiting for %s." % (timeout, what))
+      if progress is not None:
+         if next_progress_time is None:
+            progress("Waiting for %s." % what)
+            next_progress_time = current_time + progress_interval
+         elif current_time >= next_progress_time:
+            progress("Still waiting for %s (%d secs so far)." % (what, current_time - start_time))
+            next_progress_time = current_time + progress_interval
+
+      clock.wait(cancel_event, min(interval, deadline - current_time))
+      interval = min(interval * backoff, max_interval)
+
+def wait_until_all_ready(probes, what, timeout=600, cancel_event=None, progress=None,
+                         progress_interval=30, interval=1, max_interval=10, backoff=1.5,
+                         max_parallel=32, clock=system_clock):
+
+   # Waits for each of a dict of probes (eg. indexed by machine) to succeed, all with the
+   # same deadline.  Returns a dict indexed the same way with None for the probes that
+   # succeeded and the exception (timeout or cancellation) for those that didn't.
+   #
+   # Rather than each probe having a thread doing its own wait, a single scheduling loop
+   # tracks when each probe is next due (each backing off independently, as for
+   # wait_until_ready) and runs the due ones on a pool of at most max_parallel threads,
+   # so that a slow-to-respond BMC doesn't hold up probing of the others.  Progress
+   # messages, if progress is provided, cover all of the probes.
+
+   cancel_event = cancel_event if cancel_event is not None else clock.event()
+   results = dict()
+   if not probes:
+      return results
+
+   start_time = clock.now()
+   deadline = start_time + timeout
+   next_progress_time = start_time + progress_interval
+
+   # When each probe is next due (None while its running), and its current interval.
+   next_probe_times = {k: start_time for k in probes.keys()}
+   intervals = {k: interval for k in probes.keys()}
+
+   # Probes that have finished, as (key, succeeded) tuples, and an event set whenever
+   # one does.
+   finished = []
+   finished_lock = threading.Lock()
+   probe_finished = clock.event()
+
+   def run_probe(k):
+      succeeded = _probe_succeeds(probes[k])
+      with finished_lock:
+         finished.append((k, succeeded))
+      probe_finished.set()
+
+   # Due probes are only handed to the pool when it has a thread free for them, so that
+   # none are left queued behind slow ones (which a simulated clock would take as work
+   # still to be done).
+   pool_size = max(1, min(max_parallel, len(probes)))
+   running_cnt = 0
+
+   pool = ThreadPoolExecutor(max_workers=pool_size)
+   try:
+      while len(results) < len(probes):
+         current_time = clock.now()
+         if cancel_event.is_set() or current_time >= deadline:
+            for k in probes.keys():
+               if k not in results:
+                  if cancel_event.is_set():
+                     results[k] = BMCWaitCancelled("Wait for %s was cancelled." % what)
+                  else:
+                     results[k] = BMCWaitTimeout("Timed out after %d seconds waiting for %s." % (timeout, what))
+            break
+
+         due_keys = sorted((k for k, t in next_probe_times.items() if t is not None and t <= current_time),
+                           key=lambda k: next_probe_times[k])
+         for k in due_keys[:pool_size - running_cnt]:
+            next_probe_times[k] = None
+            running_cnt += 1
+            pool.submit(clock.held(run_probe), k)
+
+         # Wait for a probe to finish or the next one to come due (but not so long that a
+         # cancellation goes unnoticed for long).  Probes already due are waiting for a
+         # running one to finish.
+
+         due_times = [t for t in next_probe_times.values() if t is not None and t > current_time]
+         wait_secs = min(due_times + [deadline, next_progress_time, current_time + 1]) - current_time
+         clock.wait(probe_finished, max(wait_secs, 0))
+
+         with finished_lock:
+            probe_finished.clear()
+            done = finished[:]
+            del finished[:]
+         running_cnt -= len(done)
+         for k, succeeded in done:
+            if succeeded:
+               results[k] = None
+            else:
+               next_probe_times[k] = clock.now() + intervals[k]
+               intervals[k] = min(intervals[k] * backoff, max_interval)
+
+         current_time = clock.now()
+         if progress is not None and current_time >= next_progress_time and len(results) < len(probes):
+            waiting_cnt = len(probes) - len(results)
+            progress("Still waiting for %s on %d of %d machines (%d secs so far)." %
+                     (what, waiting_cnt, len(probes), current_time - start_time))
+            next_progress_time = current_time + progress_interval
+   finally:
+      # Don't hang around for probes still running after a timeout or cancellation.
+      pool.shutdown(wait=False)
+
+   return results
+
 class BMCConnection(object):
 
    # Note: We'll try to keep Dell-iDRAC specific sutff from creaping into this class
    # just in case we ever have any Redfish-managed machines from another hw vendor.
    # To do this, we'll refer to the Redfish spec in preference to (or as a sanity check
    # of) stuff found in the Dell iDRAC Redfish doc.
+   #
+   # A connection (and its session) can be shared by threads issuing requests
+   # concurrently, eg. a pool of workers all dealing with the same BMC.  The caches,
+   # statistics and session state are guarded by self.lock, which is never held while
+   # waiting for the BMC, and response headers are handed back per request rather than
+   # kept as connection-wide state.
+
+   # Max number of requests that can be in progress on a connection at once.  Others
+   # wait for one of these to finish.
+   max_concurrent_requests = 16
+
+   # Max number of resources whose validators (and bodies) are kept for conditional
+   # requests on a connection.  The least recently used make way for new ones.
+   max_validated_reads = 200
+
+   # Timeouts (secs) for establishing a connection to the BMC and for waiting for (each
+   # chunk of) a response, so a wedged BMC can't hang us.  iDRAC can be slow, but not
+   # this slow.
+
+   connect_timeout = 10
+   read_timeout    = 120
+
+   # How long to pause before retrying a request iDRAC said it wasn't ready for, and the
+   # clock (see Clock in misc_utils) the pauses are taken on.
+
+   not_ready_retry_pause = 5
+   clock = system_clock
+
+   # If set, told of the sessions we open and close, via its session_opened() and
+   # session_closed() methods (each called with the BMC, username and session id).
+
+   session_ledger = None
+
+   # If set, limits how many requests are in flight at once across all connections.
+   # Each request is made between calls of its acquire() and release() methods, and it
+   # is told of iDRAC's not-ready errors via not_ready().  (See AdaptiveConcurrencyLimiter
+   # in lab_common.)
+
+   request_concurrency_limiter = None
+
+   # Uncached reads (cacheable=False) of a resource are answered with what the last read
+   # of it got if that read completed within this many secs, and no update or action has
+   # been done since.  (Cached reads of course use the cache.)
 
-   def __init__(self, base_url, username, password):
+   uncached_read_freshness_secs = 0.5
+
+   def __init__(self, base_url, username, password, svc_root_path=default_svc_root_path,
+                deadline=None):
+
+      # If svc_root_path is None, the service root is found via /redfish rather than
+      # assumed to be there.  If deadline is provided, it applies (see set_deadline) from
+      # the start, ie. to establishing the connection too.
 
       dbg("Initializing BMCConnection object.", level=9)
 
@@ -191,7 +576,48 @@ class BMCConnection(object):
       self.session_token  = None
       self.session_res_id = None
 
-      self.last_response = None
+      # Time (as per now()) by which requests must be done with, if any.
+      self.deadline = deadline
+
+      # Guards the caches, statistics and session state below.
+      self.lock = threading.RLock()
+
+      # The last response received by each thread (see get_last_response_headers).
+      self.thread_state = threading.local()
+
+      # All requests go through a per-connection HTTP session so that the TLS connections
+      # are kept alive between requests, and responses can be compressed.  Concurrent
+      # requests each get their own TLS connection from the session's pool, which is
+      # sized so that they don't get discarded after use.
+
+      self.http_session = requests.Session()
+      self.http_session.headers["Accept-Encoding"] = "gzip, deflate"
+      self.request_limiter = threading.BoundedSemaphore(self.max_concurrent_requests)
+      adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrent_requests)
+      self.http_session.mount("https://", adapter)
+      self.http_session.mount("http://", adapter)
+
+      # Validators (ETag, Last-Modified) and bodies of the resources we've read, indexed
+      # by (resource path, query parms), so reads can be made conditional and PATCHes
+      # can be made to fail if the resource changed since we read it.  Kept in least
+      # to most recently used order (see max_validated_reads).
+
+      self.validated_reads = OrderedDict()
+
+      # Transport statistics for this connection.
+
+      self.stats = {
+         "requests":          0,    # Round trips to the BMC, including retries
+         "request_secs":      0.0,  # Time spent waiting for responses
+         "bytes_received":    0,    # Response body bytes as transferred (compressed)
+         "bytes_decoded":     0,    # Response body bytes after decompression
+         "not_modified":      0,    # Conditional reads answered with 304 Not Modified
+         "bytes_not_resent":  0,    # Decoded size of bodies 304 responses didn't resend
+         "coalesced_reads":   0,    # Resource reads answered by another thread's read
+         "fresh_reads":       0,    # Uncached reads answered by a just-completed read
+         "bootstrap_secs":    None, # Time taken to get the service root and a session
+         "discovery_secs":    None  # Time taken to discover the system (when first needed)
+      }
 
       # Debug message levels for various kinds of things.
 
@@ -207,51 +633,135 @@ class BMCConnection(object):
       # Cache of resources we've fetched.
       self.resources = dict()
 
-      # Some resource ids we may discover/learn as we need them.
+      # Cache of partial resources fetched via $select, with the property paths each
+      # one is known to contain.  (Full resources in the above cache take precedence.)
+      self.partial_resources = dict()
+
+      # Reads of resources in progress, and when the last uncached reads of resources
+      # completed and what they got, indexed by resource id.
+      self.reads_in_flight = dict()
+      self.recent_reads = dict()
+
+      # Whether the service honors $select, determined on first use.
+      self.select_supported = None
+
+      # Some resource ids we may discover/learn as we need them.  The system id is only
+      # set once it's validated, and discovering it is single-flight (under
+      # discovery_lock, which unlike self.lock is held while waiting for the BMC).
       self.this_system_id          = None
+      self.discovery_lock          = threading.Lock()
 
       self.base_url = remove_trailing(base_url, "/")
+      self.bmc_label = urlsplit(self.base_url).netloc or self.base_url
+
+      started_at = now()
+      self._bootstrap(svc_root_path)
+      bootstrap_secs = now() - started_at
+      with self.lock:
+         self.stats["bootstrap_secs"] = bootstrap_secs
+      _bmc_bootstrap_secs.observe(bootstrap_secs, bmc=self.bmc_label, step="connect")
+      dbg("Connected to BMC %s in %.2f secs." % (self.bmc_label, bootstrap_secs), level=self.dbg_msg_lvl_api_details)
+
+   def _bootstrap(self, svc_root_path):
 
-      # Get V1 root URL from the /redfish resource on the base URL given.
+      # We need the service root resource to form paths for other collections/services
+      # we will use, and a session.  Where the service root and Sessions collection are
+      # is pretty much a given, so rather than wait to be told, we get the service root
+      # and open the session at the same time, and then check that we got it right.
 
-      self.rf_svc_root_uri = self.base_url
-      version_obj = self.do_get("redfish", unauth=True)
-      self.rf_svc_root_uri = remove_trailing(self.base_url + version_obj["v1"], "/")
+      svc_root_res = None
+      session_exc = None
+      assumed_sessions_path = None
 
-      # Get the service root resource as we'll need it to form paths for other
-      # collections/services we will use.
+      if svc_root_path is not None:
+         svc_root_path = remove_trailing(svc_root_path, "/")
+         assumed_sessions_path = svc_root_path + "/SessionService/Sessions"
+         self.rf_svc_root_uri = self.base_url + svc_root_path
 
-      self.svc_root_res = self.do_get(None, unauth=True)
+         (svc_root_res, root_exc), (_, session_exc) = _run_in_parallel(
+            lambda: self.do_get(None, unauth=True),
+            lambda: self._open_session(assumed_sessions_path))
+
+         if root_exc is not None or remove_trailing(svc_root_res.get("@odata.id", ""), "/") != svc_root_path:
+            dbg("Service root not at %s as assumed, asking /redfish where it is." % svc_root_path,
+                level=self.dbg_msg_lvl_api_details)
+            svc_root_res = None
+
+      if svc_root_res is None:
+
+         # Get V1 root URL from the /redfish resource on the base URL given.
+
+         self.rf_svc_root_uri = self.base_url
+         version_obj = self.do_get("redfish", unauth=True)
+         self.rf_svc_root_uri = remove_trailing(self.base_url + version_obj["v1"], "/")
+
+         svc_root_res = self.do_get(None, unauth=True)
+
+      self.svc_root_res = svc_root_res
       self._cache_resource(self.svc_root_res)
       dbg("Service root resource:\n%s" % json_dumps(self.svc_root_res), level=9)
 
-      self._open_session()
+      # If opening the session failed where the Sessions collection really is, there's
+      # no point trying again.  Otherwise we guessed wrong so open it where it really is.
+
+      with self.lock:
+         session_open = self.session_token is not None
+      if not session_open:
+         if session_exc is not None and self._get_session_collection_path() == assumed_sessions_path:
+            raise session_exc
+         self._open_session()
 
    def __del__(self):
 
       dbg("Destroying BMCConnection object.", level=9)
       self._close_open_sessions()
+      dbg("Connection statistics: %s" % self.stats, level=self.dbg_msg_lvl_api_details)
+      self.http_session.close()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, exc_tb):
+      self.close()
+
+   def close(self):
+      """
+      Closes the BMC session (if open) and the HTTP connections to the BMC.
+      """
+      # Whatever deadline the last user had shouldn't keep us from cleaning up.
+      self.deadline = None
+      self._close_open_sessions()
+      self.http_session.close()
 
-   def _open_session(self):
+   def _open_session(self, sessions_coll_id=None):
 
       dbg_msg_lvl = self.dbg_msg_lvl_rf_ctrl_requests
 
       dbg("Opening new session to BMC.", level=dbg_msg_lvl)
 
-      sessions_coll_id = self._get_session_collection_path()
+      if sessions_coll_id is None:
+         sessions_coll_id = self._get_session_collection_path()
 
       req_body = {"UserName": self.username, "Password": self.password}
-      session_res = self.do_post(sessions_coll_id, body=req_body,
-                                 unauth=True, explicit_dbg_msg_level=dbg_msg_lvl)
+      resp = self.redfish_request("POST", sessions_coll_id, body=req_body,
+                                  unauth=True, explicit_dbg_msg_level=dbg_msg_lvl)
 
       # Per info on RedFish session authentication, we may or may not get a response body back
       # from the POST, and even if we do, it won't contain the session token.  But the session id
       # (which we need to save to close/DELETE the session) and the token are always provided
       # in response headers.
 
-      resp_hdrs = self.last_response.headers
-      self.session_res_id = resp_hdrs["Location"]
-      self.session_token  = resp_hdrs["X-Auth-Token"]
+      resp_hdrs = resp.headers
+      with self.lock:
+         self.session_res_id = resp_hdrs["Location"]
+         self.session_token  = resp_hdrs["X-Auth-Token"]
+      _bmc_sessions_opened.inc(bmc=self.bmc_label)
+      _bmc_sessions_open.inc(bmc=self.bmc_label)
+
+      with _connections_lock:
+         _connections_with_sessions.add(self)
+      if self.session_ledger is not None:
+         self.session_ledger.session_opened(self.bmc_label, self.username, resp_hdrs["Location"])
 
       dbg("Session open, session id: %s" % self.session_res_id, level=dbg_msg_lvl)
       # dbg("Session token: %s"% self.session_token, level=dbg_msg_lvl)
@@ -260,12 +770,27 @@ class BMCConnection(object):
 
       dbg_msg_lvl = self.dbg_msg_lvl_rf_ctrl_requests
 
-      if self.session_res_id is not None:
-         dbg("Closing open BMC session %s." % self.session_res_id, level=dbg_msg_lvl)
+      # Claim the session id so that if several threads close the connection at once,
+      # only one deletes the session.
+
+      with self.lock:
+         session_res_id = self.session_res_id
+         self.session_res_id = None
+
+      if session_res_id is not None:
+         dbg("Closing open BMC session %s." % session_res_id, level=dbg_msg_lvl)
+         _bmc_sessions_open.dec(bmc=self.bmc_label)
+         with _connections_lock:
+            _connections_with_sessions.discard(self)
          try:
-            self.do_delete(self.session_res_id, explicit_dbg_msg_level=dbg_msg_lvl)
+            self.do_delete(session_res_id, explicit_dbg_msg_level=dbg_msg_lvl)
+            # (If we couldn't delete it, the ledger still says its open so it can be reaped.)
+            if self.session_ledger is not None:
+               self.session_ledger.session_closed(self.bmc_label, self.username, session_res_id)
          except BMCError:
             dbg("BMC exception raised during open-session closing. Ignoring.", level=dbg_msg_lvl)
+         with self.lock:
+            self.session_token = None
 
    def _check_for_error(self, resp):
 
@@ -281,14 +806,135 @@ class BMCConnection(object):
       if is_2xx and resp.status_code != 200:
          return resp
 
+      # Only conditional reads get a 304, and the caller has the body.
+      if resp.status_code == 304:
+         return resp
+
       if resp.status_code == 200:
-         if resp.text is None:
+         if not resp.text:
             return resp
          if "error" not in resp.json():
             return resp
 
       raise BMCRequestError(self, resp=resp)
 
+   def _note_response(self, resp):
+
+      # Account for a request/response in the connection statistics.  The raw response
+      # tells us how much was actually read off the wire (ie. before decompression).
+
+      decoded_len = len(resp.content)
+      try:
+         received_len = resp.raw.tell()
+      except (AttributeError, ValueError):
+         received_len = int(resp.headers.get("Content-Length", decoded_len))
+
+      with self.lock:
+         stats = self.stats
+         stats["requests"]       += 1
+         stats["request_secs"]   += resp.elapsed.total_seconds()
+         stats["bytes_received"] += received_len
+         stats["bytes_decoded"]  += decoded_len
+
+      method = resp.request.method
+      _bmc_requests.inc(bmc=self.bmc_label, method=method, code=resp.status_code)
+      _bmc_request_secs.observe(resp.elapsed.total_seconds(), bmc=self.bmc_label, method=method)
+
+   def set_deadline(self, deadline):
+      """
+      Sets the time (as per now()) by which requests on this connection must be done
+      with, or None for no deadline.  Requests in progress at the deadline time out, and
+      requests made after it fail, with a BMCTimeoutError.
+      """
+      self.deadline = deadline
+
+   def get_deadline(self):
+      return self.deadline
+
+   def _get_request_timeout(self):
+
+      # Returns the (connect, read) timeout for a request, which is the usual unless
+      # that would take it past our deadline.
+
+      connect_timeout = self.connect_timeout
+      read_timeout    = self.read_timeout
+
+      deadline = self.deadline
+      if deadline is not None:
+         remaining = deadline - now()
+         if remaining <= 0:
+            raise BMCTimeoutError(self, "Deadline for requests to BMC %s has passed." % self.bmc_label)
+         connect_timeout = min(connect_timeout, remaining)
+         read_timeout    = min(read_timeout, remaining)
+
+      return (connect_timeout, read_timeout)
+
+   def _get_remaining_secs(self):
+      return None if self.deadline is None else max(self.deadline - now(), 0)
+
+   def _send(self, func, *args, **kwargs):
+
+      # Sends a request via func (one of the http_session methods), accounting for it.
+      # Waits for its turn (under the process-wide and the per-connection limits on
+      # requests in flight) are bounded by the deadline, and the request's timeouts are
+      # worked out once it's its turn, from what's left of the time by then.
+
+      method = func.__name__.upper()
+      if _exiting_on_signal.is_set() and not getattr(_session_closer_state, "closing", False):
+         raise BMCConnectionError(self, "Not making %s request to BMC %s as we're exiting." %
+                                        (method, self.bmc_label))
+      self._get_request_timeout()  # (Fails right away if the deadline has passed.)
+      started_at = now()
+
+      def turn_timed_out():
+         return BMCTimeoutError(self, "%s request to BMC %s timed out after %.1f secs waiting its turn." %
+                                      (method, self.bmc_label, now() - started_at))
+
+      limiter = self.request_concurrency_limiter
+      token = None
+      if limiter is not None:
+         token = limiter.acquire(timeout=self._get_remaining_secs())
+         if token is None:
+            raise turn_timed_out()
+
+      # (Requests that get no answer count against the limiter as congestion.)
+      failure = None
+      try:
+         if not self.request_limiter.acquire(timeout=self._get_remaining_secs()):
+            raise turn_timed_out()
+         try:
+            timeout = self._get_request_timeout()
+            resp = func(*args, timeout=timeout, **kwargs)
+         finally:
+            self.request_limiter.release()
+      except requests.exceptions.Timeout as exc:
+         failure = "timeout"
+         _bmc_request_failures.inc(bmc=self.bmc_label, method=method, exception=type(exc).__name__)
+         raise BMCTimeoutError(self, "%s request to BMC %s timed out after %.1f secs." %
+                                     (method, self.bmc_label, now() - started_at)) from exc
+      except requests.exceptions.RequestException as exc:
+         failure = "connection-error"
+         _bmc_request_failures.inc(bmc=self.bmc_label, method=method, exception=type(exc).__name__)
+         raise BMCConnectionError(self, "%s request to BMC %s failed: %s" %
+                                        (method, self.bmc_label, exc)) from exc
+      finally:
+         if limiter is not None:
+            limiter.release(token, failure, bmc=self.bmc_label)
+      self._note_response(resp)
+      return resp
+
+   def _pause_before_retry(self):
+
+      # Pauses before a retry, returning False (without pausing) if the deadline would
+      # pass first, in which case there's no point retrying.
+
+      remaining = self._get_remaining_secs()
+      if remaining is not None and remaining <= self.not_ready_retry_pause:
+         dbg("req-retry: Not retrying, as the deadline is too close.", level=self.dbg_msg_lvl_rf_req_retry)
+         return False
+      self.clock.sleep(self.not_ready_retry_pause)
+      return True
+
    # Issue request and do one retry if we caught the BMC in a not-ready state.
    def _req_and_retry(self, func, *args, **kwargs):
 
@@ -307,7 +953,7 @@ class BMCConnection(object):
       # As a bandaid, if we get a 400 response with the indicated msg (as determined by its
       # msg id, not its text, we'll wait a few secs and try one more time.
 
-      resp = func(*args, **kwargs)
+      resp = self._send(func, *args, **kwargs)
       status_code = resp.status_code
       dbg("req-retry: Request returned Status code %d." % status_code, level=dbg_msg_lvl)
       if status_code not in [400, 500]:
@@ -340,14 +986,21 @@ class BMCConnection(object):
          if msg_nr == "SWC0700":
             # Error is an "iDRAC not ready one.  Wait and retry.
             dbg("req-retry: Got iDRAC-not-ready error. Retrying request after pause.", level=dbg_msg_lvl)
-            time.sleep(5)  # Arbitrary, but kinda recommended by corrective-action in iDRAC response.
-            resp = func(*args, **kwargs)
+            _bmc_request_retries.inc(bmc=self.bmc_label, reason=msg_nr)
+            if self.request_concurrency_limiter is not None:
+               self.request_concurrency_limiter.not_ready(msg_nr)
+            # Pause is arbitrary, but kinda recommended by corrective-action in iDRAC response.
+            if self._pause_before_retry():
+               resp = self._send(func, *args, **kwargs)
          elif msg_nr == "SYS518":
             # Error Msg: "iDRAC is currently unable to display any information because data sources are unavailable"
             dbg("req-retry: Got iDRAC-data-sources-unavailable error. Retrying request after pause.",
                 level=dbg_msg_lvl)
-            time.sleep(5)
-            resp = func(*args, **kwargs)
+            _bmc_request_retries.inc(bmc=self.bmc_label, reason=msg_nr)
+            if self.request_concurrency_limiter is not None:
+               self.request_concurrency_limiter.not_ready(msg_nr)
+            if self._pause_before_retry():
+               resp = self._send(func, *args, **kwargs)
             #
          #
 
@@ -361,7 +1014,7 @@ class BMCConnection(object):
       if explicit_dbg_msg_level != None:
          dbg_msg_lvl = explicit_dbg_msg_level
       else:
-         if method == "GET":
+         if method in ["GET", "HEAD"]:
             dbg_msg_lvl = self.dbg_msg_lvl_rf_read_requests
          else:
             dbg_msg_lvl = self.dbg_msg_lvl_rf_write_requests
@@ -369,6 +1022,12 @@ class BMCConnection(object):
       # Normalize inputs.
       method = method.upper()
       hdrs = headers.copy() if headers is not None else dict()
+
+      # Anything other than a read may change any number of resources (eg. a reset action
+      # changes the System), so what recent reads got can't be reused anymore.
+      if method not in ["GET", "HEAD"]:
+         with self.lock:
+            self.recent_reads.clear()
       auth = None if unauth else (self.username, self.password)
 
       # Build request URL.  If a resource path is specified and starts with a slash
@@ -393,8 +1052,10 @@ class BMCConnection(object):
       creds = None
       if not unauth:
          # Use session token is a session is estbalished, otherwise basic auth.
-         if self.session_token is not None:
-            hdrs["X-Auth-Token"] = self.session_token
+         with self.lock:
+            session_token = self.session_token
+         if session_token is not None:
+            hdrs["X-Auth-Token"] = session_token
          else:
             creds = (self.username, self.password)
 
@@ -412,50 +1073,143 @@ class BMCConnection(object):
          if query_parms is not None:
             qp = " (Query Parms: %s)" % query_parms
          dbg("GETting URI: %s%s" % (uri, qp), level=dbg_msg_lvl)
-         resp = self._req_and_retry(requests.get, uri, params=query_parms,
+         resp = self._req_and_retry(self.http_session.get, uri, params=query_parms,
+                                    verify=self.verify, auth=creds, headers=hdrs)
+
+      elif method == "HEAD":
+         dbg("HEADing URI: %s" % uri, level=dbg_msg_lvl)
+         resp = self._req_and_retry(self.http_session.head, uri, params=query_parms,
                                     verify=self.verify, auth=creds, headers=hdrs)
 
       elif method == "POST":
          dbg("POSTing to URI: %s" % uri, level=dbg_msg_lvl)
          if body is not None:
             dbg("...with JSON body:\n%s" % json_dumps(display_body), level=dbg_msg_lvl)
-         resp = self._req_and_retry(requests.post, uri, json=body,
+         resp = self._req_and_retry(self.http_session.post, uri, json=body,
                                     verify=self.verify, auth=creds, headers=hdrs)
 
       elif method == "PATCH":
          dbg("PATCHing URI: %s" % uri, level=dbg_msg_lvl)
          if body is not None:
             dbg("...with JSON body:\n%s" % json_dumps(display_body), level=dbg_msg_lvl)
-         resp = self._req_and_retry(requests.patch, uri, json=body,
+         resp = self._req_and_retry(self.http_session.patch, uri, json=body,
                                     verify=self.verify, auth=creds, headers=hdrs)
 
       elif method == "DELETE":
          dbg("DELETing URI: %s" % uri, level=dbg_msg_lvl)
-         resp = self._req_and_retry(requests.delete, uri, verify=self.verify,
+         resp = self._req_and_retry(self.http_session.delete, uri, verify=self.verify,
                                     auth=creds, headers=hdrs)
 
-      # Only a few requests (eg. authenticating via session-auth, creating things) care about
-      # the response headers, so we return just the response body as our return value.
-      # But for those that need thems, we stash the entire response in self.last_response
-      # for code to do as it pleases.  This approach would not work if we supported multiple
-      # concurrent requests on a connection, but it seems unlikely we'll want to do that
-      # (and not clear how to do even if we wanted, given HTTP request/response orientation).
+      # We return the whole response, so callers that care about the response headers (eg.
+      # authenticating via session-auth, creating things) have them for this very request
+      # even if other threads are using the connection at the same time.  The do_* methods
+      # return just the response body.  For the convenience of code that wants the headers
+      # after having used one of those, the last response is also kept per thread.
 
-      self.last_response = resp
+      self.thread_state.last_response = resp
       return (self._check_for_error(resp))
 
+   @staticmethod
+   def _validated_read_key(resource_path, query_parms=None):
+      path = remove_trailing(resource_path, "/") if resource_path is not None else None
+      parms = tuple(sorted(query_parms.items())) if query_parms else None
+      return (path, parms)
+
    def do_get(self, resource_path, unauth=False, query_parms=None, explicit_dbg_msg_level=None):
-      resp = self.redfish_request("GET", resource_path, query_parms=query_parms,
+
+      # If we've read this before and got validators for it, make the read conditional
+      # so an unchanged resource doesn't get resent.
+
+      key = self._validated_read_key(resource_path, query_parms)
+      with self.lock:
+         validated = self.validated_reads.get(key)
+         if validated is not None:
+            self.validated_reads.move_to_end(key)
+      hdrs = None
+      if validated is not None:
+         etag, last_modified, body, body_len = validated
+         hdrs = dict()
+         if etag is not None:
+            hdrs["If-None-Match"] = etag
+         if last_modified is not None:
+            hdrs["If-Modified-Since"] = last_modified
+
+      resp = self.redfish_request("GET", resource_path, query_parms=query_parms, headers=hdrs,
                                   unauth=unauth, explicit_dbg_msg_level=explicit_dbg_msg_level)
-      return _resp_json(resp)
+
+      if resp.status_code == 304:
+         dbg("Resource not modified: %s" % resource_path, level=self.dbg_msg_lvl_rf_read_requests)
+         with self.lock:
+            self.stats["not_modified"] += 1
+            self.stats["bytes_not_resent"] += body_len
+         # Callers are free to mess with what they get back, so give them a copy.
+         return copy.deepcopy(body)
+
+      body = _resp_json(resp)
+      etag = resp.headers.get("ETag")
+      last_modified = resp.headers.get("Last-Modified")
+      with self.lock:
+         if etag is not None or last_modified is not None:
+            self.validated_reads[key] = (etag, last_modified, copy.deepcopy(body), len(resp.content))
+            self.validated_reads.move_to_end(key)
+            while len(self.validated_reads) > self.max_validated_reads:
+               self.validated_reads.popitem(last=False)
+         else:
+            self.validated_reads.pop(key, None)
+      return body
+
+   def get_resource_etag(self, resource_path):
+      """
+      Returns the ETag the resource had when it was last read (in full), or None.
+      """
+      with self.lock:
+         validated = self.validated_reads.get(self._validated_read_key(resource_path))
+      return validated[0] if validated is not None else None
+
+   def do_head(self, resource_path, unauth=False, explicit_dbg_msg_level=None):
+      resp = self.redfish_request("HEAD", resource_path, unauth=unauth,
+                                  explicit_dbg_msg_level=explicit_dbg_msg_level)
+      return resp.headers
 
    def do_post(self, resource_path, body=None, unauth=False, explicit_dbg_msg_level=None):
       return _resp_json(self.redfish_request("POST", resource_path, body=body,
                                              unauth=unauth,explicit_dbg_msg_level=explicit_dbg_msg_level))
 
    def do_patch(self, resource_path, body=None, explicit_dbg_msg_level=None):
-      return _resp_json(self.redfish_request("PATCH", resource_path,
-                                             body=body, explicit_dbg_msg_level=explicit_dbg_msg_level))
+
+      # If we know the (strong) ETag of the resource from having read it, only apply the
+      # update if the resource hasn't changed since then.  A 412 (Precondition Failed)
+      # error results if it has.  (Weak ETags can't be used with If-Match.)  As the ETag
+      # of some resources (eg. the System resource) changes with things like the power
+      # state, which needn't make our update stale, that is retried once against the
+      # ETag of a fresh read.
+
+      try:
+         resp = self._do_patch_if_unchanged(resource_path, body, explicit_dbg_msg_level)
+      except BMCRequestError as exc:
+         if exc.status != 412:
+            raise
+         dbg("Resource changed since it was read, rereading it and retrying update: %s" % resource_path,
+             level=self.dbg_msg_lvl_rf_write_requests)
+         self.do_get(resource_path)
+         resp = self._do_patch_if_unchanged(resource_path, body, explicit_dbg_msg_level)
+      return _resp_json(resp)
+
+   def _do_patch_if_unchanged(self, resource_path, body, explicit_dbg_msg_level):
+
+      hdrs = None
+      key = self._validated_read_key(resource_path)
+      etag = self.get_resource_etag(resource_path)
+      if etag is not None and not etag.startswith("W/"):
+         hdrs = {"If-Match": etag}
+
+      try:
+         return self.redfish_request("PATCH", resource_path, body=body, headers=hdrs,
+                                     explicit_dbg_msg_level=explicit_dbg_msg_level)
+      finally:
+         # The resource has (or may have) changed.
+         with self.lock:
+            self.validated_reads.pop(key, None)
 
    def do_delete(self, resource_path, query_parms=None, explicit_dbg_msg_level=None):
       resp = self.redfish_request("DELETE", resource_path, query_parms=query_parms,
@@ -474,41 +1228,163 @@ class BMCConnection(object):
       dbg_msg_lvl = 8
       dbg_msg_lvl_verbose = 9
 
-      msg_start = "Added to" if key not in self.resources else "Updated in"
-      dbg("%s resource cache: %s" % (msg_start, key), level=dbg_msg_lvl)
-      dbg("Resource contents: \n %s" % json_dumps(resource), level=dbg_msg_lvl_verbose)
-      self.resources[key] = (now(), resource)
+      with self.lock:
+         msg_start = "Added to" if key not in self.resources else "Updated in"
+         dbg("%s resource cache: %s" % (msg_start, key), level=dbg_msg_lvl)
+         dbg("Resource contents: \n %s" % json_dumps(resource), level=dbg_msg_lvl_verbose)
+         self.resources[key] = (now(), resource)
+         self.partial_resources.pop(key, None)
+
+   def _cache_partial_resource(self, key, resource, properties):
+
+      dbg_msg_lvl = 8
+
+      # Merge the newly fetched properties into any we already have for the resource.
+
+      with self.lock:
+         if key in self.partial_resources:
+            _, cached_res, cached_props = self.partial_resources[key]
+            merged_res = dict(cached_res)
+            for prop, value in resource.items():
+               if isinstance(value, dict) and isinstance(merged_res.get(prop), dict):
+                  merged_res[prop] = dict(merged_res[prop], **value)
+               else:
+                  merged_res[prop] = value
+            resource = merged_res
+            properties = cached_props | set(properties)
+
+         dbg("Added/updated partial resource in cache: %s %s" % (key, sorted(properties)), level=dbg_msg_lvl)
+         self.partial_resources[key] = (now(), resource, set(properties))
 
    def _uncache_resource(self, key):
 
       dbg_msg_lvl = 8
       dbg_msg_lvl_verbose = 9
 
-      try:
-         del self.resources[key]
-         dbg("Removed from resource cache: %s" % key, level=dbg_msg_lvl)
-      except KeyError:
-         pass
+      with self.lock:
+         try:
+            del self.resources[key]
+            dbg("Removed from resource cache: %s" % key, level=dbg_msg_lvl)
+         except KeyError:
+            pass
+         self.partial_resources.pop(key, None)
+         self.recent_reads.pop(key, None)
+
+         # A read in progress may have started before whatever made us uncache, so
+         # don't let later callers wait for it, or let it cache what it gets.
+         self.reads_in_flight.pop(key, None)
 
    # Resource CRUD.
 
    def _get_resource(self, res_id, cacheable=True):
 
+      # Concurrent reads of the same resource (eg. of the System resource by threads
+      # sharing the connection) are coalesced: the first does the GET and the others
+      # wait for it and get (a copy of) what it got.
+
       dbg_msg_lvl = 8
 
-      if cacheable and res_id in self.resources:
-         dbg("Getting resource from cache: %s" % res_id, level=dbg_msg_lvl)
-         return self.resources[res_id][1]
+      with self.lock:
+         if cacheable:
+            cached = self.resources.get(res_id)
+            if cached is not None:
+               dbg("Getting resource from cache: %s" % res_id, level=dbg_msg_lvl)
+               return cached[1]
+         else:
+            recent = self.recent_reads.get(res_id)
+            if recent is not None and now() - recent[0] <= self.uncached_read_freshness_secs:
+               dbg("Getting just-read resource: %s" % res_id, level=dbg_msg_lvl)
+               self.stats["fresh_reads"] += 1
+               _bmc_coalesced_reads.inc(bmc=self.bmc_label, reason="fresh")
+               return copy.deepcopy(recent[1])
+
+         read = self.reads_in_flight.get(res_id)
+         is_reader = read is None
+         if is_reader:
+            read = _ResourceRead()
+            self.reads_in_flight[res_id] = read
+         else:
+            self.stats["coalesced_reads"] += 1
 
-      res = self.do_get(res_id)
-      if cacheable:
-         self._cache_resource(res)
-      else:
-         # Don't leave a potentially stale copy cached.
-         self._uncache_resource(res_id)
+      if not is_reader:
+         dbg("Waiting for in-progress read of resource: %s" % res_id, level=dbg_msg_lvl)
+         _bmc_coalesced_reads.inc(bmc=self.bmc_label, reason="in-flight")
+         read.done.wait()
+         if read.exc is not None:
+            raise read.exc
+         return copy.deepcopy(read.res)
+
+      try:
+         res = self.do_get(res_id)
+         read.res = res
+      except BaseException as exc:
+         read.exc = exc
+         raise
+      finally:
+         with self.lock:
+            is_current = self.reads_in_flight.get(res_id) is read
+            if is_current:
+               del self.reads_in_flight[res_id]
+               if read.exc is None:
+                  if cacheable:
+                     self._cache_resource(res)
+                  else:
+                     # Don't leave a potentially stale copy cached.
+                     self._uncache_resource(res_id)
+                     self.recent_reads[res_id] = (now(), copy.deepcopy(res))
+         read.done.set()
 
       return res
 
+   def _get_resource_properties(self, res_id, properties, cacheable=True):
+
+      # Returns a resource containing at least the specified properties (paths as used
+      # in $select), but possibly only them.  If the service doesn't support $select
+      # the full resource is fetched (and cached as usual).
+
+      dbg_msg_lvl = 8
+
+      if cacheable:
+         with self.lock:
+            cached = self.resources.get(res_id)
+            cached_partial = self.partial_resources.get(res_id)
+         if cached is not None:
+            dbg("Getting resource from cache: %s" % res_id, level=dbg_msg_lvl)
+            return cached[1]
+         if cached_partial is not None:
+            _, res, cached_props = cached_partial
+            if cached_props.issuperset(properties):
+               dbg("Getting partial resource from cache: %s" % res_id, level=dbg_msg_lvl)
+               return res
+
+      if self.select_supported is None:
+         self.select_supported = self._protocol_feature_supported("SelectQuery")
+         dbg("Service %s $select." % ("supports" if self.select_supported else "doesn't support"),
+             level=self.dbg_msg_lvl_api_details)
+
+      res = None
+      if self.select_supported:
+         query_parms = {"$select": ",".join(properties)}
+         try:
+            res = self.do_get(res_id, query_parms=query_parms)
+         except BMCRequestError as exc:
+            if exc.status not in [400, 501]:
+               raise
+            dbg("Service rejected $select, no longer using it.", level=self.dbg_msg_lvl_api_details)
+            self.select_supported = False
+
+      # Some services honor $select for some resources or properties and not others, so
+      # make sure we got what we asked for.
+
+      if res is not None and all(_has_property_path(res, p) for p in properties):
+         if cacheable:
+            self._cache_partial_resource(res_id, res, properties)
+         else:
+            self._uncache_resource(res_id)
+         return res
+
+      return self._get_resource(res_id, cacheable=cacheable)
+
    def _update_resource(self, res_id, update_body):
 
       res = self.do_patch(res_id, update_body)
@@ -527,6 +1403,15 @@ class BMCConnection(object):
       dbg("Getting resource %s" % res_id, level=self.dbg_msg_lvl_api_summary)
       return self._get_resource(res_id, cacheable=cacheable)
 
+   def get_resource_properties(self, res_id, properties, cacheable=True):
+      """
+      Returns a resource identified by its id/path, fetching only the specified properties
+      (eg. "Attributes/BootMode") if the service allows.  Callers should access only those
+      properties of the result.  Will use cached value if permitted.
+      """
+      dbg("Getting properties %s of resource %s" % (properties, res_id), level=self.dbg_msg_lvl_api_summary)
+      return self._get_resource_properties(res_id, properties, cacheable=cacheable)
+
    def update_resource_by_id(self, res_id, update_body):
       """
       Updates a resource identified by its id/path.
@@ -534,6 +1419,15 @@ class BMCConnection(object):
       dbg("Patching resource %s" % res_id, level=self.dbg_msg_lvl_api_summary)
       return self._update_resource(res_id, update_body)
 
+   def delete_resource(self, res_id):
+      """
+      Deletes a resource identified by its id/path.
+      """
+      dbg("Deleting resource %s" % res_id, level=self.dbg_msg_lvl_api_summary)
+      resp_body = self.do_delete(res_id)
+      self._uncache_resource(res_id)
+      return resp_body
+
    def update_resource(self, res, update_body):
       """
       Updates a specified resource.
@@ -547,8 +1441,8 @@ class BMCConnection(object):
 
    def _start_task(self, task_start_path, task_body):
 
-      resp_body = self.do_post(task_start_path, task_body)
-      resp_hdrs = self.last_response.headers
+      resp = self.redfish_request("POST", task_start_path, body=task_body)
+      resp_hdrs = resp.headers
 
       task_id = resp_hdrs["Location"]
       return task_id
@@ -569,16 +1463,88 @@ class BMCConnection(object):
 
    def _perform_action(self, action_path, action_body):
 
-      resp_body = self.do_post(action_path, action_body)
-      resp_hdrs = self.last_response.headers
-      # task_id = resp_hdrs["Location"]
-      return resp_body
+      resp = self.redfish_request("POST", action_path, body=action_body)
+      # task_id = resp.headers["Location"]
+      return _resp_json(resp)
 
    def perform_action(self, action_path, action_body):
       return self._perform_action(action_path, action_body)
 
    def get_last_response_headers(self):
-      return self.last_response.headers
+      """
+      Returns the headers of the last response received by the calling thread (empty if
+      it hasn't made any requests).
+      """
+      resp = getattr(self.thread_state, "last_response", None)
+      return resp.headers if resp is not None else dict()
+
+   def get_connection_statistics(self):
+      """
+      Returns a dict of transport statistics (requests, bytes, etc.) for this connection.
+      """
+      with self.lock:
+         return dict(self.stats)
+
+   # Readiness probes, for use with wait_until_ready() and friends.  All are cheap (HEAD
+   # requests where possible) and return False rather than raising on errors.
+
+   def _probe_head(self, res_id, unauth=False):
+
+      dbg_msg_lvl = 9
+
+      try:
+         self.do_head(res_id, unauth=unauth, explicit_dbg_msg_level=dbg_msg_lvl)
+         return True
+      except BMCRequestError as exc:
+         # Some services don't do HEAD for everything, in which case fall back to GET.
+         if exc.status != 405:
+            return False
+      except requests.exceptions.RequestException:
+         return False
+
+      try:
+         self.redfish_request("GET", res_id, unauth=unauth, explicit_dbg_msg_level=dbg_msg_lvl)
+         return True
+      except (BMCRequestError, requests.exceptions.RequestException):
+         return False
+
+   def probe_service_root(self):
+      """
+      Returns True if the Redfish service is answering (unauthenticated) requests.
+      """
+      return self._probe_head(None, unauth=True)
+
+   def probe_resource(self, res_id):
+      """
+      Returns True if the specified resource can be read, eg. after it has been created.
+      """
+      return self._probe_head(res_id)
+
+   def probe_redfish_ready(self):
+      """
+      Returns True if Redfish is ready to service (authenticated) requests for the system.
+      """
+      try:
+         system_id = self._get_this_system_id()
+      except (BMCRequestError, requests.exceptions.RequestException):
+         return False
+      return self._probe_head(system_id)
+
+   def probe_ready_for_tasks(self):
+      """
+      Returns True if the BMC is ready to accept task (job) submissions.
+      """
+      return self.probe_redfish_ready()
+
+   def probe_task_ended(self, task_id):
+      """
+      Returns True if the specified task has ended.
+      """
+      try:
+         task_res = self._get_task(task_id)
+      except (BMCRequestError, requests.exceptions.RequestException):
+         return False
+      return task_res.get("TaskState") in _task_states_final
 
    # Collection CRUD.
 
@@ -591,24 +1557,113 @@ class BMCConnection(object):
       if expand != 0:
          query_parm = {"$expand": ".($levels=%d)" % expand}
       coll = self.do_get(coll_id, query_parms=query_parm)
+
+      # If the collection is paged, gather up the members from the rest of the pages
+      # so callers see the whole collection.
+
+      next_page_id = coll.get("Members@odata.nextLink")
+      while next_page_id is not None:
+         page = self.do_get(next_page_id)
+         coll["Members"].extend(page["Members"])
+         next_page_id = page.get("Members@odata.nextLink")
+      coll.pop("Members@odata.nextLink", None)
+
       return coll
 
    def get_collection(self, coll_id, expand=0):
       return self._get_collection(coll_id, expand)
 
-   def _get_collection_member_ids(self, coll_id):
-      coll = self._get_collection(coll_id)
+   def _protocol_feature_supported(self, feature):
 
-      try:
-         members = coll["Members"]
-      except KeyError:
-         raise BMCRequestError(self, msg="Not a collection: %s" % key)
+      # The service root tells us which of the optional query parameters the service
+      # supports (Redfish 1.3+).  Most are booleans but some (eg. ExpandQuery) are
+      # objects, so anything present and not False counts as supported.
+
+      features = self.svc_root_res.get("ProtocolFeaturesSupported", {})
+      return features.get(feature, False) not in [False, None]
 
-      return [m["@odata.id"] for m in members]
+   def _iter_collection_pages(self, coll_id, query_parms=None):
+
+      # Yields the Members list of each page of a collection, following the
+      # Members@odata.nextLink references of a paged collection.
+
+      page_id = coll_id
+      while page_id is not None:
+         page = self.do_get(page_id, query_parms=query_parms)
+         try:
+            members = page["Members"]
+         except KeyError:
+            raise BMCRequestError(self, msg="Not a collection: %s" % coll_id)
+         yield members
+
+         # The next link carries all of the query parameters needed to get the next page.
+         page_id = page.get("Members@odata.nextLink")
+         query_parms = None
+
+   def _iter_collection_member_ids(self, coll_id, odata_filter=None, top=None, skip=None):
+
+      # Yields the ids of the members of a collection, a page at a time.  $filter is only
+      # sent if the service supports it (so callers can't count on it being applied),
+      # and $top/$skip are done locally if the service doesn't support them.  (The top
+      # limit is always also enforced locally, as some services treat $top as a page
+      # size and keep providing next links.)
+
+      query_parms = dict()
+      if odata_filter is not None:
+         if self._protocol_feature_supported("FilterQuery"):
+            query_parms["$filter"] = odata_filter
+         else:
+            dbg("Service doesn't support $filter, not filtering %s server-side." % coll_id,
+                level=self.dbg_msg_lvl_api_details)
+
+      local_top_skip = not self._protocol_feature_supported("TopSkipQuery")
+      if not local_top_skip:
+         if top is not None:
+            query_parms["$top"] = top
+         if skip is not None:
+            query_parms["$skip"] = skip
+
+      to_skip = skip if local_top_skip and skip is not None else 0
+      remaining = top
+
+      for members in self._iter_collection_pages(coll_id, query_parms if query_parms else None):
+         for m in members:
+            if to_skip > 0:
+               to_skip -= 1
+               continue
+            if remaining is not None:
+               if remaining <= 0:
+                  return
+               remaining -= 1
+            yield m["@odata.id"]
+
+   def _iter_collection_members(self, coll_id, where=None, odata_filter=None, select=None,
+                                top=None, skip=None, cacheable=True):
+
+      # Yields the member resources of a collection as they are fetched, without
+      # collecting them into a list.  If provided, where is a predicate applied to
+      # each member (after fetching) to decide if its yielded, and so should agree
+      # with the odata_filter if both are provided.
+
+      query_parms = None
+      if select is not None and self._protocol_feature_supported("SelectQuery"):
+         query_parms = {"$select": ",".join(select)}
+
+      for res_id in self._iter_collection_member_ids(coll_id, odata_filter=odata_filter,
+                                                     top=top, skip=skip):
+         if query_parms is not None:
+            # Partial resource, so don't cache it.
+            res = self.do_get(res_id, query_parms=query_parms)
+         else:
+            res = self._get_resource(res_id, cacheable=cacheable)
+         if where is None or where(res):
+            yield res
+
+   def _get_collection_member_ids(self, coll_id):
+      return list(self._iter_collection_member_ids(coll_id))
 
    def _get_collection_members(self, coll_id):
-      member_ids = self._get_collection_member_ids(coll_id)
-      return [self._get_resource(res_id) for res_id in member_ids]
+      return list(self._iter_collection_members(coll_id))
 
    def get_collection_member_ids(self, coll_id):
       """
@@ -630,6 +1685,24 @@ class BMCConnection(object):
       dbg("Returning the %d resources in collection %s" % (cnt, coll_id), level=self.dbg_msg_lvl_api_summary)
       return member_resources
 
+   def iter_collection_member_ids(self, coll_id, odata_filter=None, top=None, skip=None):
+      """
+      Yields the resource ids of the members of the specified collection, following
+      pagination links.  The OData filter is applied only if the service supports it.
+      """
+      dbg("Iterating over ids of members of collection %s" % coll_id, level=self.dbg_msg_lvl_api_summary)
+      return self._iter_collection_member_ids(coll_id, odata_filter=odata_filter, top=top, skip=skip)
+
+   def iter_collection_members(self, coll_id, where=None, odata_filter=None, select=None,
+                               top=None, skip=None, cacheable=False):
+      """
+      Yields the resources that are members of the specified collection as they are
+      fetched.  Members for which where (if given) returns False are skipped.
+      """
+      dbg("Iterating over members of collection %s" % coll_id, level=self.dbg_msg_lvl_api_summary)
+      return self._iter_collection_members(coll_id, where=where, odata_filter=odata_filter,
+                                           select=select, top=top, skip=skip, cacheable=cacheable)
+
    def get_collection_member_with_name(self, coll_id, names):
       """
       Returns the first collection member that has the specified name.
@@ -637,9 +1710,7 @@ class BMCConnection(object):
 
       check_names = names if type(names) is list else [names]
 
-      member_ids = self._get_collection_member_ids(coll_id)
-      for m_id in member_ids:
-         m_res = self._get_resource(m_id)
+      for m_res in self._iter_collection_members(coll_id):
          if m_res["Name"] in check_names:
             return m_res
 
@@ -660,6 +1731,16 @@ class BMCConnection(object):
       # Probably: /redfish/va/SessionService
       return self.svc_root_res["SessionService"]["@odata.id"]
 
+   def get_session_id(self):
+      """
+      Returns the id of the session this connection has open (None if none).
+      """
+      with self.lock:
+         return self.session_res_id
+
+   def get_session_collection_path(self):
+      return self._get_session_collection_path()
+
    def _get_session_collection_path(self):
 
       # Probably: /redfish/v1/SessionService/Sessions
@@ -691,28 +1772,58 @@ class BMCConnection(object):
    def _get_this_system_id(self):
       if self.this_system_id is not None:
          return self.this_system_id
+      with self.discovery_lock:
+         # (Another thread may have discovered it while we waited.)
+         if self.this_system_id is None:
+            self.this_system_id = self._discover_this_system_id()
+      return self.this_system_id
+
+   def _discover_this_system_id(self):
 
      # We believe the Reedfish service  we'rre connected to is that of a BMC vs. some multi-system
      # management facility (system management application, chassis mgmt module, etc.).  If true, 
      # it stands to reason that there would only be one entry in the System collection. So get
      # that collection and verify there is only one thing there. 
+     #
+     # By the same reasoning there's one Manager, the BMC, so we get the Managers collection
+     # at the same time and then the System and (presumed) Manager resources at the same
+     # time.  Whether we presumed right is checked below, by way of the System's ManagedBy
+     # link as usual.
+
+      started_at = now()
+
+      (sys_collection, sys_exc), (mgr_collection, mgr_exc) = _run_in_parallel(
+         lambda: self.do_get(self._get_sys_collection_path()),
+         lambda: self.do_get(self._get_mgr_collection_path()))
+      if sys_exc is not None:
+         raise sys_exc
 
-      sys_collection = self.do_get(self._get_sys_collection_path())
       members = sys_collection["Members"]
       if len(members) != 1:
          how_many = "No" if len(members) == 0 else "Multiple"
          raise BMCRequestError(self, msg="%s Computer Systems found." % how_many)
 
       # Members is an array of objects with at least an @odata.id property.
-      self.this_system_id = members[0]["@odata.id"]
-      dbg("Determined this system id: %s" % self.this_system_id, level=self.dbg_msg_lvl_api_details)
+      system_id = members[0]["@odata.id"]
+      dbg("Determined this system id: %s" % system_id, level=self.dbg_msg_lvl_api_details)
+
+      mgr_members = mgr_collection.get("Members", []) if mgr_exc is None else []
+      if len(mgr_members) == 1:
+         _run_in_parallel(lambda: self._get_resource(system_id),
+                          lambda: self._get_resource(mgr_members[0]["@odata.id"]))
 
       # As a further check, verify that the system-manager of this system resource is a BMC.
-      # (This method does the BMC check for us.)
 
-      self._get_this_system_manager_resource()
+      sys_res = self._get_resource(system_id)
+      mgr_res = self._get_resource(sys_res["Links"]["ManagedBy"][0]["@odata.id"])
+      self._check_manager_is_bmc(mgr_res)
 
-      return self.this_system_id
+      discovery_secs = now() - started_at
+      with self.lock:
+         self.stats["discovery_secs"] = discovery_secs
+      _bmc_bootstrap_secs.observe(discovery_secs, bmc=self.bmc_label, step="discover-system")
+
+      return system_id
 
    def _get_this_system_resource(self, cacheable=True):
       res_id = self._get_this_system_id()
@@ -733,15 +1844,17 @@ class BMCConnection(object):
 
       res_id = self._get_this_system_manager_id(cacheable=cacheable)
       res = self._get_resource(res_id, cacheable=cacheable)
+      self._check_manager_is_bmc(res)
+      return res
+
+   def _check_manager_is_bmc(self, mgr_res):
 
       # Sanity check.  Make sure is a BMC.
 
-      mgr_type = res["ManagerType"]
+      mgr_type = mgr_res["ManagerType"]
       if mgr_type != "BMC":
          raise BMCRequestError(self, msg="Redfish service is not of Manager-Type BMC.")
 
-      return res
-
    def get_this_system_manager_resource(self, cacheable=True):
       return self._get_this_system_manager_resource(cacheable=cacheable)
 
@@ -797,13 +1910,10 @@ class BMCConnection(object):
 
       # Sign: $exapnd doesn't work on iDRAC.  Getting 404 error re last entry in collection.
       # accts_collection = self._get_collection(col_path, expand=1)
-      accts_collection = self._get_collection(col_path)
 
       accounts = dict()
-      members = accts_collection["Members"]
       empty_slot = None
-      for m in members:
-         member_path = m["@odata.id"]
+      for member_path in self._iter_collection_member_ids(col_path):
          acct_res = self._get_resource(member_path)
          user_name = acct_res["UserName"]
          if user_name != "":
@@ -839,6 +1949,14 @@ class BMCConnection(object):
    def get_all_accounts(self):
       return self._get_accounts()
 
+   def get_account_slots(self):
+      """
+      Returns the resources for all account slots, in use or empty, in slot order.
+      """
+      dbg("Getting all BMC account slots.", level=self.dbg_msg_lvl_api_summary)
+      col_path = self._get_acct_collection_path()
+      return [self._get_resource(m_id, cacheable=False) for m_id in self._iter_collection_member_ids(col_path)]
+
    def get_account(self, user_name):
 
       dbg("Getting BMC account for user \"%s\"" % user_name, level=self.dbg_msg_lvl_api_summary)
@@ -891,7 +2009,14 @@ class BMCConnection(object):
 
       dbg("Will create new account using slot at id %s" % acct_res["Id"], level=self.dbg_msg_lvl_api_details)
 
-      res_id = _get_resource_id(acct_res)
+      self.fill_account_slot(_get_resource_id(acct_res), user_name, password, role)
+
+   def fill_account_slot(self, slot_res_id, user_name, password, role=None):
+      ''''
+      Defines an account (user) with the specified role in an (empty) account slot.
+      '''
+
+      role = "none" if role is None else role
 
       update_body = dict()
 
@@ -900,7 +2025,7 @@ class BMCConnection(object):
       update_body["Enabled"]  = True
       update_body["RoleId"]   = self._map_role(role)
 
-      self._update_resource(res_id, update_body)
+      self._update_resource(slot_res_id, update_body)
 
    def delete_account(self, user_name):
       ''''
@@ -916,7 +2041,14 @@ class BMCConnection(object):
       if acct_res is None:
          raise BMCRequestError(self, msg="Account \"%s\" doesn't exist." % user_name)
 
-      res_id = _get_resource_id(acct_res)
+      self.clear_account_slot(_get_resource_id(acct_res))
+
+   def clear_account_slot(self, slot_res_id):
+      ''''
+      Deletes the account (user) defined in the specified account slot.
+      '''
+
+      res_id = slot_res_id
       update_body = dict()
 
       # On Dell iDRAC 9, you need to do the "delete" by first disabling the account and
@@ -933,6 +2065,20 @@ class BMCConnection(object):
       # update_body["Password"] = ""
       self._update_resource(res_id, update_body)
 
+   def update_account_slot(self, slot_res_id, password=None, role=None):
+      ''''
+      Sets the password and/or role of the account defined in the specified account slot.
+      '''
+
+      update_body = dict()
+      if password is not None:
+         update_body["Password"] = password
+      if role is not None:
+         update_body["RoleId"] = self._map_role(role)
+
+      if update_body:
+         self._update_resource(slot_res_id, update_body)
+
    def set_account_role(self, user_name, role=None):
       ''''
       Sets the role for the specified BMC account (user).
@@ -972,7 +2118,8 @@ class BMCConnection(object):
       Get power state from the Computer System resource for this system/BMC.
       '''
 
-      res = self.get_this_system_resource(cacheable=False)
+      res_id = self._get_this_system_id()
+      res = self._get_resource_properties(res_id, ["PowerState"], cacheable=False)
       return res["PowerState"]
 
    def _do_system_reset_action(self, action_type):
@@ -1068,9 +2215,46 @@ class BMCConnection(object):
 
 class DellBMCConnection(BMCConnection):
 
-   def __init__(self, hostname, username, password):
+   def __init__(self, hostname, username, password, svc_root_path=default_svc_root_path,
+                deadline=None):
 
       # NB: Dell iDRAC's Redfish implementation only supports https connections.
       base_url = "https://%s" % hostname
-      super().__init__(base_url, username, password)
+      super().__init__(base_url, username, password, svc_root_path=svc_root_path, deadline=deadline)
+
+      self.lc_remote_api_status_target = None
+
+   def _get_lc_remote_api_status_target(self):
+      if self.lc_remote_api_status_target is None:
+         mgr_res = self._get_this_system_manager_resource()
+         lc_service_id = mgr_res["Links"]["Oem"]["Dell"]["DellLCService"]["@odata.id"]
+         lc_service_res = self._get_resource(lc_service_id)
+         actions = lc_service_res["Actions"]
+         self.lc_remote_api_status_target = actions["#DellLCService.GetRemoteServicesAPIStatus"]["target"]
+      return self.lc_remote_api_status_target
+
+   def probe_lc_ready(self):
+      """
+      Returns True if the Lifecycle Controller reports that it (and the remote services
+      API) is ready.
+      """
+
+      # Patterned after Dell's DeleteJobQueueREDFISH.py script.  Older iDRAC firmware
+      # just fails the request if LC isn't ready, newer also reports LCStatus.
+
+      dbg_msg_lvl = 9
+
+      try:
+         action_target = self._get_lc_remote_api_status_target()
+         resp_body = self.do_post(action_target, {}, explicit_dbg_msg_level=dbg_msg_lvl)
+      except (BMCRequestError, requests.exceptions.RequestException):
+         return False
+      return resp_body.get("LCStatus", "Ready") == "Ready"
+
+   def probe_ready_for_tasks(self):
+      """
+      Returns True if the BMC is ready to accept task (job) submissions.  For iDRAC that
+      means the Lifecycle Controller is ready.
+      """
+      return self.probe_redfish_ready() and self.probe_lc_ready()
 
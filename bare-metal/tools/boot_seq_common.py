@@ -0,0 +1,685 @@
+
+# Some common functions for classifying and rearranging the UEFI boot sequence
+# of our Fog machines.  Shared by fog-reset-boot-sequence and the tools that
+# check the boot configuration of machines across the lab.
+#
+# This is HIGHLY Dell Server and Fog-Machine-Setup specific!
+
+# Assumes: Python 3.6+
+
+from misc_utils import *
+
+# Some constatns:
+
+entry_kind_prop                  = "*Kind"
+entry_kind_first_disk            = "first-disk"
+entry_kind_other_disk            = "other-disk"
+entry_kind_first_pxe_boot        = "first-pxe"
+entry_kind_other_pxe_boot        = "other-pxe"
+entry_kind_first_http_boot       = "first-http"
+entry_kind_other_http_boot       = "other-http"
+entry_kind_first_iscsi_boot      = "first-iscsi"
+entry_kind_other_iscsi_boot      = "other-iscsi"
+entry_kind_first_optical_drive   = "first-optical-drive"
+entry_kind_other_optical_drive   = "other-optical-drive"
+entry_kind_virtual_floppy_drive  = "virtual-floppy-drive"
+entry_kind_virtual_optical_drive = "virtual-optical-drive"
+entry_kind_generic_usb           = "generic-usb"
+entry_kind_uefi_os               = "uefi-os"
+
+# Names of the boot-sequence orderings rearrange_boot_sequence() knows how to produce.
+
+boot_ordering_standard     = "standard"
+boot_ordering_pxe_fallback = "pxe-fallback"
+boot_ordering_pxe_boot     = "pxe-boot"
+
+def dbg_show_boot_sequence(machine, boot_seq, show_details=True):
+
+   ix = 0
+   for boot_entry in boot_seq:
+      display_name = boot_entry["DisplayName"]
+      enabled = boot_entry["BootOptionEnabled"]
+      uefi_dev_path = boot_entry["UefiDevicePath"]
+      enabled_flag = "*" if enabled else " "
+      details = " [%s]" % uefi_dev_path if show_details else ""
+      dbg("[%s] %s %02d: %s%s" % (machine, enabled_flag, ix, display_name, details))
+      ix += 1
+#
+
+def dbg_show_dell_boot_sequence(machine, entries, id_to_disp_name_map, show_details=True):
+   for e in entries:
+      ix    = e["Index"]
+      ident = e["Id"]
+      name = e["Name"]
+      enabled = e["Enabled"]
+      display_name = id_to_disp_name_map[ident]
+      enabled_flag = "*" if enabled else " "
+      details = " [%s]" % name if show_details else ""
+      dbg("[%s] %s %02d: %s%s" % (machine, enabled_flag, ix, display_name, details))
+
+
+def classify_dell_boot_entries(machine, boot_seq):
+
+   # Highly Dell and Fog-machine specific!
+
+   # HACK WARNING:
+   # The following code makes lots of dependencies on likely Dell-specific device display
+   # names because there doesn't appear to be any better way to be able to detect the
+   # kind of device being mentioned in a boot entry.  The best alternative would be to
+   # rely on the UEFI device path, but that is probably worse because then it introduces
+   # depednencies on just how the devices are plugged into the PCI device address space.
+
+   # We're prepated to find the following kinds of things in the boot sequence:
+   #
+   # - Disk placeholder entries:
+   #   + Eg: Integrated RAID Controller 1: EFI RAID Disk PlaceHolder 1
+   #   + Recognized by:
+   #     - UEFI device path being of the form PciRoot(...)
+   #     - Display name containing the string "Disk Placeholder"
+   #
+   # - PXE Boot entries:
+   #   + Eg: PXE Device 1: Embedded NIC 1 Port 1 Partition 1 (R340)
+   #       : PXE Device 1: Integrated NIC 1 Port 1 Partition 1 (R640)
+   #   + Recognized by:
+   #     - UEFI device path being of the form VenHw(...)
+   #     - Display name containing the string "PXE Device"
+   #
+   # - HTTP Boot Entries:
+   #   + Eg. HTTP Device 1: Embedded NIC 2 Port 1 Partition 1
+   #   + Recognized by:
+   #     - UEFI device path being of the form VenHw(...)
+   #     - Display name containing the string "HTTP Device"
+   #
+   # - ISCSI Boot Entries:
+   #   + Eg. ISCSI Device 1: <Not Connected>
+   #   + Recognized by:
+   #     - UEFI device path being of the form VenHw(...)
+   #     - Display name containing the string "ISCSI Device"
+   #
+   # - Optical drive entries:
+   #   + Eg: Embedded SATA Port Optical Drive E: EFI DVD/CDROM 1
+   #   + Recognized by:
+   #     - UEFI device path being of the form PciRoot(...)
+   #     - Display name containing the string "Optical Drive" and "EFI DVD/CDROM"
+   #
+   # - Generic USB boot entries:
+   #   + Eg: Generic USB Boot
+   #   + Recognized by:
+   #     - Display name being equal to string "Generic USB Boot"
+   #
+   # - Virtual floppy drive entries (virtual media):
+   #   + Eg: Virtual Floppy Drive
+   #   + Recognized by:
+   #     - UEFI device path being of the form PciRoot(...)
+   #     - Display name being equal to string "Virtual Floppy Drive"
+   #
+   # - Virtual optical drive entries (virtual media):
+   #   + Eg: Virtual Floppy Drive
+   #   + Recognized by:
+   #     - UEFI device path being of the form PciRoot(...)
+   #     - Display name being equal to string "Virtual Optical Drive"
+   #
+   # - UEFI ("efitbootmgr managed") OS etnries:
+   #   + Eg display name: Unavailable: Red Hat Enterprise Linux
+   #   + Recognized by:
+   #     - UEFI device path being of the form HD(...)
+
+   # More details on display name stuff We rely on:
+   #
+   # Disk placeholders names:
+   #    Integrated RAID Controller n: <anything> Disk Placeholder n
+   #
+   # PXE boot device names:
+   #    PXE Device n: <specific-device-info>
+   #
+   # Optical drive names:
+   #    <anything> Optical Drive <anything>>: <specific-dev-info> n
+
+   errors_occurred = False
+
+   first_disk_entry_encountered          = False
+   first_pxe_boot_entry_encountered      = False
+   first_http_boot_entry_encountered     = False
+   first_iscsi_boot_entry_encountered    = False
+   first_optical_drive_entry_encountered = False
+
+   for e in boot_seq:
+      recognized = False
+      display_name  = e["DisplayName"]
+      uefi_dev_path = e["UefiDevicePath"]
+
+      if uefi_dev_path.startswith("HD("):
+         # dbg("Entry is a UEFI OS entry for:  %s." % display_name)
+         e[entry_kind_prop] = entry_kind_uefi_os
+         recognized = True
+
+      elif uefi_dev_path.startswith("PciRoot("):
+
+         if  "Disk PlaceHolder" in display_name:
+            first_raid_controller_prefix = "Integrated RAID Controller 1: "
+            is_first_raid_controller = display_name.startswith(first_raid_controller_prefix)
+            if is_first_raid_controller:
+               disk_placeholder_name = display_name[len(first_raid_controller_prefix):]
+               placeholder_nr = int(disk_placeholder_name[disk_placeholder_name.rfind(" ")+1:])
+               if placeholder_nr == 1:
+                  if not first_disk_entry_encountered:
+                     # dbg("Entry is first disk placeholder: %s" % disk_placeholder_name)
+                     e[entry_kind_prop] = entry_kind_first_disk
+                     first_disk_entry_encountered = True
+                  else:
+                     # This multiple-occurrence error has been observed on occasioni, when somehow
+                     # the BIOS etc. gets out of sync with the disk config and creates multiple
+                     # "Hard disk placeholer 1" entries.  Since our processing is based on display
+                     # name, this creates ambiguity about what underlying hard disk/virtual drive
+                     # is represented by these entires, and we can't really tolerate such ambiguity.
+                     emsg("[%s] Current boot sequence has multiple first-disk entries." % machine)
+                     errors_occurred = True
+               else:
+                  # dbg("Entry is additional disk placeholder: %s" % disk_placeholder_name)
+                  e[entry_kind_prop] = entry_kind_other_disk
+               recognized = True
+
+         elif display_name == "Virtual Floppy Drive":
+            # dbg("Entry is virtual floppy drive")
+            e[entry_kind_prop] = entry_kind_virtual_floppy_drive
+            recognized = True
+
+         elif display_name == "Virtual Optical Drive":
+            # dbg("Entry is virtual optical drive")
+            e[entry_kind_prop] = entry_kind_virtual_optical_drive
+            recognized = True
+
+         elif "Optical Drive" in display_name and "EFI DVD/CDROM" in display_name:
+
+            optical_drive_name = display_name[display_name.rfind(":")+2:]
+            optical_drive_nr = int(optical_drive_name[optical_drive_name.rfind(" ")+1:])
+            if optical_drive_nr == 1:
+               if not first_optical_drive_entry_encountered:
+                  # dbg("Entry is first optical drive: %s" % optical_drive_name)
+                  e[entry_kind_prop] = entry_kind_first_optical_drive
+                  first_optical_drive_entry_encountered = True
+               else:
+                  emsg("[%s] Current boot sequence has multiple first-optical-drive entries." % machine)
+                  errors_occurred = True
+            else:
+               # dbg("Entry is additional optical drive: %s" % optical_drive_name)
+               e[entry_kind_prop] = entry_kind_other_optical_drive
+            recognized = True
+
+      elif uefi_dev_path.startswith("VenHw("):
+
+         if "PXE Device" in display_name:
+            first_pxe_dev_prefix = "PXE Device 1: "
+            is_first_pxe_device = display_name.startswith(first_pxe_dev_prefix)
+            if is_first_pxe_device:
+               if not first_pxe_boot_entry_encountered:
+                  pxe_dev_name = display_name[len(first_pxe_dev_prefix):]
+                  # dbg("Entry is first PXE boot device: %s" % pxe_dev_name)
+                  e[entry_kind_prop] = entry_kind_first_pxe_boot
+                  first_pxe_boot_entry_encountered = True
+               else:
+                  emsg("[%s] Current boot sequence has multiple first-pxe-boot entries." % machine)
+                  errors_occurred = True
+            else:
+               pxe_dev_name = display_name[display_name.find(":")+2:]
+               # dbg("Entry is additional PXE boot device: %s" % pxe_dev_name)
+               e[entry_kind_prop] = entry_kind_other_pxe_boot
+            recognized = True
+
+         elif "HTTP Device" in display_name:
+            first_http_dev_prefix = "HTTP Device 1: "
+            is_first_http_device = display_name.startswith(first_http_dev_prefix)
+            if is_first_http_device:
+               if not first_http_boot_entry_encountered:
+                  http_dev_name = display_name[len(first_http_dev_prefix):]
+                  # dbg("Entry is first HTTP boot device: %s" % http_dev_name)
+                  e[entry_kind_prop] = entry_kind_first_http_boot
+                  first_http_boot_entry_encountered = True
+               else:
+                  emsg("[%s] Current boot sequence has multiple first-http-boot entries." % machine)
+                  errors_occurred = True
+            else:
+               http_dev_name = display_name[display_name.find(":")+2:]
+               # dbg("Entry is additional HTTP boot device: %s" % http_dev_name)
+               e[entry_kind_prop] = entry_kind_other_http_boot
+            recognized = True
+
+         elif "ISCSI Device" in display_name:
+            first_iscsi_dev_prefix = "ISCSI Device 1: "
+            is_first_iscsi_device = display_name.startswith(first_iscsi_dev_prefix)
+            if is_first_iscsi_device:
+               if not first_iscsi_boot_entry_encountered:
+                  iscsi_dev_name = display_name[len(first_iscsi_dev_prefix):]
+                  # dbg("Entry is first ISCSI boot device: %s" % iscsi_dev_name)
+                  e[entry_kind_prop] = entry_kind_first_iscsi_boot
+                  first_iscsi_boot_entry_encountered = True
+               else:
+                  emsg("[%s] Current boot sequence has multiple first-iscsi-boot entries." % machine)
+                  errors_occurred = True
+            else:
+               iscsi_dev_name = display_name[display_name.find(":")+2:]
+               # dbg("Entry is additional ISCSI boot device: %s" % iscsi_dev_name)
+               e[entry_kind_prop] = entry_kind_other_iscsi_boot
+            recognized = True
+
+         elif display_name == "Generic USB Boot":
+            # dbg("Entry is generic boot entry: %s" % display_name)
+            e[entry_kind_prop] = entry_kind_generic_usb
+            recognized = True
+
+      if not recognized:
+         emsg("Unrecognized boot-sequecne entry: %s" % display_name)
+         blurt(json_dumps(e))
+         errors_occurred = True
+   #
+
+   if errors_occurred:
+      emsg("[%s] One or more boot-sequence errors occurred." % machine)
+
+   return not errors_occurred
+
+def rearrange_boot_sequence(machine, input_boot_seq, ordering=None):
+
+   # Highly Fog-machine specific!
+
+   # We're prepated to find the following kinds of things in the boot sequence:
+   #
+   # - entry_kind_first_disk/entry_kind_other_disk:
+   #   + Default Disposition:
+   #     - The first such disk entry becomes the first entry in the new boot sequence.
+   #        Its the only one marked enabled.
+   #     - Other disk entries found are pushed down below all of the "first of" entries
+   #       and are marked disabled.
+   #
+   # - entry_kind_first_pxe_boot/entry_kind_other_pxe_boot:
+   #   + Default Disposition:
+   #     - The first such entry becomes the second entry in the new boot sequence.
+   #       It is marked disabled.
+   #     - Other entries found are pushed down below all of the "first of" entries
+   #       and are marked disabled.
+   #
+   # - entry_kind_first_optical_drive/entry_kind_other_optical_drive:
+   #   + Default Disposition:
+   #     - The first such entry becomes the third entry in the new boot sequence.
+   #       It is marked disabled.
+   #     - Other entries found are pushed down below all of the "first of" entries
+   #       and are marked disabled.
+   #
+   # - entry_kind_first_http_boot/entry_kind_other_http_boot:
+   #   + Default Disposition:
+   #     - All such entries found are pushed down below all of the "first of" entries
+   #       and are marked disabled.
+   #
+   # - entry_kind_first_iscsi_boot/entry_kind_other_iscsi_boot:
+   #   + Default Disposition:
+   #     - All such entries found are pushed down below all of the "first of" entries
+   #       and are marked disabled.
+   #
+   # - entry_kind_generic_usb:
+   #   + Default Disposition:
+   #     - Considered to be of a generic "other" type
+   #     - All such entries found are pushed down below all of the "first of" entries
+   #       and are marked disabled.
+   #
+   # - entry_kind_uefi_os:
+   #   + Default Disposition:
+   #     - All such entries found are pushed down to be the last group of entries in
+   #       the new boot sequence, and are marked disabled.
+
+   # Gather up what we have based on kind.
+
+   first_disk_entry = None
+   other_disk_entries = []
+   first_pxe_boot_entry = None
+   other_pxe_boot_entries = []
+   first_http_boot_entry = None
+   other_http_boot_entries = []
+   first_iscsi_boot_entry = None
+   other_iscsi_boot_entries = []
+   first_optical_drive_entry = None
+   other_optical_drive_entries = []
+   uefi_os_entries = []
+   generic_usb_entries = []
+   virtual_floppy_drive_entry = None   # Assume just one
+   virtual_optical_drive_entry = None  # Assume just one
+
+   errors_occurred = False
+   for e in input_boot_seq:
+      kind = e[entry_kind_prop]
+
+      if kind == entry_kind_first_disk:
+         first_disk_entry = e
+
+      elif kind == entry_kind_other_disk:
+         other_disk_entries.append(e)
+
+      elif kind == entry_kind_first_pxe_boot:
+         first_pxe_boot_entry = e
+
+      elif kind == entry_kind_other_pxe_boot:
+         other_pxe_boot_entries.append(e)
+
+      elif kind == entry_kind_first_http_boot:
+         first_http_boot_entry = e
+
+      elif kind == entry_kind_other_http_boot:
+         other_http_boot_entries.append(e)
+
+      elif kind == entry_kind_first_iscsi_boot:
+         first_iscsi_boot_entry = e
+
+      elif kind == entry_kind_other_iscsi_boot:
+         other_iscsi_boot_entries.append(e)
+
+      elif kind == entry_kind_first_optical_drive:
+         first_optical_drive_entry = e
+
+      elif kind == entry_kind_other_optical_drive:
+         other_optical_drive_entries.append(e)
+
+      elif kind == entry_kind_generic_usb:
+         generic_usb_entries.append(e)
+
+      elif kind == entry_kind_virtual_floppy_drive:
+         virtual_floppy_drive_entry = e
+
+      elif kind == entry_kind_virtual_optical_drive:
+         virtual_optical_drive_entry = e
+
+      elif kind == entry_kind_uefi_os:
+         uefi_os_entries.append(e)
+
+      else:
+         emsg("[%s] Script logic error: Unrecognized entry-kind %s" % (machine, kind))
+         errors_occurred = True
+   #
+   if errors_occurred:
+      return None
+
+   # Reorganize into standard new boot sequence (all disabled except as noted):
+   # - First disk (enabled)
+   # - FIrst PXE Boot entries
+   # - First optical drive
+   # - Other disks
+   # - Other PXE boot entries
+   # - Other optilcal drive entries
+   # - Other recognized device entries
+   # - UEFI OS book entries
+
+   # These lists define the desired ordering of boot entryes by kind/class of entry.
+
+   standard_ordering = [
+      {"kind": entry_kind_first_disk,            "required": True,  "enabled": True},
+      {"kind": entry_kind_first_pxe_boot,        "required": True,  "enabled": False},
+      {"kind": entry_kind_first_optical_drive,   "required": False, "enabled": False},
+      {"kind": entry_kind_other_disk,            "required": False, "enabled": False},
+      {"kind": entry_kind_other_pxe_boot,        "required": False, "enabled": False},
+      {"kind": entry_kind_first_http_boot,       "required": False, "enabled": False},
+      {"kind": entry_kind_other_http_boot,       "required": False, "enabled": False},
+      {"kind": entry_kind_first_iscsi_boot,      "required": False, "enabled": False},
+      {"kind": entry_kind_other_iscsi_boot,      "required": False, "enabled": False},
+      {"kind": entry_kind_other_optical_drive,   "required": False, "enabled": False},
+      {"kind": entry_kind_generic_usb,           "required": False, "enabled": False},
+      {"kind": entry_kind_virtual_floppy_drive,  "required": False, "enabled": False},
+      {"kind": entry_kind_virtual_optical_drive, "required": False, "enabled": False},
+      {"kind": entry_kind_uefi_os,               "required": False, "enabled": False}
+   ]
+
+   pxe_fallback_ordering = [
+      {"kind": entry_kind_first_disk,            "required": True,  "enabled": True},
+      {"kind": entry_kind_first_pxe_boot,        "required": True,  "enabled": True},
+      {"kind": entry_kind_first_optical_drive,   "required": False, "enabled": False},
+      {"kind": entry_kind_other_disk,            "required": False, "enabled": False},
+      {"kind": entry_kind_other_pxe_boot,        "required": False, "enabled": False},
+      {"kind": entry_kind_first_http_boot,       "required": False, "enabled": False},
+      {"kind": entry_kind_other_http_boot,       "required": False, "enabled": False},
+      {"kind": entry_kind_first_iscsi_boot,      "required": False, "enabled": False},
+      {"kind": entry_kind_other_iscsi_boot,      "required": False, "enabled": False},
+      {"kind": entry_kind_other_optical_drive,   "required": False, "enabled": False},
+      {"kind": entry_kind_generic_usb,           "required": False, "enabled": False},
+      {"kind": entry_kind_virtual_floppy_drive,  "required": False, "enabled": False},
+      {"kind": entry_kind_virtual_optical_drive, "required": False, "enabled": False},
+      {"kind": entry_kind_uefi_os,               "required": False, "enabled": False}
+   ]
+
+   pxe_boot_ordering = [
+      {"kind": entry_kind_first_pxe_boot,        "required": True,  "enabled": True},
+      {"kind": entry_kind_first_disk,            "required": True,  "enabled": False},
+      {"kind": entry_kind_first_optical_drive,   "required": False, "enabled": False},
+      {"kind": entry_kind_other_disk,            "required": False, "enabled": False},
+      {"kind": entry_kind_other_pxe_boot,        "required": False, "enabled": False},
+      {"kind": entry_kind_first_http_boot,       "required": False, "enabled": False},
+      {"kind": entry_kind_other_http_boot,       "required": False, "enabled": False},
+      {"kind": entry_kind_first_iscsi_boot,      "required": False, "enabled": False},
+      {"kind": entry_kind_other_iscsi_boot,      "required": False, "enabled": False},
+      {"kind": entry_kind_other_optical_drive,   "required": False, "enabled": False},
+      {"kind": entry_kind_generic_usb,           "required": False, "enabled": False},
+      {"kind": entry_kind_virtual_floppy_drive,  "required": False, "enabled": False},
+      {"kind": entry_kind_virtual_optical_drive, "required": False, "enabled": False},
+      {"kind": entry_kind_uefi_os,               "required": False, "enabled": False}
+   ]
+
+   if ordering == boot_ordering_pxe_fallback:
+      new_ordering = pxe_fallback_ordering
+   elif ordering == boot_ordering_pxe_boot:
+      new_ordering = pxe_boot_ordering
+   else:
+      new_ordering = standard_ordering
+
+   # This map defines where the reordering loop finds source data for each kind/class
+   # of entry as it encounters them.  (It provides some display stuff too.)
+
+   kind_control = {
+      entry_kind_first_disk: {
+         "display-name": "first-disk",
+         "source-data":  first_disk_entry
+      },
+      entry_kind_first_pxe_boot: {
+         "display-name": "first-pxe-boot",
+         "source-data":  first_pxe_boot_entry
+      },
+      entry_kind_first_http_boot: {
+         "display-name": "first-http-boot",
+         "source-data":  first_http_boot_entry
+      },
+      entry_kind_first_iscsi_boot: {
+         "display-name": "first-iscsi-boot",
+         "source-data":  first_iscsi_boot_entry
+      },
+      entry_kind_first_optical_drive: {
+         "display-name": "first-optical-drive",
+         "source-data":  first_optical_drive_entry
+      },
+      entry_kind_other_disk: {
+         "display-name": "other disk",
+         "source-data":  other_disk_entries
+      },
+      entry_kind_other_pxe_boot: {
+         "display-name": "other pxe-boot",
+         "source-data":  other_pxe_boot_entries
+      },
+      entry_kind_other_http_boot: {
+         "display-name": "other http-boot",
+         "source-data":  other_http_boot_entries
+      },
+      entry_kind_other_iscsi_boot: {
+         "display-name": "other iscsi-boot",
+         "source-data":  other_iscsi_boot_entries
+      },
+      entry_kind_other_optical_drive: {
+         "display-name": "other optical-drive",
+         "source-data":  other_pxe_boot_entries
+      },
+      entry_kind_other_pxe_boot: {
+         "display-name": "other pxe-boot",
+         "source-data":  other_optical_drive_entries
+      },
+      entry_kind_generic_usb: {
+         "display-name": "generic usb-boot",
+         "source-data":  generic_usb_entries
+      },
+      entry_kind_virtual_floppy_drive: {
+         "display-name": "virtual_floppy_drive",
+         "source-data":  virtual_floppy_drive_entry
+      },
+      entry_kind_virtual_optical_drive: {
+         "display-name": "virtual_optical_drive",
+         "source-data":  virtual_optical_drive_entry
+      },
+      entry_kind_uefi_os: {
+         "display-name": "UEFI OS",
+         "source-data":  uefi_os_entries
+      }
+   }
+
+   new_boot_seq = []
+   all_required_entries_found = True
+
+   for g in new_ordering:
+
+      # Attributes of the kind/class we're now adding to the new boot sequence:
+      kind     = g["kind"]
+      required = g["required"]
+      enabled  = g["enabled"]
+
+      # And some info about where to get source info for that kind:
+      display_name=kind_control[kind]["display-name"]
+      source_data=kind_control[kind]["source-data"]
+
+      source_is_list = isinstance(source_data, list)
+
+      if source_data:
+         if source_is_list:
+            for list_entry in source_data:
+               new_e = list_entry
+               new_e["BootOptionEnabled"] = enabled
+               new_boot_seq.append(new_e)
+         else:
+           new_e = source_data
+           new_e["BootOptionEnabled"] = enabled
+           new_boot_seq.append(new_e)
+      else:
+         if required:
+            if source_is_list:
+               emsg("[%s] Current boot sequence did not contain any %s entries." % (machine, display_name))
+            else:
+               emsg("[%s] Current boot sequence did not contain a %s entry." % (machine, display_name))
+            all_required_entries_found = False
+   #
+
+   if not all_required_entries_found:
+      return None
+   if len(input_boot_seq) != len(new_boot_seq):
+      emsg("[%s] Script logic error: Current and new boot sequences are not the same length." % machine)
+      return None
+
+   return new_boot_seq
+
+def get_current_dell_uefi_boot_sequence(machine, bmc_conn):
+
+   sys_res = bmc_conn.get_system_resource()
+   boot_sources = bmc_conn.get_resource(sys_res["@odata.id"] + "/BootSources")
+
+   # Example of interesting part of BootSources:
+
+   # ...
+   # "Attributes": {
+   #   "UefiBootSeq": [
+   #     {
+   #       "Enabled": true,
+   #       "Id": "BIOS.Setup.1-1#UefiBootSeq#RAID.Integrated.1-1#f1a60a11cf4311ecfd5309e802b3afc2",
+   #       "Index": 0,
+   #       "Name": "RAID.Integrated.1-1"
+   #     },
+   #     {
+   #       "Enabled": false,
+   #       "Id": "BIOS.Setup.1-1#UefiBootSeq#NIC.PxeDevice.1-1#f7dbc53a281f0f61e8e4c4fb27008828",
+   #       "Index": 1,
+   #       "Name": "NIC.PxeDevice.1-1"
+   #     },
+   #     ...
+   #     {
+   #       "Enabled": false,
+   #       "Id": "BIOS.Setup.1-1#UefiBootSeq#Unknown.Unknown.8-1#8541c05cfae70f8aec3fd50781b290e7",
+   #       "Index": 7,
+   #       "Name": "Unknown.Unknown.8-1"
+   #     }
+   #   ]
+   # }
+   # ...
+
+   return boot_sources["Attributes"]["UefiBootSeq"]
+
+def get_dell_uefi_boot_entry_name_to_id_map(machine, bmc_conn):
+
+   # Get the BootSourceRegistry attriute, and transform into a map from dos[;au ma,e
+   # to id.  We need this to translate the info in our rearranged boot sequence, which
+   # is expressed in terms of Redfish-standard BootOptions, into the corresponding
+   # Dell-specific UefiBootSeq info that we PATCH.  Correlating by display name seems
+   # like the only way to do it (eek!).
+
+   sys_res = bmc_conn.get_system_resource()
+   boot_sources_rgy = bmc_conn.get_resource(sys_res["@odata.id"] + "/BootSources/BootSourcesRegistry")
+
+   # Example of interesting part of BootSourcesRegistry
+
+   # ...
+   # "RegistryEntries": {
+   #   "Attributes": [
+   #     {
+   #       "AttributeName": "UefiBootSeq",
+   #       "DisplayName": "UEFI Boot Sequence",
+   #       "DisplayOrder": 0,
+   #       "Entry": [
+   #         {
+   #           "DisplayName": "Integrated RAID Controller 1: EFI RAID Disk PlaceHolder 1",
+   #           "Enabled": null,
+   #           "Id": "BIOS.Setup.1-1#UefiBootSeq#RAID.Integrated.1-1#f1a60a11cf4311ecfd5309e802b3afc2",
+   #           "Index": null,
+   #           "Name": "RAID.Integrated.1-1"
+   #         },
+   #         {
+   #           "DisplayName": "PXE Device 1: Embedded NIC 1 Port 1 Partition 1",
+   #           "Enabled": null,
+   #           "Id": "BIOS.Setup.1-1#UefiBootSeq#NIC.PxeDevice.1-1#f7dbc53a281f0f61e8e4c4fb27008828",
+   #           "Index": null,
+   #           "Name": "NIC.PxeDevice.1-1"
+   #         },
+   #         ...
+   #         {
+   #           "DisplayName": "Unavailable: ironic1",
+   #           "Enabled": null,
+   #           "Id": "BIOS.Setup.1-1#UefiBootSeq#Unknown.Unknown.8-1#8541c05cfae70f8aec3fd50781b290e7",
+   #           "Index": null,
+   #           "Name": "Unknown.Unknown.8-1"
+   #         }
+   #       ],
+   #       "HelpText": "This field controls the UEFI boot order. The first option in the list will be attempted first, and if unsuccessful, the second option will be attempted and so on. This field applies only when Boot Mode is 'UEFI'; it has no effect when Boot Mode is 'BIOS'.",
+   #       "Hidden": false,
+   #       "MenuPath": "./BootSettingsRef/UefiBootSettingsRef",
+   #       "ReadOnly": false,
+   #       "Type": "OrderedList"
+   #     }
+   #   ],
+   #   ...
+
+   # Find the UEFI Boot Sequence info within the attribute list.
+
+   uefi_boot_seq_attr = None
+   for e in boot_sources_rgy["RegistryEntries"]["Attributes"]:
+      if e["AttributeName"] == "UefiBootSeq":
+         uefi_boot_seq_attr = e
+         break
+   if uefi_boot_seq_attr == None:
+      die("Could not find UefiBootSeq attribute within BootSourcesRegistry resource.")
+
+   # Now turn the UEFI boot sequence info into the map we need.
+
+   disp_name_to_id_map = dict()
+   for e in uefi_boot_seq_attr["Entry"]:
+      ident = e["Id"]
+      name = e["Name"]
+      display_name = e["DisplayName"]
+      disp_name_to_id_map[display_name] = ident
+
+   return disp_name_to_id_map
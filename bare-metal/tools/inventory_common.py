@@ -0,0 +1,286 @@
+
+# Some common functions for collecting hardware/firmware inventory from the BMCs of
+# the lab machines into a local (SQLite) snapshot store, and for querying that store.
+#
+# The store holds the most recent snapshot for each machine, along with the time it
+# was collected so that queries can say how fresh the answers are.  The details from
+# crawling the sub-collections (storage, NICs, licenses) aren't necessarily crawled
+# with every snapshot, so the time they were is kept too.
+
+# Assumes: Python 3.6+
+
+import calendar
+import sqlite3
+import time
+
+from lab_common import *
+
+_inventory_schema = """
+   create table if not exists machines (
+      machine       text primary key,
+      collected_at  real not null,
+      details_collected_at real,
+      vendor        text,
+      model         text,
+      service_tag   text,
+      serial_number text,
+      bios_version  text,
+      power_state   text,
+      memory_gib    real,
+      cpu_count     integer,
+      cpu_model     text,
+      bmc_model     text,
+      bmc_firmware  text,
+      system_etag   text,
+      manager_etag  text
+   );
+   create index if not exists machines_bmc_firmware on machines (bmc_firmware);
+   create index if not exists machines_bios_version on machines (bios_version);
+
+   create table if not exists storage_controllers (
+      machine    text not null,
+      storage_id text not null,
+      model      text,
+      firmware   text
+   );
+   create index if not exists storage_controllers_machine on storage_controllers (machine);
+   create index if not exists storage_controllers_model on storage_controllers (model);
+
+   create table if not exists volumes (
+      machine        text not null,
+      storage_id     text not null,
+      volume_id      text not null,
+      name           text,
+      capacity_bytes integer,
+      raid_type      text
+   );
+   create index if not exists volumes_machine on volumes (machine);
+
+   create table if not exists nics (
+      machine      text not null,
+      nic_id       text not null,
+      mac_address  text,
+      speed_mbps   integer,
+      link_status  text
+   );
+   create index if not exists nics_machine on nics (machine);
+   create index if not exists nics_mac_address on nics (mac_address);
+
+   create table if not exists licenses (
+      machine        text not null,
+      entitlement_id text,
+      description    text,
+      license_type   text,
+      end_date       text
+   );
+   create index if not exists licenses_machine on licenses (machine);
+   create index if not exists licenses_type on licenses (license_type);
+"""
+
+# Tables holding the parts of a snapshot that come from crawling the sub-collections
+# of the System and Manager resources, along with the columns of each.
+
+_detail_tables = {
+   "storage_controllers": ["storage_id", "model", "firmware"],
+   "volumes":             ["storage_id", "volume_id", "name", "capacity_bytes", "raid_type"],
+   "nics":                ["nic_id", "mac_address", "speed_mbps", "link_status"],
+   "licenses":            ["entitlement_id", "description", "license_type", "end_date"]
+}
+
+_machine_columns = ["vendor", "model", "service_tag", "serial_number", "bios_version",
+                    "power_state", "memory_gib", "cpu_count", "cpu_model", "bmc_model",
+                    "bmc_firmware", "system_etag", "manager_etag"]
+
+def get_default_inventory_store_pathname():
+   return os.path.join(get_lab_state_dir(), "inventory.sqlite")
+
+def license_days_remaining(end_date, as_of=None):
+
+   # Licenses carry an end date like "2023-06-01T00:00:00-05:00" (or no end date if
+   # they don't expire).  Returns the (possibly negative) number of whole days left.
+
+   if not end_date:
+      return None
+   as_of = now() if as_of is None else as_of
+   try:
+      end_time = calendar.timegm(time.strptime(end_date[:10], "%Y-%m-%d"))
+   except ValueError:
+      return None
+   return int((end_time - as_of) // 86400)
+
+class InventoryStore:
+
+   def __init__(self, pathname=None):
+      self.pathname = pathname if pathname is not None else get_default_inventory_store_pathname()
+      dbg("Using inventory store: %s" % self.pathname, level=2)
+      self.db = sqlite3.connect(self.pathname)
+      self.db.row_factory = sqlite3.Row
+      self.db.executescript(_inventory_schema)
+
+      # (Stores from before details_collected_at was added get it, as unknown.)
+      columns = [r["name"] for r in self.db.execute("pragma table_info(machines)")]
+      if "details_collected_at" not in columns:
+         with self.db:
+            self.db.execute("alter table machines add column details_collected_at real")
+
+   def close(self):
+      self.db.close()
+
+   def get_machine_row(self, machine):
+      return self.db.execute("select * from machines where machine = ?", (machine,)).fetchone()
+
+   def get_machine_rows(self, machines=None):
+      rows = self.db.execute("select * from machines order by machine").fetchall()
+      if machines is not None:
+         rows = [r for r in rows if r["machine"] in machines]
+      return rows
+
+   def get_detail_rows(self, table, machine):
+      return self.db.execute("select * from %s where machine = ?" % table, (machine,)).fetchall()
+
+   def save_snapshot(self, machine, snapshot):
+
+      # Saves (replaces) the snapshot for a machine.  If the snapshot doesn't include the
+      # details from the sub-collection crawls (because nothing changed), the details
+      # recorded previously are kept, along with when they were collected.
+
+      details = snapshot.get("details")
+      with self.db:
+         if details is not None:
+            details_collected_at = snapshot["collected_at"]
+         else:
+            prev_row = self.get_machine_row(machine)
+            details_collected_at = prev_row["details_collected_at"] if prev_row is not None else None
+         cols = ["machine", "collected_at", "details_collected_at"] + _machine_columns
+         values = [machine, snapshot["collected_at"], details_collected_at] + \
+                  [snapshot["machine"].get(c) for c in _machine_columns]
+         self.db.execute("insert or replace into machines (%s) values (%s)" %
+                         (", ".join(cols), ", ".join("?" * len(cols))), values)
+
+         if details is None:
+            return
+         for table, table_cols in _detail_tables.items():
+            self.db.execute("delete from %s where machine = ?" % table, (machine,))
+            cols = ["machine"] + table_cols
+            self.db.executemany("insert into %s (%s) values (%s)" %
+                                (table, ", ".join(cols), ", ".join("?" * len(cols))),
+                                [[machine] + [row.get(c) for c in table_cols] for row in details[table]])
+
+# Crawls the inventory-related resources of a machine's BMC.
+
+class InventoryCollector:
+
+   def __init__(self, args, known_etags=None, full_crawl=False, details_due=None):
+
+      # known_etags is a dict indexed by machine name of (system_etag, manager_etag)
+      # tuples from the snapshots in the store.  Details_due is the machines whose
+      # details are to be re-crawled regardless (eg. as they were last crawled long ago).
+
+      self.args = args
+      self.known_etags = known_etags if known_etags is not None else dict()
+      self.full_crawl = full_crawl
+      self.details_due = details_due if details_due is not None else set()
+
+   @staticmethod
+   def _get_with_etag(bmc_conn, res_id):
+      res = bmc_conn.get_resource(res_id, cacheable=False)
+      etag = bmc_conn.get_last_response_headers().get("ETag", res.get("@odata.etag"))
+      return (res, etag)
+
+   def collect_machine(self, machine):
+
+      bmc_conn = LabBMCConnection.create_connection(machine, self.args)
+
+      service_root_res = bmc_conn.get_service_root_resource()
+      vendor = service_root_res["Vendor"]
+
+      system_res = bmc_conn.get_system_resource(cacheable=False)
+      system_etag = bmc_conn.get_last_response_headers().get("ETag", system_res.get("@odata.etag"))
+      mgr_res_id = system_res["Links"]["ManagedBy"][0]["@odata.id"]
+      mgr_res, mgr_etag = self._get_with_etag(bmc_conn, mgr_res_id)
+
+      processors = system_res.get("ProcessorSummary", {})
+      memory = system_res.get("MemorySummary", {})
+      snapshot = {
+         "collected_at": now(),
+         "machine": {
+            "vendor":        vendor,
+            "model":         system_res.get("Model"),
+            "service_tag":   system_res.get("SKU"),
+            "serial_number": system_res.get("SerialNumber"),
+            "bios_version":  system_res.get("BiosVersion"),
+            "power_state":   system_res.get("PowerState"),
+            "memory_gib":    memory.get("TotalSystemMemoryGiB"),
+            "cpu_count":     processors.get("Count"),
+            "cpu_model":     processors.get("Model"),
+            "bmc_model":     mgr_res.get("Model"),
+            "bmc_firmware":  mgr_res.get("FirmwareVersion"),
+            "system_etag":   system_etag,
+            "manager_etag":  mgr_etag
+         }
+      }
+
+      # The sub-collections are where most of the requests go, so only crawl them if
+      # the System or Manager resource has changed since the last snapshot, or they're
+      # due anyway.  (Without ETags to go on, we always crawl.)  Not everything changes
+      # those ETags (eg. creating a volume or installing a license doesn't), hence the
+      # latter.
+
+      known_etags = self.known_etags.get(machine)
+      unchanged = system_etag is not None and mgr_etag is not None and \
+                  known_etags == (system_etag, mgr_etag)
+      if unchanged and not self.full_crawl and machine not in self.details_due:
+         dbg("[%s] System and Manager unchanged, keeping previous details." % machine, level=2)
+         return snapshot
+
+      details = {t: [] for t in _detail_tables}
+      snapshot["details"] = details
+
+      if "Storage" in system_res:
+         for stg_res in bmc_conn.get_collection_members(system_res["Storage"]["@odata.id"]):
+            stg_id = stg_res["Id"]
+            for ctrl in stg_res.get("StorageControllers", []):
+               details["storage_controllers"].append({
+                  "storage_id": stg_id,
+                  "model":      ctrl.get("Model", "").strip(),
+                  "firmware":   ctrl.get("FirmwareVersion")
+               })
+            if "Volumes" not in stg_res:
+               continue
+            for vol_res in bmc_conn.get_collection_members(stg_res["Volumes"]["@odata.id"]):
+               details["volumes"].append({
+                  "storage_id":     stg_id,
+                  "volume_id":      vol_res["Id"],
+                  "name":           vol_res.get("Name"),
+                  "capacity_bytes": vol_res.get("CapacityBytes"),
+                  "raid_type":      vol_res.get("RAIDType", vol_res.get("VolumeType"))
+               })
+
+      if "EthernetInterfaces" in system_res:
+         for nic_res in bmc_conn.get_collection_members(system_res["EthernetInterfaces"]["@odata.id"]):
+            details["nics"].append({
+               "nic_id":      nic_res["Id"],
+               "mac_address": nic_res.get("MACAddress", "").lower(),
+               "speed_mbps":  nic_res.get("SpeedMbps"),
+               "link_status": nic_res.get("LinkStatus")
+            })
+
+      # Licenses are Dell specific.  (See also fog-show-bmc-info.)
+
+      try:
+         dell_license_coll_id = mgr_res["Links"]["Oem"]["Dell"]["DellLicenseCollection"]["@odata.id"]
+      except KeyError:
+         dell_license_coll_id = None
+      if dell_license_coll_id is not None:
+         bmc_inst_id = mgr_res["Id"]
+         for lic in bmc_conn.get_collection_members(dell_license_coll_id):
+            if bmc_inst_id not in lic.get("AssignedDevices", []):
+               continue
+            details["licenses"].append({
+               "entitlement_id": lic.get("EntitlementID"),
+               "description":    lic.get("LicenseDescription", [""])[0],
+               "license_type":   lic.get("LicenseType"),
+               "end_date":       lic.get("LicenseEndDate")
+            })
+
+      return snapshot
@@ -0,0 +1,242 @@
+
+# Some common functions for keeping track of the iDRAC job queues of the lab machines
+# in bulk, eg. to spot jobs that have been sitting Scheduled for too long.
+#
+# A JobQueuePoller polls the job queues of a set of machines concurrently (at most
+# max_parallel at once), keeping its connection to each BMC across polls.  Each poll
+# reads the Jobs collection and then only those jobs that might have changed: jobs
+# not seen before, and jobs not yet ended.  The latter reads are conditional, so an
+# unchanged job costs only a 304.  Jobs that have ended don't change, so once seen
+# they're not read again.
+#
+# What has been seen is kept in a FleetJobIndex, indexed by machine, job state and
+# message id.  The index is saved in the lab state dir so that a later run carries
+# on from where the last one left off, including knowing how long each job has been
+# in its current state.
+
+# Assumes: Python 3.6+
+
+import threading
+
+from lab_common import *
+
+def get_job_queue_state_pathname():
+   return os.path.join(get_lab_state_dir(), "job-queues.json")
+
+def job_queue_record(job_res):
+
+   # Returns the record kept for a job, from either a DMTF Job or a DellJob resource
+   # (the latter has its message at the top level rather than in a Messages list).
+
+   msgs = job_res.get("Messages") or []
+   msg = msgs[0] if msgs else job_res
+   return {
+      "id":               job_res["Id"],
+      "name":             job_res.get("Name"),
+      "state":            job_res.get("JobState"),
+      "status":           job_res.get("JobStatus"),
+      "percent_complete": job_res.get("PercentComplete"),
+      "message":          msg.get("Message"),
+      "message_id":       msg.get("MessageId"),
+      "waiting":          job_is_waiting(job_res),
+      "ended":            job_has_ended(job_res)
+   }
+
+class FleetJobIndex:
+
+   def __init__(self):
+
+      self.lock = threading.Lock()
+
+      # Job records indexed by machine and then job id.  Besides what job_queue_record()
+      # provides, each has first_seen and state_since times.
+      self.jobs = dict()
+
+      # Sets of (machine, job id) tuples indexed by job state and by message id.
+      self.by_state = dict()
+      self.by_message_id = dict()
+
+      # Time of the last successful poll and error from the last failed one, by machine.
+      self.polled_at = dict()
+      self.errors = dict()
+
+   def _index_job(self, machine, rec):
+      key = (machine, rec["id"])
+      self.by_state.setdefault(rec["state"], set()).add(key)
+      self.by_message_id.setdefault(rec["message_id"], set()).add(key)
+
+   def _unindex_job(self, machine, rec):
+      key = (machine, rec["id"])
+      for index, value in [(self.by_state, rec["state"]), (self.by_message_id, rec["message_id"])]:
+         keys = index.get(value)
+         if keys is not None:
+            keys.discard(key)
+            if not keys:
+               del index[value]
+
+   def get_machine_jobs(self, machine):
+      with self.lock:
+         return dict(self.jobs.get(machine, {}))
+
+   def update_machine(self, machine, records, polled_at):
+
+      # Replaces what we know of a machine's jobs with the records from a poll, carrying
+      # the first-seen and state-since times over from what we knew before.
+
+      with self.lock:
+         old_jobs = self.jobs.get(machine, {})
+         for rec in old_jobs.values():
+            self._unindex_job(machine, rec)
+
+         new_jobs = dict()
+         for rec in records:
+            rec = dict(rec)
+            prev = old_jobs.get(rec["id"])
+            rec["first_seen"] = prev["first_seen"] if prev is not None else polled_at
+            if prev is not None and prev["state"] == rec["state"]:
+               rec["state_since"] = prev["state_since"]
+            else:
+               rec["state_since"] = polled_at
+            new_jobs[rec["id"]] = rec
+            self._index_job(machine, rec)
+
+         self.jobs[machine] = new_jobs
+         self.polled_at[machine] = polled_at
+         self.errors.pop(machine, None)
+
+   def note_error(self, machine, error):
+      with self.lock:
+         self.errors[machine] = str(error)
+
+   def _lookup(self, keys):
+      return sorted(((m, dict(self.jobs[m][j])) for m, j in keys), key=lambda mj: (mj[0], mj[1]["id"]))
+
+   def jobs_in_state(self, state):
+      with self.lock:
+         return self._lookup(self.by_state.get(state, set()))
+
+   def jobs_with_message_id(self, message_id):
+      with self.lock:
+         return self._lookup(self.by_message_id.get(message_id, set()))
+
+   def state_counts(self):
+      with self.lock:
+         return {s: len(keys) for s, keys in self.by_state.items()}
+
+   def message_id_counts(self):
+      with self.lock:
+         return {mid: len(keys) for mid, keys in self.by_message_id.items()}
+
+   def stuck_jobs(self, min_secs, as_of=None):
+
+      # Returns (machine, job record) tuples for the jobs that have been waiting (eg.
+      # Scheduled) in the same state for at least min_secs, longest-waiting first.
+
+      as_of = now() if as_of is None else as_of
+      with self.lock:
+         stuck = [(m, dict(rec)) for m, jobs in self.jobs.items() for rec in jobs.values()
+                  if rec["waiting"] and as_of - rec["state_since"] >= min_secs]
+      return sorted(stuck, key=lambda mj: (mj[1]["state_since"], mj[0], mj[1]["id"]))
+
+   def to_dict(self, machines=None):
+      with self.lock:
+         machines = sorted(set(self.jobs.keys()) | set(self.errors.keys())) if machines is None else machines
+         return {m: {"polled_at": self.polled_at.get(m),
+                     "error":     self.errors.get(m),
+                     "jobs":      [dict(self.jobs[m][j]) for j in sorted(self.jobs.get(m, {}).keys())]}
+                 for m in machines}
+
+   def load(self, pathname, machines=None):
+
+      # Loads what save() saved for the specified machines (all if None).  Errors are
+      # not carried over, as they say nothing about what the next poll will find.
+
+      state = load_json_state_file(pathname, default={})
+      with self.lock:
+         for machine, entry in state.items():
+            if machines is not None and machine not in machines:
+               continue
+            self.jobs[machine] = {rec["id"]: rec for rec in entry["jobs"]}
+            self.polled_at[machine] = entry["polled_at"]
+            for rec in entry["jobs"]:
+               self._index_job(machine, rec)
+
+   def save(self, pathname):
+
+      # Saves what we know of the machines we've polled, leaving whatever was saved
+      # for other machines as it was.
+
+      state = load_json_state_file(pathname, default={})
+      for machine, entry in self.to_dict().items():
+         if entry["polled_at"] is not None:
+            del entry["error"]
+            state[machine] = entry
+      save_json_state_file(pathname, state)
+
+class JobQueuePoller:
+
+   def __init__(self, args, machines, index=None, max_parallel=16):
+
+      self.args = args
+      self.machines = machines
+      self.index = index if index is not None else FleetJobIndex()
+      self.max_parallel = max_parallel
+
+      # Connections and Jobs collection ids, kept across polls, by machine.
+      self.connections = dict()
+      self.job_collection_ids = dict()
+
+      # Number of job resources read by the last poll, by machine.
+      self.job_reads = dict()
+
+   def get_connection(self, machine):
+
+      # Returns our connection to a machine's BMC, opening one if needed.
+
+      bmc_conn = self.connections.get(machine)
+      if bmc_conn is None:
+         bmc_conn = LabBMCConnection.create_connection(machine, self.args)
+         service_root_res = bmc_conn.get_service_root_resource()
+         job_service_res = bmc_conn.get_resource(service_root_res["JobService"]["@odata.id"])
+         self.job_collection_ids[machine] = job_service_res["Jobs"]["@odata.id"]
+         self.connections[machine] = bmc_conn
+      return bmc_conn
+
+   def poll_machine(self, machine):
+
+      # Polls one machine's job queue into the index, returning the job records.
+
+      bmc_conn = self.get_connection(machine)
+      polled_at = now()
+      known = self.index.get_machine_jobs(machine)
+
+      records = []
+      reads = 0
+      for job_res_id in bmc_conn.get_collection_member_ids(self.job_collection_ids[machine]):
+         job_id = remove_trailing(job_res_id, "/").rsplit("/", 1)[-1]
+         prev = known.get(job_id)
+         if prev is not None and prev["ended"]:
+            records.append(prev)
+            continue
+         records.append(job_queue_record(bmc_conn.get_resource(job_res_id, cacheable=False)))
+         reads += 1
+      #
+      self.index.update_machine(machine, records, polled_at)
+      self.job_reads[machine] = reads
+      dbg("[%s] Polled job queue: %d jobs, %d read." % (machine, len(records), reads), level=3)
+      return records
+
+   def poll(self):
+
+      # Polls all of the machines, returning a dict of the exceptions raised for the
+      # machines that couldn't be polled, indexed by machine.
+
+      self.job_reads = dict()
+      results, errors = for_each_machine(self.machines, self.poll_machine, max_parallel=self.max_parallel)
+      for m, exc in errors.items():
+         self.index.note_error(m, exc)
+         # Start afresh next time, in case the BMC restarted (losing our session).
+         bmc_conn = self.connections.pop(m, None)
+         if bmc_conn is not None:
+            bmc_conn.release()
+      return errors
@@ -3,15 +3,25 @@
 
 # Assumes: Python 3.6+
 
+import argparse
+import atexit
+import hashlib
 import json
 import os
+import socket
+import statistics
+import subprocess
 import sys
 import yaml
 
-from threading import Thread, Lock, Event
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from threading import Thread, Lock, Event, BoundedSemaphore, Condition
+from urllib.parse import urlsplit
 
 from misc_utils import *
 from bmc_common import *
+from profile_utils import *
 
 db_loading_lock = Lock()
 
@@ -35,9 +45,18 @@ class LabBMCConnection(object):
       parser.add_argument("--as-root",  "-R",  dest="as_root", action="store_true")
       parser.add_argument("--as-mgmt",  "-M",  dest="as_mgmt", action="store_true")
 
+      # Every tool that talks to BMCs can also export the metrics it gathers, and be
+      # profiled.
+      parser.add_argument("--metrics-file", dest="metrics_file")
+      parser.add_argument("--metrics-listen", dest="metrics_listen")
+      parser.add_argument("--profile", dest="profile_dir", metavar="DIR", action=_StartProfiling)
+
    @staticmethod
    def create_connection(machine_name, args, default_to_admin=False, default_to_default=False,
-                                             use_default_bmc_info=False):
+                                             use_default_bmc_info=False, deadline=None):
+
+      start_metrics_export(args)
+      start_profiling(args)
 
       username = args.login_username
       password = args.login_password
@@ -71,34 +90,61 @@ class LabBMCConnection(object):
       else:
          dbg("Creating connection to %s using default standard user." % machine_name, level=3)
 
-      return LabBMCConnection(machine_name, username=username, password=password,
-                              for_std_user=for_std_user, use_default_bmc_info=use_default_bmc_info)
+      # Connections are shared within the process (see BMCConnectionRegistry), so we
+      # need to know who we'd be logging in as to know if we already have one.
+
+      bmc_cfg = LabBMCConnection._get_bmc_cfg(machine_name, for_std_user=for_std_user,
+                                              use_default_bmc_info=use_default_bmc_info)
+      if username is None:
+         reg_username, reg_password = bmc_cfg["username"], bmc_cfg["password"]
+      else:
+         reg_username, reg_password = username, password
+
+      def open_connection():
+         return LabBMCConnection(machine_name, username=username, password=password,
+                                 for_std_user=for_std_user, use_default_bmc_info=use_default_bmc_info,
+                                 deadline=deadline, bmc_cfg=bmc_cfg)
+
+      # (A connection we already had gets the deadline too.)
+      conn = bmc_connections.acquire(machine_name, reg_username, reg_password, open_connection)
+      if deadline is not None:
+         conn.set_deadline(deadline)
+      return conn
 
    def __init__(self, machine_name, username=None, password=None,
-                for_std_user=None, use_default_bmc_info=False):
+                for_std_user=None, use_default_bmc_info=False, deadline=None, bmc_cfg=None):
+
+      # Bmc_cfg is the machine's BMC config (see _get_bmc_cfg), if already looked up.
 
       if (username is not None) != (password is not None):
          die("Both BMC login username and password are required if either is provided.")
 
       self.machine_info = None
-      bmc_cfg = self._get_bmc_cfg(machine_name, for_std_user=for_std_user,
-                                  use_default_bmc_info=use_default_bmc_info)
+      if bmc_cfg is None:
+         bmc_cfg = self._get_bmc_cfg(machine_name, for_std_user=for_std_user,
+                                     use_default_bmc_info=use_default_bmc_info)
+
+      # Set if the connection is shared via the registry (see BMCConnectionRegistry).
+      self.registry_entry = None
 
       self.host = bmc_cfg["address"]
       self.username = bmc_cfg["username"] if username is None else username
       self.password = bmc_cfg["password"] if password is None else password
       # Future: Maybe also accept username/password from env vars?
 
-      self.connection = DellBMCConnection(self.host, self.username, self.password)
+      self.connection = DellBMCConnection(self.host, self.username, self.password, deadline=deadline)
 
       # Because we're doing things by composition of rahter than subclassing from the
       # BMCConnection class, we have to explicitly "export" the methods of the
       # BMCConnection classs that we want to be part of our API.
 
       self.get_resource           = self.connection.get_resource
+      self.get_resource_properties         = self.connection.get_resource_properties
       self.get_collection         = self.connection.get_collection
       self.get_collection_members = self.connection.get_collection_members
       self.get_collection_member_ids       = self.connection.get_collection_member_ids
+      self.iter_collection_members         = self.connection.iter_collection_members
+      self.iter_collection_member_ids      = self.connection.iter_collection_member_ids
       self.get_collection_member_with_name = self.connection.get_collection_member_with_name
 
       self.get_service_root_resource   = self.connection.get_service_root_resource
@@ -107,11 +153,25 @@ class LabBMCConnection(object):
 
       self.update_resource       = self.connection.update_resource
       self.update_resource_by_id = self.connection.update_resource_by_id
+      self.delete_resource       = self.connection.delete_resource
 
       self.start_task     = self.connection.start_task
       self.get_task       = self.connection.get_task
       self.perform_action = self.connection.perform_action
       self.get_last_response_headers = self.connection.get_last_response_headers
+      self.get_connection_statistics = self.connection.get_connection_statistics
+      self.get_resource_etag         = self.connection.get_resource_etag
+      self.set_deadline              = self.connection.set_deadline
+      self.get_deadline              = self.connection.get_deadline
+      self.get_session_id            = self.connection.get_session_id
+      self.get_session_collection_path = self.connection.get_session_collection_path
+
+      self.probe_service_root    = self.connection.probe_service_root
+      self.probe_resource        = self.connection.probe_resource
+      self.probe_redfish_ready   = self.connection.probe_redfish_ready
+      self.probe_ready_for_tasks = self.connection.probe_ready_for_tasks
+      self.probe_task_ended      = self.connection.probe_task_ended
+      self.probe_lc_ready        = self.connection.probe_lc_ready
 
       self.get_power_state         = self.connection.get_power_state
       self.get_system_power_state  = self.connection.get_power_state
@@ -125,11 +185,40 @@ class LabBMCConnection(object):
       self.create_account       = self.connection.create_account
       self.delete_account       = self.connection.delete_account
       self.set_account_password = self.connection.set_account_password
+      self.get_account_slots    = self.connection.get_account_slots
+      self.fill_account_slot    = self.connection.fill_account_slot
+      self.clear_account_slot   = self.connection.clear_account_slot
+      self.update_account_slot  = self.connection.update_account_slot
 
    def __del__(self):
-      del self.connection
+      # (No connection if opening it failed.)
+      if hasattr(self, "connection"):
+         del self.connection
+
+   # Can be used as a context manager, eg. "with LabBMCConnection.create_connection(...)
+   # as bmc_conn:", which releases a shared connection or closes one that isn't shared.
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, exc_tb):
+      if self.registry_entry is not None:
+         self.release()
+      else:
+         self.close()
 
-   def _get_bmc_cfg(self, machine_name, for_std_user=None, use_default_bmc_info=False):
+   def release(self):
+
+      # Says the caller is done with a connection it got from create_connection(), so
+      # that it can be closed once it has been idle for a while.
+
+      bmc_connections.release(self)
+
+   def close(self):
+      self.connection.close()
+
+   @staticmethod
+   def _get_bmc_cfg(machine_name, for_std_user=None, use_default_bmc_info=False):
 
       m_entry = None
       bmc_cfg = {}
@@ -149,13 +238,295 @@ class LabBMCConnection(object):
       return bmc_cfg
 
 
+# --- Sharing BMC connections within a process ---
+
+_bmc_connection_acquires = metrics.counter("acm_lab_bmc_connection_acquires_total",
+   "Requests for shared BMC connections, by whether a connection was opened or reused.",
+   ["outcome"])
+
+class BMCConnectionRegistry:
+
+   # A process-wide registry of LabBMCConnections indexed by (machine, username), so that
+   # the parts of a tool (or the steps of a multi-step workflow) that want a connection
+   # to the same BMC as the same user share one, rather than each paying for Redfish
+   # discovery and a session login.  (A BMCConnection can be used by several threads at
+   # once.)
+   #
+   # Connections are reference counted.  acquire() hands one out, opening it if needed,
+   # and release() says a holder is done with it.  A connection nobody holds is kept for
+   # idle_timeout secs in case its wanted again, then closed.  A connection that hasn't
+   # been handed out for health_check_after secs is checked (a cheap authenticated HEAD)
+   # before being handed out again, and replaced if the check fails (eg. the BMC has
+   # restarted and our session is gone).  Whatever is still open is closed at exit.
+
+   def __init__(self, idle_timeout=300, health_check_after=60, sweep_interval=30):
+
+      self.idle_timeout = idle_timeout
+      self.health_check_after = health_check_after
+      self.sweep_interval = sweep_interval
+
+      # Entries indexed by (machine, username).  Each is a dict with the connection (None
+      # while its being opened), the password it was opened with, its reference count and
+      # when it was last handed out or released.
+      self.entries = dict()
+      self.lock = Lock()
+      self.sweeper = None
+
+      atexit.register(self.close_all)
+
+   @staticmethod
+   def _close(entry, why):
+      dbg("Closing shared BMC connection to %s as %s (%s)." % (entry["key"] + (why,)), level=3)
+      try:
+         entry["conn"].close()
+      except Exception as exc:
+         dbg("Ignoring exception closing BMC connection: %s" % exc, level=3)
+
+   def _start_sweeper(self):
+      if self.sweeper is None:
+         self.sweeper = Thread(target=self._sweep_periodically)
+         self.sweeper.daemon = True
+         self.sweeper.start()
+
+   def _sweep_periodically(self):
+      while True:
+         time.sleep(self.sweep_interval)
+         self.evict_idle()
+
+   def _forget(self, key):
+
+      # Removes an entry, returning it if it can be closed now (ie. nobody holds it).
+      # Otherwise its closed when its last holder releases it.
+
+      entry = self.entries.pop(key)
+      return entry if entry["ref_cnt"] == 0 and entry["conn"] is not None else None
+
+   def acquire(self, machine, username, password, opener):
+
+      # Returns a shared connection to the machine's BMC as the user, calling opener()
+      # to open one if we don't have one (or the one we have is no longer usable).
+
+      key = (machine, username)
+      while True:
+         to_close = None
+         with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["conn"] is not None and entry["password"] != password:
+               # The creds have changed (eg. rotated) since it was opened.
+               to_close = self._forget(key)
+               entry = None
+            if entry is None:
+               entry = {"key": key, "conn": None, "password": password, "ref_cnt": 1,
+                        "last_active": now(), "opened": Event()}
+               self.entries[key] = entry
+               opening = True
+            elif entry["conn"] is None:
+               opening = False
+            else:
+               entry["ref_cnt"] += 1
+               idle_secs = now() - entry["last_active"]
+               entry["last_active"] = now()
+               opening = None
+         if to_close is not None:
+            self._close(to_close, "credentials changed")
+
+         if opening is None:
+            # Reusing one we have, if its still healthy.
+            conn = entry["conn"]
+            if idle_secs < self.health_check_after or conn.probe_redfish_ready():
+               dbg("Reusing shared BMC connection to %s as %s." % key, level=3)
+               _bmc_connection_acquires.inc(outcome="reused")
+               return conn
+            dbg("Shared BMC connection to %s as %s failed its health check." % key, level=3)
+            _bmc_connection_acquires.inc(outcome="unhealthy")
+            self.release(conn)
+            with self.lock:
+               to_close = self._forget(key) if self.entries.get(key) is entry else None
+            if to_close is not None:
+               self._close(to_close, "unhealthy")
+            continue
+
+         if not opening:
+            # Someone else is opening it, so wait for them then try again.
+            entry["opened"].wait()
+            continue
+
+         try:
+            conn = opener()
+         except BaseException:
+            with self.lock:
+               if self.entries.get(key) is entry:
+                  del self.entries[key]
+            entry["opened"].set()
+            raise
+         conn.registry_entry = entry
+         with self.lock:
+            entry["conn"] = conn
+            self._start_sweeper()
+         entry["opened"].set()
+         _bmc_connection_acquires.inc(outcome="opened")
+         return conn
+
+   def release(self, conn):
+      entry = conn.registry_entry
+      if entry is None:
+         return
+      with self.lock:
+         entry["ref_cnt"] = max(entry["ref_cnt"] - 1, 0)
+         entry["last_active"] = now()
+         # Close it now if its been replaced and this was the last holder.
+         orphaned = entry["ref_cnt"] == 0 and self.entries.get(entry["key"]) is not entry
+      if orphaned:
+         self._close(entry, "replaced")
+
+   def evict_idle(self):
+      to_close = []
+      with self.lock:
+         cutoff = now() - self.idle_timeout
+         for key in [k for k, e in self.entries.items() if e["ref_cnt"] == 0 and e["last_active"] < cutoff]:
+            to_close.append(self._forget(key))
+      for entry in to_close:
+         self._close(entry, "idle")
+
+   def close_all(self):
+
+      # Closes all of the connections, whether held or not.  For use at exit.
+
+      with self.lock:
+         entries = [e for e in self.entries.values() if e["conn"] is not None]
+         self.entries = dict()
+      for entry in entries:
+         self._close(entry, "closing all")
+
+# The process-wide registry used by LabBMCConnection.create_connection().
+bmc_connections = BMCConnectionRegistry()
+
+
+# --- Keeping track of the BMC sessions we have open ---
+
+def _process_is_running(pid):
+   try:
+      os.kill(pid, 0)
+   except ProcessLookupError:
+      return False
+   except PermissionError:
+      pass
+   return True
+
+def normalize_bmc_session_id(session_id):
+   # Session ids come from Location headers, which might be full URLs.
+   return remove_trailing(urlsplit(session_id).path, "/")
+
+class BMCSessionLedger:
+
+   # Keeps a record of the BMC sessions this process has open, so that reap-bmc-sessions
+   # can tell sessions left behind by a process that is gone (eg. was killed) from those
+   # of processes still running.  Each process appends open and close records to its own
+   # file in the sessions subdir of the lab state dir.  At exit, once our sessions have
+   # been closed, the file is removed (unless some of them couldn't be).
+
+   def __init__(self):
+      self.lock = Lock()
+      self.pathname = None
+      self.open_sessions = set()
+      atexit.register(self.close)
+
+   def _append(self, rec):
+      with self.lock:
+         try:
+            if self.pathname is None:
+               self.pathname = os.path.join(get_lab_state_dir("sessions"),
+                                            "%s-%d.jsonl" % (socket.gethostname(), os.getpid()))
+            with open(self.pathname, "a") as f:
+               f.write(json.dumps(rec) + "\n")
+         except OSError as exc:
+            dbg("Could not record BMC session in ledger: %s" % exc, level=3)
+
+   def session_opened(self, bmc, username, session_id):
+      session_id = normalize_bmc_session_id(session_id)
+      with self.lock:
+         self.open_sessions.add((bmc, session_id))
+      self._append({"op": "open", "bmc": bmc, "user": username, "session": session_id, "at": now()})
+
+   def session_closed(self, bmc, username, session_id):
+      session_id = normalize_bmc_session_id(session_id)
+      with self.lock:
+         self.open_sessions.discard((bmc, session_id))
+      self._append({"op": "close", "bmc": bmc, "user": username, "session": session_id, "at": now()})
+
+   def close(self):
+      close_all_bmc_sessions()
+      with self.lock:
+         if self.pathname is not None and not self.open_sessions:
+            try:
+               os.remove(self.pathname)
+            except FileNotFoundError:
+               pass
+            self.pathname = None
+
+   @staticmethod
+   def load_all():
+
+      # Returns a list of the ledgers of all processes (including this one), each a dict
+      # with the pathname, host and pid of the process, whether the process is running
+      # (None if unknown, as its on another host) and the sessions it has open, a dict of
+      # the open records indexed by (bmc, session id).
+
+      my_host = socket.gethostname()
+      sessions_dir = get_lab_state_dir("sessions")
+
+      ledgers = []
+      for fn in sorted(os.listdir(sessions_dir)):
+         if not fn.endswith(".jsonl"):
+            continue
+         # (Named <host>-<pid>.jsonl, and host names can have dashes in them.)
+         host, _, pid = fn[:-len(".jsonl")].rpartition("-")
+         try:
+            pid = int(pid)
+         except ValueError:
+            continue
+         pathname = os.path.join(sessions_dir, fn)
+         open_sessions = dict()
+         try:
+            with open(pathname, "r") as f:
+               for line in f:
+                  try:
+                     rec = json.loads(line)
+                  except ValueError:
+                     # (A partial last line, from a process killed mid-write.)
+                     continue
+                  key = (rec["bmc"], rec["session"])
+                  if rec["op"] == "open":
+                     open_sessions[key] = rec
+                  else:
+                     open_sessions.pop(key, None)
+         except FileNotFoundError:
+            continue
+         ledgers.append({
+            "pathname":      pathname,
+            "host":          host,
+            "pid":           pid,
+            "is_running":    _process_is_running(pid) if host == my_host else None,
+            "open_sessions": open_sessions
+         })
+      return ledgers
+
+# The ledger of this process.
+bmc_session_ledger = BMCSessionLedger()
+BMCConnection.session_ledger = bmc_session_ledger
+
+
 # --- Getting info from our lab machine-info database (yaml file) ---
 
 machine_info = None
 
+# The standard user whose creds were merged into machine_info when it was loaded.
+machine_info_std_user = None
+
 def _load_machine_info_db_inner(for_std_user=None):
 
    global machine_info
+   global machine_info_std_user
 
    if machine_info is not None:
       return
@@ -167,15 +538,12 @@ def _load_machine_info_db_inner(for_std_user=None):
       machine_db_yaml = os.getenv("FOG_MACHINE_INFO")
    if machine_db_yaml is None:
       die("Environment variable ACM_LAB_MACHINE_INFO is not set.")
-   machine_creds_yaml = os.getenv("ACM_LAB_MACHINE_CREDS")
-   if machine_creds_yaml is None:
-      machine_creds_yaml = os.getenv("FOG_MACHINE_CREDS")
-   if machine_creds_yaml is None:
-      die("Environment variable ACM_LAB_MACHINE_CREDS is not set.")
+   machine_creds_yaml = get_machine_creds_pathname()
 
    for_std_user = for_std_user if for_std_user is not None else "bmc"
    if for_std_user not in ["bmc", "default", "root", "admin", "mgmt"]:
       die("Requested standard user \"%s\"%s is not recognized." % for_std_user)
+   machine_info_std_user = for_std_user
 
    # Load DB and convert it into a dict indexed by machine name.
 
@@ -221,14 +589,29 @@ def _load_machine_info_db_inner(for_std_user=None):
    except KeyError:
       die("Machine info db not as expected (bmc data missing/wrong).")
 
+def get_machine_creds_pathname():
+   machine_creds_yaml = os.getenv("ACM_LAB_MACHINE_CREDS")
+   if machine_creds_yaml is None:
+      machine_creds_yaml = os.getenv("FOG_MACHINE_CREDS")
+   if machine_creds_yaml is None:
+      die("Environment variable ACM_LAB_MACHINE_CREDS is not set.")
+   return machine_creds_yaml
+
 def _load_machine_info_db(for_std_user=None):
 
    # Wrap db-loading with a lock to make this thread safe.
+   #
+   # If the db was already loaded for some other standard user (eg. because we looked up
+   # machine names or switches before opening any connections), reload it with the creds
+   # of the user now asked for.
 
    global machine_info
    with db_loading_lock:
       if machine_info is not None:
-         return
+         if for_std_user is None or for_std_user == machine_info_std_user:
+            return
+         dbg("Reloading machine info db for standard user \"%s\"." % for_std_user, level=3)
+         machine_info = None
       _load_machine_info_db_inner(for_std_user)
 
 def get_machine_entry(machine_name, for_std_user=None, use_default_bmc_info=False):
@@ -246,9 +629,11 @@ def get_machine_entry(machine_name, for_std_user=None, use_default_bmc_info=Fals
       return machine_info[machine_name]
    except KeyError:
       if use_default_bmc_info:
-         info = machine_info["default"]
          # The address and redfish entries are expected to contain a single %s
-         # substitution placeholder that we replace with the machine name.
+         # substitution placeholder that we replace with the machine name, in a copy
+         # as the default entry is shared by all machines not recorded.
+         info = dict(machine_info["default"])
+         info["bmc"] = dict(info["bmc"])
          info["bmc"]["address"] = info["bmc"]["address"] % machine_name
          info["bmc"]["redfish"] = info["bmc"]["redfish"] % machine_name
          return info
@@ -257,9 +642,671 @@ def get_machine_entry(machine_name, for_std_user=None, use_default_bmc_info=Fals
    #
 #
 
+def get_all_machine_names(for_std_user=None):
+
+   # Returns the names of all of the machines recorded in the machine info db,
+   # omitting the "default" pseudo-entry used for unrecorded machines.
+
+   _load_machine_info_db(for_std_user=for_std_user)
+   return sorted(m for m in machine_info.keys() if m != "default")
+
+
+# --- Local state kept by the lab tools (caches, run journals, etc.) ---
+
+def get_lab_state_dir(sub_dir=None):
+
+   # Returns (creating it if needed) the directory in which tools keep state that
+   # persists across runs.  Defaults to ~/.cache/acm-lab but can be overridden via
+   # the ACM_LAB_STATE_DIR environment variable.
+
+   state_dir = os.getenv("ACM_LAB_STATE_DIR")
+   if state_dir is None:
+      state_dir = os.path.join(os.path.expanduser("~"), ".cache", "acm-lab")
+   if sub_dir is not None:
+      state_dir = os.path.join(state_dir, sub_dir)
+   os.makedirs(state_dir, exist_ok=True)
+   return state_dir
+
+def load_json_state_file(pathname, default=None):
+   try:
+      with open(pathname, "r") as f:
+         return json.load(f)
+   except FileNotFoundError:
+      return default
+   except ValueError:
+      wmsg("Ignoring unreadable state file: %s" % pathname)
+      return default
+
+def save_json_state_file(pathname, state):
+
+   # Write to a temp file and rename it into place so that a reader (or a later
+   # run after a crash) never sees a partially written file.
+
+   tmp_pathname = "%s.tmp.%d" % (pathname, os.getpid())
+   with open(tmp_pathname, "w") as f:
+      json.dump(state, f, indent=1, sort_keys=True)
+   os.replace(tmp_pathname, pathname)
+
+
+# --- Exporting metrics (see metrics_utils) ---
+
+_metrics_export_lock = Lock()
+_metrics_export_started = False
+
+def start_metrics_export(args=None):
+
+   # Starts exporting metrics as per the --metrics-file and --metrics-listen options
+   # (or the ACM_LAB_METRICS_FILE and ACM_LAB_METRICS_LISTEN environment variables), if
+   # either is specified.  Only does anything the first time its called.
+
+   global _metrics_export_started
+   with _metrics_export_lock:
+      if _metrics_export_started:
+         return
+      _metrics_export_started = True
+
+   metrics_file = getattr(args, "metrics_file", None) or os.getenv("ACM_LAB_METRICS_FILE")
+   metrics_listen = getattr(args, "metrics_listen", None) or os.getenv("ACM_LAB_METRICS_LISTEN")
+
+   if metrics_file is not None:
+      start_metrics_file_dumps(metrics_file)
+   if metrics_listen is not None:
+      host, port = split_at(metrics_listen, ":", favor_right=True)
+      try:
+         start_metrics_server(host if host else "0.0.0.0", int(port))
+      except (ValueError, OSError) as exc:
+         wmsg("Could not serve metrics on %s: %s" % (metrics_listen, exc))
+
+# --- Profiling (see profile_utils) ---
+
+_profiling_lock = Lock()
+_profiling_started = False
+
+def start_profiling(args=None):
+
+   # Starts profiling into the directory specified by the --profile option (or the
+   # ACM_LAB_PROFILE_DIR environment variable), if either is specified.  Only does
+   # anything the first time its called.  TaskRunner workers (see _TR_Worker) each
+   # profile into a subdirectory of their own.
+
+   global _profiling_started
+   with _profiling_lock:
+      if _profiling_started:
+         return
+      _profiling_started = True
+
+   profile_dir = getattr(args, "profile_dir", None) or os.getenv("ACM_LAB_PROFILE_DIR")
+   if profile_dir is None:
+      return
+   if getattr(args, "dist_worker_of", None) is not None:
+      profile_dir = os.path.join(profile_dir, "worker-%d" % os.getpid())
+   profiler.start(profile_dir)
+
+class _StartProfiling(argparse.Action):
+
+   # Starts profiling as soon as --profile is parsed, so that all of the tool's run is
+   # covered rather than just what comes after it first connects to a BMC.
+
+   def __call__(self, parser, namespace, values, option_string=None):
+      setattr(namespace, self.dest, values)
+      profiler.start(values)
+
+# Metrics on task health, by task type.
+
+_task_phase_secs = metrics.histogram("acm_lab_task_phase_duration_seconds",
+   "Time taken by a TaskRunner phase for a machine, by task type.",
+   ["task", "phase"], buckets=task_duration_buckets)
+_task_bmc_wait_secs = metrics.histogram("acm_lab_task_bmc_wait_seconds",
+   "Time spent waiting for BMCs to catch up after TaskRunner phases, by task type.",
+   ["task", "after_phase"], buckets=task_duration_buckets)
+_task_job_secs = metrics.histogram("acm_lab_task_job_duration_seconds",
+   "Time from submitting a BMC job to seeing it end, by task type and ending status.",
+   ["task", "status"], buckets=task_duration_buckets)
+_task_results = metrics.counter("acm_lab_task_results_total",
+   "Machines TaskRunner is done with, by task type, final phase and job status.",
+   ["task", "phase", "status"])
+_task_outliers = metrics.counter("acm_lab_task_outliers_total",
+   "BMC jobs that took abnormally long compared to the history of such jobs, by task type.",
+   ["task"])
+
+
+# --- Learning how long BMC tasks take ---
+
+def describe_secs(secs):
+   secs = int(round(secs))
+   if secs < 120:
+      return "%ds" % secs
+   elif secs < 7200:
+      return "%dm" % (secs // 60)
+   else:
+      return "%dh%02dm" % (secs // 3600, (secs % 3600) // 60)
+
+class TaskDurationHistory:
+
+   # How long BMC tasks have taken, from their machine being set going on them (ie. the
+   # post-submit phase, eg. powering it on, being done with) to being seen to have ended
+   # OK, by task type, system model and BMC firmware version.  Kept in the lab state dir
+   # so that TaskRunner can check on tasks around when they're expected to end rather
+   # than every so often, show ETAs, and flag tasks taking abnormally long.  Only the
+   # most recent max_samples durations of each kind are kept.
+
+   max_samples = 50
+
+   # Fewer samples than this of a kind aren't enough to go on.
+   min_samples = 3
+
+   @staticmethod
+   def default_pathname():
+      return os.path.join(get_lab_state_dir(), "task-durations.json")
+
+   def __init__(self, pathname=None):
+      self.pathname = pathname if pathname is not None else self.default_pathname()
+      self.lock = Lock()
+
+      # Durations (secs) indexed by task type, model and then firmware version.
+      self.history = load_json_state_file(self.pathname, default={})
+
+   def _samples(self, task, model=None, firmware=None):
+
+      # Returns the durations of the task type, narrowed to the model and firmware version
+      # if specified.
+
+      samples = []
+      for m, by_firmware in self.history.get(task, {}).items():
+         if model is None or m == model:
+            for fw, durations in by_firmware.items():
+               if firmware is None or fw == firmware:
+                  samples.extend(durations)
+      return samples
+
+   def estimate(self, task, model, firmware):
+
+      # Returns a dict with how long the task is expected to take (the median of the
+      # durations of the most specific kind we have enough of), after how long it should
+      # be considered an outlier, and how many durations of what kind that's based on.
+      # Returns None if we don't have enough history.
+
+      model = model if model is not None else "unknown"
+      firmware = firmware if firmware is not None else "unknown"
+
+      with self.lock:
+         candidates = [
+            ("%s with firmware %s" % (model, firmware), self._samples(task, model, firmware)),
+            (model, self._samples(task, model)),
+            ("all models", self._samples(task))
+         ]
+      for basis, samples in candidates:
+         if len(samples) >= self.min_samples:
+            break
+      else:
+         return None
+
+      # Outliers are judged by the median absolute deviation, which isn't thrown off by
+      # the odd outlier already in the history, but with some slack for when the
+      # durations are all much the same.
+
+      expected = statistics.median(samples)
+      mad = statistics.median([abs(d - expected) for d in samples])
+      outlier_after = expected + max(4 * 1.4826 * mad, 0.5 * expected)
+
+      return {"expected": expected, "outlier_after": outlier_after, "samples": len(samples), "basis": basis}
+
+   def record(self, task, model, firmware, secs):
+
+      # Adds a duration to the history, saving it right away (merged with whatever other
+      # runs have saved in the meantime).
+
+      model = model if model is not None else "unknown"
+      firmware = firmware if firmware is not None else "unknown"
+
+      with self.lock:
+         history = load_json_state_file(self.pathname, default={})
+         durations = history.setdefault(task, {}).setdefault(model, {}).setdefault(firmware, [])
+         durations.append(round(secs, 1))
+         del durations[:-self.max_samples]
+         save_json_state_file(self.pathname, history)
+         self.history = history
+
 
 # -- Iterating across a bunch of machines to do the same thing asynchronously ---
 
+class _ForEachMachine(Thread):
+
+   def __init__(self, machine, func, limiter, on_done=None):
+      Thread.__init__(self)
+      self.machine = machine
+      self.func    = func
+      self.limiter = limiter
+      self.on_done = on_done
+
+      self.result = None
+      self.error  = None
+
+   def run(self):
+      with profiler.in_phase(getattr(self.func, "__name__", "per-machine")), self.limiter:
+         try:
+            self.result = self.func(self.machine)
+         except SystemExit:
+            # Something called die(), which already said why.
+            self.error = BMCError("Processing aborted.")
+         except Exception as exc:
+            self.error = exc
+      if self.on_done is not None:
+         self.on_done(self.machine, self.result, self.error)
+
+def for_each_machine(machines, func, max_parallel=None, on_done=None):
+
+   # Calls func(machine) for each of the machines on parallel threads, with at most
+   # max_parallel of them running at once (no limit if None).  Returns a tuple of two
+   # dicts indexed by machine name: the func return values for the machines for which
+   # it completed, and the exceptions raised for the machines for which it didn't.
+   #
+   # If on_done is specified, on_done(machine, result, exception) is also called (on
+   # the machine's thread) as soon as each machine is done with, eg. to report on it.
+
+   limit = len(machines) if max_parallel is None else max_parallel
+   limiter = BoundedSemaphore(max(limit, 1))
+
+   # (Daemon threads, so that exiting (eg. on SIGTERM) doesn't wait for them.)
+   threads = [_ForEachMachine(m, func, limiter, on_done) for m in machines]
+   for t in threads:
+      t.daemon = True
+      t.start()
+   for t in threads:
+      t.join()
+
+   results = {t.machine: t.result for t in threads if t.error is None}
+   errors  = {t.machine: t.error for t in threads if t.error is not None}
+   return (results, errors)
+
+
+# --- Reporting per-machine results in machine-readable form ---
+
+class MachineResultReporter:
+
+   # Reports a result record (a dict) for each machine a tool deals with, for tools'
+   # --output json and jsonl formats.  With jsonl, each record is written out as soon
+   # as its reported so that a pipeline can act on the machines that finish first.
+   # With json, the records are written out as one list at the end.  With table (the
+   # default) the tool's usual human-readable output is all there is.
+   #
+   # In the machine-readable formats stdout carries only the records, so anything
+   # blurted is sent to stderr instead.
+
+   output_formats = ["table", "json", "jsonl"]
+
+   @staticmethod
+   def add_argument_definitions(parser):
+      parser.add_argument("--output", dest="output_format", choices=MachineResultReporter.output_formats,
+                          default="table")
+
+   @staticmethod
+   def create_reporter(args):
+      return MachineResultReporter(getattr(args, "output_format", "table"))
+
+   def __init__(self, output_format="table"):
+
+      self.output_format = output_format
+      self.lock = Lock()
+      self.records = dict()
+
+      if self.is_structured():
+         set_blurt_to_stderr()
+
+   def is_structured(self):
+      return self.output_format != "table"
+
+   def was_reported(self, machine):
+      with self.lock:
+         return machine in self.records
+
+   def report(self, machine, ok=True, error=None, **fields):
+
+      record = {"machine": machine, "ok": ok, "reported_at": now()}
+      if error is not None:
+         record["error"] = str(error)
+      record.update(fields)
+
+      with self.lock:
+         self.records[machine] = record
+         if self.output_format == "jsonl":
+            sys.stdout.write(json.dumps(record, sort_keys=True) + "\n")
+            sys.stdout.flush()
+
+   def finish(self):
+      if self.output_format == "json":
+         with self.lock:
+            sys.stdout.write(json_dumps([self.records[m] for m in sorted(self.records.keys())]) + "\n")
+            sys.stdout.flush()
+
+
+# --- Staggered power-on of machines ---
+
+def get_machine_power_group(machine_name):
+
+   # Returns the name of the group a machine is in for power-on budgeting purposes.
+   # Machines plugged to the same (top-of-rack) switch share PDUs and the same path to
+   # the PXE/DHCP servers, so we group by the switch the machine's lowest-numbered NIC
+   # is plugged to.  Machines without that recorded all end up in the one "(unknown)"
+   # group, and so share a budget (as for all we know, they share a switch).
+
+   _load_machine_info_db()
+   machine_name,junk = split_at(machine_name, ".", favor_right=False)
+
+   entry = machine_info.get(machine_name)
+   nics = entry.get("nics") if entry is not None else None
+   if nics:
+      for nic_name in sorted(nics.keys()):
+         switch = nics[nic_name].get("plugged_to_switch")
+         if switch:
+            return str(switch)
+   return "(unknown)"
+
+class PowerOnScheduler:
+
+   # Admits machines to be powered on in waves, with at most budget machines of any one
+   # power group (switch) holding a place at a time and admissions within a group spaced
+   # at least stagger_secs apart.  A machine holds its place until it is released, which
+   # TaskRunner does as soon as the machine's task reaches Running (by then its past
+   # POST and PXE) or ends, so the next machine starts as soon as there is room for it.
+   # As a backstop, places held longer than max_hold_secs are given up.
+
+   @staticmethod
+   def add_argument_definitions(parser):
+      parser.add_argument("--power-on-budget", dest="power_on_budget", type=int)
+      parser.add_argument("--power-on-stagger", dest="power_on_stagger", type=int, default=0)
+
+   @staticmethod
+   def create_scheduler(machines, args, clock=system_clock, groups=None):
+
+      # Returns a scheduler for the machines as per the command line options, or None if
+      # no budget was requested (ie. power everything on at once, as we always have).
+
+      budget = getattr(args, "power_on_budget", None)
+      if budget is None:
+         return None
+      return PowerOnScheduler(machines, budget, stagger_secs=getattr(args, "power_on_stagger", 0),
+                              clock=clock, groups=groups)
+
+   def __init__(self, machines, budget, stagger_secs=0, max_hold_secs=1800, clock=system_clock, groups=None):
+
+      # Groups gives the power group of each machine, if not as per the machine-info db.
+
+      self.budget        = max(budget, 1)
+      self.stagger_secs  = stagger_secs
+      self.max_hold_secs = max_hold_secs
+      self.clock         = clock
+
+      if groups is None:
+         groups = {m: get_machine_power_group(m) for m in machines}
+      self.groups = groups
+
+      # Machines holding a place, and when they got it, by group.
+      self.holders = {g: dict() for g in set(self.groups.values())}
+      self.last_admit_time = dict()
+
+      self.cond = Condition()
+
+      group_names = sorted(self.holders.keys())
+      dbg("Power-on budget: %d machines per switch across %d switches (%s)." %
+          (self.budget, len(group_names), ", ".join(group_names)), level=2)
+
+   def get_group(self, machine):
+      return self.groups[machine]
+
+   def _expire_holders(self, group):
+      holders = self.holders[group]
+      for m in list(holders.keys()):
+         if self.clock.now() - holders[m] > self.max_hold_secs:
+            wmsg("Giving up power-on place held for over %d secs." % self.max_hold_secs, prefix=m)
+            del holders[m]
+
+   def _secs_until_admissible(self, machine):
+
+      # Returns 0 if the machine can be admitted now, else how long until it might be.
+
+      group = self.groups[machine]
+      self._expire_holders(group)
+      if machine in self.holders[group]:
+         return 0
+      if len(self.holders[group]) >= self.budget:
+         return 5
+      last_admit_time = self.last_admit_time.get(group)
+      if last_admit_time is not None:
+         return max(last_admit_time + self.stagger_secs - self.clock.now(), 0)
+      return 0
+
+   def _admit(self, machine):
+      group = self.groups[machine]
+      self.holders[group][machine] = self.clock.now()
+      self.last_admit_time[group] = self.clock.now()
+      dbg("[%s] Admitted for power-on (%d of %d places on switch %s in use)." %
+          (machine, len(self.holders[group]), self.budget, group), level=2)
+
+   def try_admit(self, machine):
+      with self.cond:
+         if self._secs_until_admissible(machine) > 0:
+            return False
+         self._admit(machine)
+         return True
+
+   def admit(self, machine, cancel_event=None):
+
+      # Waits until the machine can be powered on.  Returns False if cancelled.
+
+      with self.cond:
+         announced = False
+         while True:
+            wait_secs = self._secs_until_admissible(machine)
+            if wait_secs <= 0:
+               break
+            if not announced:
+               blurt("Waiting for a power-on place on switch %s." % self.groups[machine], prefix=machine)
+               announced = True
+            self.clock.wait_condition(self.cond, wait_secs)
+            if cancel_event is not None and cancel_event.is_set():
+               return False
+         self._admit(machine)
+         return True
+
+   def release(self, machine):
+
+      # Gives up the machine's place, if it has one.  Safe to call more than once.
+
+      with self.cond:
+         group = self.groups.get(machine)
+         if group is not None and self.holders[group].pop(machine, None) is not None:
+            dbg("[%s] Released power-on place on switch %s." % (machine, group), level=2)
+            self.clock.notify_all(self.cond)
+
+_bmc_in_flight_limit = metrics.gauge("acm_lab_bmc_in_flight_limit",
+   "Current limit on BMC requests in flight at once, as adjusted by the adaptive concurrency limiter.")
+_bmc_in_flight = metrics.gauge("acm_lab_bmc_requests_in_flight",
+   "BMC requests currently in flight (under the adaptive concurrency limiter).")
+_bmc_in_flight_limit_changes = metrics.counter("acm_lab_bmc_in_flight_limit_changes_total",
+   "Adjustments of the limit on BMC requests in flight, by direction and reason.",
+   ["direction", "reason"])
+
+class AdaptiveConcurrencyLimiter:
+
+   # Limits how many BMC requests are in flight at once across all of the connections of
+   # the process (while installed as BMCConnection.request_concurrency_limiter, see
+   # TaskRunner.run), adjusting the limit AIMD-style as it sees how the BMCs and the jump
+   # host's network are coping.  Requests are looked at in windows of (at least) a
+   # limit's worth of completed requests:
+   #
+   # - A window with more than max_not_ready_rate of iDRAC's not-ready errors (SWC0700,
+   #   SYS518), or whose 90th percentile latency is more than latency_tolerance times
+   #   the usual, cuts the limit by backoff_factor.  So do requests that get no answer
+   #   (timing out, or not getting through to the BMC at all), right away, once those of
+   #   min_failing_bmcs different BMCs have in a window.  (A BMC or two failing is more
+   #   likely down to the BMCs than to congestion, and one wedged BMC shouldn't drag
+   #   everything else down with it.)  The usual latency is the lowest 90th percentile
+   #   seen, except that once the limit can't go any lower, what it is then is the usual
+   #   (so a lucky early window isn't held against us forever).
+   #
+   # - A window without any such trouble, in which the limit was reached, raises the
+   #   limit by one.  Until the first cut, it doubles instead (slow start), so that the
+   #   limit gets to about the right point quickly.
+   #
+   # Requests started before a cut don't count towards the window after it, since they
+   # say nothing about how the lower limit is doing.
+
+   initial_limit       = 16
+   min_limit           = 2
+   default_max_limit   = 256
+   min_window          = 20
+   backoff_factor      = 0.7
+   max_not_ready_rate  = 0.02
+   latency_tolerance   = 3.0
+   min_failing_bmcs    = 3
+
+   # 90th percentile latencies (secs) below this are never considered too slow.
+   min_latency_concern = 1.0
+
+   @staticmethod
+   def add_argument_definitions(parser):
+      parser.add_argument("--max-in-flight", dest="max_in_flight", type=int)
+      parser.add_argument("--no-adaptive-concurrency", dest="adaptive_concurrency", action="store_false")
+
+   @staticmethod
+   def create_limiter(args, clock=system_clock):
+
+      # Returns a limiter as per the command line options, or None if it was turned off.
+      # With it turned off, --max-in-flight is a fixed limit, if specified.
+
+      max_limit = getattr(args, "max_in_flight", None)
+      if not getattr(args, "adaptive_concurrency", True):
+         if max_limit is None:
+            return None
+         return AdaptiveConcurrencyLimiter(max_limit, initial_limit=max_limit, adaptive=False, clock=clock)
+      return AdaptiveConcurrencyLimiter(max_limit if max_limit is not None else
+                                        AdaptiveConcurrencyLimiter.default_max_limit, clock=clock)
+
+   def __init__(self, max_limit, initial_limit=None, adaptive=True, clock=system_clock):
+
+      self.max_limit = max(max_limit, self.min_limit)
+      self.adaptive  = adaptive
+      self.clock     = clock
+
+      initial_limit = initial_limit if initial_limit is not None else self.initial_limit
+      self.limit = min(max(initial_limit, self.min_limit), self.max_limit)
+      self.slow_start = True
+      self.low_limit  = self.limit
+      self.high_limit = self.limit
+
+      self.in_flight = 0
+      self.cond = Condition()
+
+      # Bumped on every cut, so that requests started before it can be told apart.
+      self.generation = 0
+
+      # Usual 90th percentile latency.
+      self.usual_latency = None
+
+      self._start_window()
+      _bmc_in_flight_limit.set(self.limit)
+
+   def _start_window(self):
+      self.window_latencies = []
+      self.window_not_ready = 0
+      self.window_failing_bmcs = set()
+      self.window_peak = self.in_flight
+
+   def acquire(self, timeout=None):
+
+      # Waits for room for another request in flight.  Returns a token to pass to
+      # release(), or None if there wasn't room within timeout secs.
+
+      with self.cond:
+         deadline = None if timeout is None else self.clock.now() + timeout
+         while self.in_flight >= self.limit:
+            remaining = None if deadline is None else deadline - self.clock.now()
+            if remaining is not None and remaining <= 0:
+               return None
+            self.clock.wait_condition(self.cond, remaining)
+         self.in_flight += 1
+         self.window_peak = max(self.window_peak, self.in_flight)
+         _bmc_in_flight.set(self.in_flight)
+         return (self.generation, self.clock.now())
+
+   def release(self, token, failure=None, bmc=None):
+
+      # Notes that a request (to the BMC labelled bmc) is done.  Failure is why it got
+      # no answer, if it didn't (eg. "timeout" or "connection-error").
+
+      with self.cond:
+         self.in_flight -= 1
+         _bmc_in_flight.set(self.in_flight)
+         self.clock.notify_all(self.cond)
+         generation, started_at = token
+         if not self.adaptive or generation != self.generation:
+            return
+         if failure is not None:
+            self.window_failing_bmcs.add(bmc)
+            if len(self.window_failing_bmcs) >= self.min_failing_bmcs:
+               self._cut(failure)
+            return
+         self.window_latencies.append(self.clock.now() - started_at)
+         if len(self.window_latencies) >= max(self.min_window, self.limit):
+            self._end_window()
+
+   def not_ready(self, reason):
+
+      # Notes a not-ready error from a BMC (reason is its message id).
+
+      with self.cond:
+         self.window_not_ready += 1
+
+   def _end_window(self):
+
+      latencies = sorted(self.window_latencies)
+      p90 = latencies[int(0.9 * (len(latencies) - 1))]
+      not_ready_rate = self.window_not_ready / len(latencies)
+      usual = self.usual_latency
+
+      too_slow = usual is not None and p90 > max(self.latency_tolerance * usual, self.min_latency_concern)
+      if usual is None or self.limit <= self.min_limit:
+         self.usual_latency = p90
+      else:
+         self.usual_latency = min(p90, usual)
+
+      if not_ready_rate > self.max_not_ready_rate:
+         self._cut("not-ready")
+      elif too_slow:
+         self._cut("latency")
+      elif self.window_peak >= self.limit:
+         self._raise()
+      else:
+         self._start_window()
+
+   def _cut(self, reason):
+      new_limit = max(int(self.limit * self.backoff_factor), self.min_limit)
+      self.slow_start = False
+      self.generation += 1
+      self._adjust(new_limit, "down", reason)
+
+   def _raise(self):
+      new_limit = min(self.limit * 2 if self.slow_start else self.limit + 1, self.max_limit)
+      self._adjust(new_limit, "up", "slow-start" if self.slow_start else "ok")
+
+   def _adjust(self, new_limit, direction, reason):
+      if new_limit != self.limit:
+         dbg("Limit on BMC requests in flight %s from %d to %d (%s)." %
+             ("raised" if direction == "up" else "cut", self.limit, new_limit, reason), level=2)
+         _bmc_in_flight_limit_changes.inc(direction=direction, reason=reason)
+         self.limit = new_limit
+         self.low_limit  = min(self.low_limit, new_limit)
+         self.high_limit = max(self.high_limit, new_limit)
+         _bmc_in_flight_limit.set(new_limit)
+         self.cond.notify_all()
+      self._start_window()
+
+   def describe(self):
+      with self.cond:
+         return "%d (ranged %d to %d)" % (self.limit, self.low_limit, self.high_limit)
+
+
 def cast_to_dmtf_task(task_res):
    cast_task_res = task_res.copy()
    adjust_task_resource(cast_task_res)
@@ -338,29 +1385,232 @@ def adjust_task_resource(task_res):
 # - Thread = A Python Threading object that executes a task method/methods (for a
 #            particular machine) in parallel with other machines.
 
+# Persistent record of how far a TaskRunner run has gotten for each machine, so that
+# a run that is interrupted (eg. the orchestrating process is killed while waiting for
+# tasks to complete) can be resumed without redoing the work already done.  The journal
+# is rewritten each time a machine moves to a new phase.  A journal without a pathname
+# (eg. for tools that can't resume runs) is just kept in memory.
+
+class RunJournal:
+
+   phase_validated      = "validated"
+   phase_not_needed     = "not-needed"
+   phase_prepared       = "prepared"
+   phase_pre_submitted  = "pre-submitted"
+   phase_submitted      = "submitted"
+   phase_post_submitted = "post-submitted"
+   phase_ended          = "ended"
+   phase_completed      = "completed"
+   phase_failed         = "failed"
+
+   # Failed in the post-completion phase, ie. after the task was done with.  Resuming
+   # does just the post-completion phase again rather than the whole task.
+   phase_post_completion_failed = "post-completion-failed"
+
+   # Phases after which there is nothing left to do for a machine, and after which
+   # there's nothing more to be done in this run.
+   final_phases = [phase_not_needed, phase_completed]
+   failed_phases = [phase_failed, phase_post_completion_failed]
+
+   # Phases at which a BMC task has been submitted and we know its id, so resuming
+   # means reattaching to that task rather than starting over, and of those, the ones
+   # past the post-submit phase.
+   task_submitted_phases = [phase_submitted, phase_post_submitted, phase_ended, phase_post_completion_failed]
+   post_submitted_phases = [phase_post_submitted, phase_ended, phase_post_completion_failed]
+
+   @staticmethod
+   def default_pathname(tool_name, machines):
+      machines_hash = hashlib.sha256(" ".join(sorted(machines)).encode("utf-8")).hexdigest()[:12]
+      return os.path.join(get_lab_state_dir("runs"), "%s-%s.json" % (tool_name, machines_hash))
+
+   def __init__(self, pathname, task_name, resume=False):
+
+      self.pathname = pathname
+      self.lock = Lock()
+
+      journal = None
+      if resume:
+         journal = load_json_state_file(pathname)
+         if journal is None:
+            nmsg("No journal found for a previous run, so starting from the beginning.")
+         elif journal.get("task") != task_name:
+            wmsg("Journal %s is not for a %s run, ignoring it." % (pathname, task_name))
+            journal = None
+      if journal is None:
+         journal = {"task": task_name, "started_at": now(), "machines": {}}
+
+      self.journal = journal
+      if pathname is not None:
+         dbg("Using run journal: %s" % pathname, level=2)
+
+      # If set, called as on_final_phase(machine, entry) when a machine is recorded as
+      # having reached a final phase or failed.
+      self.on_final_phase = None
+
+      # Machines that have reached a final phase or failed in this run.  Anything else
+      # recorded for them (eg. by the thread of a machine that was abandoned, once it
+      # gets unstuck) is ignored.
+      self.settled = set()
+
+   def get_entry(self, machine):
+      with self.lock:
+         entry = self.journal["machines"].get(machine)
+         return dict(entry) if entry is not None else None
+
+   def get_entries(self, machines=None):
+      with self.lock:
+         entries = self.journal["machines"]
+         return {m: dict(e) for m, e in entries.items() if machines is None or m in machines}
+
+   @staticmethod
+   def get_outcome_status(entry):
+
+      # Returns the status a machine ended up with:  Where it failed if it did, or else
+      # the status its task ended with (if it got that far).
+
+      status = entry.get("status")
+      return status if status is not None else entry.get("task_status")
+
+   def record(self, machine, phase, task_id=None, status=None, task_status=None):
+
+      # Records the phase a machine has reached, and its status as of that phase (eg.
+      # where it failed), if any.  The id of its task and the status the task ended
+      # with are kept from phase to phase, until the machine starts over (is validated
+      # again).
+
+      is_final = phase in RunJournal.final_phases or phase in RunJournal.failed_phases
+      with self.lock:
+         if machine in self.settled:
+            dbg("Ignoring %s phase for %s, already settled in this run." % (phase, machine), level=2)
+            return
+         if is_final:
+            self.settled.add(machine)
+         entry = self.journal["machines"].setdefault(machine, dict())
+         if phase == RunJournal.phase_validated:
+            entry.clear()
+         entry["phase"] = phase
+         entry["updated_at"] = now()
+         if task_id is not None:
+            entry["task_id"] = task_id
+         if task_status is not None:
+            entry["task_status"] = task_status
+         if status is not None:
+            entry["status"] = status
+         else:
+            entry.pop("status", None)
+         entry = dict(entry)
+         self._entry_recorded(machine, entry)
+      #
+      if self.on_final_phase is not None and is_final:
+         self.on_final_phase(machine, entry)
+
+   def _entry_recorded(self, machine, entry):
+      if self.pathname is not None:
+         save_json_state_file(self.pathname, self.journal)
+
+class _TR_Deadlines:
+
+   # The deadlines for a machine's run:  Each phase must be done with within its
+   # timeout (secs) from when it starts, and if there's a machine timeout, the whole run
+   # must be done with within it.  The deadlines are passed down to the machine's BMC
+   # connection, so no request outlives them.  If the machine's run has to be abandoned,
+   # cancel_event is set to get its thread to give up any waiting.
+
+   def __init__(self, phase_timeouts, machine_timeout=None, clock=system_clock):
+      self.clock = clock
+      self.phase_timeouts = phase_timeouts
+      self.machine_deadline = self.clock.now() + machine_timeout if machine_timeout is not None else None
+      self.cancel_event = self.clock.event()
+
+   def get_deadline(self, phase=None):
+
+      # Returns the deadline for a phase starting now (or overall, if phase is None),
+      # or None if there isn't one.
+
+      deadline = self.machine_deadline
+      timeout = self.phase_timeouts.get(phase) if phase is not None else None
+      if timeout is not None:
+         deadline = self.clock.now() + timeout if deadline is None else min(deadline, self.clock.now() + timeout)
+      return deadline
+
+   def remaining(self, deadline):
+      return None if deadline is None else max(deadline - self.clock.now(), 0)
+
+   def apply(self, bmc_conn, phase=None):
+      deadline = self.get_deadline(phase)
+      bmc_conn.set_deadline(deadline)
+      return deadline
+
+   def cancel(self):
+      self.cancel_event.set()
+
+   def is_cancelled(self):
+      return self.cancel_event.is_set()
+
 # These _TR_ classes are thread classes to premit multi-threading.
 
 class _TR_ConnectAndValidate(Thread):
 
     def __init__(self, machine, connection_args, the_task_class,
-                       task_arg=None, default_to_admin=False):
+                       task_arg=None, default_to_admin=False, journal=None, resume_entry=None):
        Thread.__init__(self)
        self.machine = machine
        self.connection_args = connection_args
        self.the_task_class = the_task_class
        self.task_arg = task_arg
        self.default_to_admin = default_to_admin
+       self.journal = journal if journal is not None else RunJournal(None, None)
+       self.resume_entry = resume_entry
+       self.deadlines = _TR_Deadlines({})
+       self.clock = system_clock
+
+       # How BMC connections are made (overridden when simulating).
+       self.create_connection = LabBMCConnection.create_connection
+
+       self._task = None
+       self._pre_check_ok = False
 
     def run(self):
+       with profiler.in_phase("connect-and-validate"):
+          try:
+             self._connect_and_validate()
+          except BMCError as exc:
+             emsg(str(exc), prefix=self.machine)
+             self._pre_check_ok = False
+
+    def _connect_and_validate(self):
 
        machine = self.machine
 
+       if self.resume_entry is not None:
+          # Reattaching to a task submitted by a previous run.  The pre-checks were done
+          # back then and the machine is no longer in the state they check for.
+          blurt("Opening BMC connection to reattach to task %s." % self.resume_entry["task_id"],
+                prefix=machine)
+          deadline = self.deadlines.get_deadline()
+          bmc_conn = self.create_connection(machine, self.connection_args,
+                                            default_to_admin= self.default_to_admin, deadline=deadline)
+          bmc_conn.set_deadline(deadline)
+          self._task = self.the_task_class(machine, bmc_conn, self.task_arg)
+          self._task.set_task_id(self.resume_entry["task_id"])
+          self._pre_check_ok = True
+          return
+
        blurt("Opening BMC connection and doing verification.", prefix=machine)
-       bmc_conn = LabBMCConnection.create_connection(machine, self.connection_args,
-                                                     default_to_admin= self.default_to_admin)
+       started_at = self.clock.now()
 
+       # (The deadline covers establishing the connection too.)
+       deadline = self.deadlines.get_deadline("connect-and-validate")
+       bmc_conn = self.create_connection(machine, self.connection_args,
+                                         default_to_admin= self.default_to_admin, deadline=deadline)
+       bmc_conn.set_deadline(deadline)
        self._task = self.the_task_class(machine, bmc_conn, self.task_arg)
        self._pre_check_ok = self._task.pre_check()
+       bmc_conn.set_deadline(self.deadlines.get_deadline())
+       _task_phase_secs.observe(self.clock.now() - started_at, task=self._task.get_short_task_name(),
+                                phase="connect-and-validate")
+       if self._pre_check_ok:
+          self.journal.record(machine, RunJournal.phase_validated)
 
     def task(self):
        return self._task
@@ -372,15 +1622,40 @@ class _TR_ConnectAndValidate(Thread):
 
 class _TR_PrepareTaskRequest(Thread):
 
-    def __init__(self, task, announce_actions):
+    def __init__(self, task, announce_actions, journal=None):
        Thread.__init__(self)
        self._task   = task
        self.machine = task.get_machine()
+       self.journal = journal if journal is not None else RunJournal(None, None)
+       self.deadlines = _TR_Deadlines({})
+       self.clock = system_clock
+
+       self._task_is_needed = False
 
     def run(self):
-       self._task_is_needed = self._task.prepare_task_request()
+       with profiler.in_phase("prepare"):
+          self._prepare()
+
+    def _prepare(self):
+       bmc_conn = self._task.get_bmc_conn()
+       started_at = self.clock.now()
+       try:
+          self.deadlines.apply(bmc_conn, "prepare")
+          self._task_is_needed = self._task.prepare_task_request()
+       except BMCError as exc:
+          emsg(str(exc), prefix=self.machine)
+          blurt("Abandoning futher action due to preceeding errors.", prefix=self.machine)
+          self._task_is_needed = False
+          self.journal.record(self.machine, RunJournal.phase_failed, status="prepare")
+          return
+       finally:
+          bmc_conn.set_deadline(self.deadlines.get_deadline())
+          _task_phase_secs.observe(self.clock.now() - started_at, task=self._task.get_short_task_name(), phase="prepare")
        if not self._task_is_needed:
           blurt("No task is necessary.", prefix=self.machine)
+          self.journal.record(self.machine, RunJournal.phase_not_needed)
+       else:
+          self.journal.record(self.machine, RunJournal.phase_prepared)
 
     def task(self):
        return self._task
@@ -390,14 +1665,55 @@ class _TR_PrepareTaskRequest(Thread):
 
 class _TR_RunTask(Thread):
 
-   def __init__(self, task, announce_actions):
+   def __init__(self, task, announce_actions, journal=None, resume_phase=None):
       Thread.__init__(self)
       self._task   = task
       self.machine = task.get_machine()
       self.announce_actions = announce_actions
+      self.journal = journal if journal is not None else RunJournal(None, None)
+
+      # When resuming, the phase the machine had reached in the previous run.  Only
+      # set for machines whose task had already been submitted.
+      self.resume_phase = resume_phase
 
       self._task_has_ended = False
 
+      # When we submitted the task and completed the post-submit phase (eg. powered the
+      # machine on to run it), if it was us rather than a previous run.  Tasks' durations
+      # are counted from the latter, so as not to include any wait for a power-on place.
+      self.submitted_at = None
+      self.post_submitted_at = None
+
+      # Deadlines for the phases, and by when the task must have ended (set when we
+      # start checking on it).
+      self.deadlines = _TR_Deadlines({})
+      self.task_deadline = None
+      self.clock = system_clock
+
+      # How often to check on the task's status, unless we know when to expect it to end
+      # (from the duration history, if set), in which case checks are spaced out (up to
+      # max_check_status_pause apart) until then.
+      self.check_status_pause_time = 15
+      self.max_check_status_pause = 300
+      self.duration_history  = None
+      self.duration_key      = None
+      self.duration_estimate = None
+      self.is_outlier        = False
+
+      # When we started waiting for the task to end, its state and when it was last seen
+      # not to have ended, and when to next check on it.
+      self.task_started_at = None
+      self.task_state      = None
+      self.last_seen_at    = None
+      self.next_check_at   = 0
+
+      # Max time to wait for the BMC to catch up after phases that ask us to.
+      self.bmc_ready_timeout = 300
+
+      # If set, the scheduler that admits this machine to the post-submit phase (which
+      # is where tasks power their machines on).  See PowerOnScheduler.
+      self.power_on_scheduler = None
+
       self._testing = False
       self.dummy_task_id       = "DUMMY-TASK-ID"
       self.dummy_task_check_nr = 0
@@ -424,40 +1740,47 @@ class _TR_RunTask(Thread):
    # better way to handle this (yet).
 
    def run(self):
+      try:
+         with profiler.in_phase("pre-submit"):
+            self._run_all_phases()
+      finally:
+         self.release_power_on_place()
+
+   def _run_all_phases(self):
 
       machine = self.machine
       task    = self._task
 
-      sleeper = Event()
-
-      idrac_pause_time        = 15 if not self._testing else 2
-      check_status_pause_time = 15 if not self._testing else 2
+      # Sleeps are cut short if the machine's run is abandoned.
+      sleeper = self.deadlines.cancel_event
 
-      # Run the pre-submit phase, pausing afterwards if requeted.
+      # Run the pre-submit and submit phases, waiting for the BMC to catch up afterwards
+      # if requeted, unless we're resuming after the task was already submitted.
 
-      pause = self.do_pre_submit()
-      if not self._ok:
-         return
-      if pause:
-         blurt("Pausing a bit to allow iDRAC to catch up.", prefix=machine)
-         sleeper.wait(idrac_pause_time) # Really gross
+      if self.resume_phase is None:
 
-      # Run the submit phase.
+         pause = self.do_pre_submit()
+         if not self._ok:
+            return
+         if pause:
+            self.wait_for_bmc_to_catch_up("pre-submit")
 
-      self.do_submit()
-      if not self._ok:
-         return
-      blurt("Pausing a bit to allow iDRAC to catch up.", prefix=machine)
-      sleeper.wait(idrac_pause_time)  # Really gross.
+         self.do_submit()
+         if not self._ok:
+            return
+         self.wait_for_bmc_to_catch_up("submit")
 
-      # Run the post-submit phase.
+      # Run the post-submit phase, once there's room for the machine to power on.
 
+      if self.needs_power_on_place():
+         profiler.switch_to("power-on-wait")
+         if not self.power_on_scheduler.admit(machine, cancel_event=self.deadlines.cancel_event):
+            return
       pause = self.do_post_submit()
       if not self._ok:
          return
       if pause:
-         blurt("Pausing a bit to allow iDRAC to catch up.", prefix=machine)
-         sleeper.wait(idrac_pause_time) # Really gross
+         self.wait_for_bmc_to_catch_up("post-submit")
 
       # Check on status periodically until task is done.
 
@@ -465,7 +1788,12 @@ class _TR_RunTask(Thread):
       while not has_ended:
          has_ended = self.check_task_status()
          if not has_ended:
-            sleeper.wait(check_status_pause_time)
+            # (No point sleeping past the task's deadline.)
+            pause = max(self.next_check_at - self.clock.now(), 1)
+            remaining = self.deadlines.remaining(self.task_deadline)
+            self.clock.wait(sleeper, pause if remaining is None else min(pause, remaining + 1))
+            if self.deadlines.is_cancelled():
+               return
       if not self.ok():
          return
 
@@ -481,34 +1809,112 @@ class _TR_RunTask(Thread):
 
       # All done for this machine/task/thread.
 
-   def _do_pre_or_post_phase(self, phase_name, announce_method, phase_method):
+   def needs_power_on_place(self):
+      if self.power_on_scheduler is None:
+         return False
+      return self.resume_phase not in RunJournal.post_submitted_phases
+
+   def release_power_on_place(self):
+      if self.power_on_scheduler is not None:
+         self.power_on_scheduler.release(self.machine)
+
+   def get_readiness_probe(self, after_phase):
+
+      # Returns the probe that tells us the BMC has caught up after the specified phase,
+      # and a description of what we'd be waiting for:  Before a task is submitted, that
+      # the BMC is ready to accept one.  After it is submitted, that the task is visible.
+      # Otherwise (eg. after powering the machine on) that Redfish is responsive.
+
+      task     = self._task
+      bmc_conn = task.get_bmc_conn()
+
+      if after_phase == "pre-submit":
+         return (bmc_conn.probe_ready_for_tasks, "BMC to be ready to accept tasks")
+      elif after_phase == "submit":
+         task_id = task.get_task_id()
+         return (lambda: bmc_conn.probe_resource(task_id), "submitted task to be visible")
+      else:
+         return (bmc_conn.probe_redfish_ready, "BMC to be responsive")
+
+   def wait_for_bmc_to_catch_up(self, after_phase):
+
+      # Rather than pausing a fixed time to let iDRAC catch up after we've done something
+      # to the machine, wait until it says its ready for what comes next.  If it doesn't
+      # get there in a reasonable time we carry on anyway, as we always used to.
+
+      machine = self.machine
+
+      if self._testing:
+         blurt("TESTING: Pausing instead of waiting for BMC.", prefix=machine)
+         self.clock.sleep(2)
+         return
+
+      # Don't wait past the machine's deadline though.
+
+      timeout = self.bmc_ready_timeout
+      remaining = self.deadlines.remaining(self.deadlines.get_deadline())
+      if remaining is not None:
+         timeout = min(timeout, remaining)
+
+      profiler.switch_to("wait-for-bmc")
+      probe, what = self.get_readiness_probe(after_phase)
+      started_at = self.clock.now()
+      try:
+         wait_until_ready(probe, what, timeout=timeout, cancel_event=self.deadlines.cancel_event,
+                          progress=lambda msg: blurt(msg, prefix=machine), clock=self.clock)
+      except BMCWaitTimeout as exc:
+         wmsg("%s  Continuing anyway." % exc, prefix=machine)
+      except BMCWaitCancelled:
+         pass
+      _task_bmc_wait_secs.observe(self.clock.now() - started_at, task=self._task.get_short_task_name(),
+                                  after_phase=after_phase)
+
+   def _do_pre_or_post_phase(self, phase_name, announce_method, phase_method, journal_phase=None,
+                             journal_failed_phase=RunJournal.phase_failed):
 
       task    = self._task
       machine = self.machine
 
       self._set_ok(True)
 
+      profiler.switch_to(phase_name)
+      bmc_conn = task.get_bmc_conn()
+      started_at = self.clock.now()
       try:
+         self.deadlines.apply(bmc_conn, phase_name)
          if self.announce_actions:
             announce_method(machine=machine)
          if not self._testing:
-            return phase_method()
+            pause = phase_method()
          else:
             blurt("TESTING: No-op'ing %s call." % phase_name, prefix=machine)
-            return True
+            pause = True
+         if journal_phase is not None:
+            self.journal.record(machine, journal_phase)
+         return pause
       except BMCError as exc:
          emsg(str(exc))
          blurt("Abandoning futher action due to preceeding errors.", prefix=machine)
          self._set_ok(False)
+         self.release_power_on_place()
+         self.journal.record(machine, journal_failed_phase, status=phase_name)
          return False
+      finally:
+         bmc_conn.set_deadline(self.deadlines.get_deadline())
+         _task_phase_secs.observe(self.clock.now() - started_at, task=task.get_short_task_name(), phase=phase_name)
 
    def do_pre_submit(self):
 
       # Perform pre-submit pass, intnedned to get the machine into whatever
       # pre-task-submit state is required if more than power control is needed.
 
+      if self.resume_phase is not None:
+         self._set_ok(True)
+         return False
+
       task = self._task
-      return self._do_pre_or_post_phase("pre-submit", task.announce_pre_submit_pass, task.pre_submit)
+      return self._do_pre_or_post_phase("pre-submit", task.announce_pre_submit_pass, task.pre_submit,
+                                        RunJournal.phase_pre_submitted)
 
    def do_submit(self):
 
@@ -517,11 +1923,20 @@ class _TR_RunTask(Thread):
       task    = self._task
       machine = self.machine
 
+      if self.resume_phase is not None:
+         blurt("Reattached to previously submitted task %s." % task.get_task_id(), prefix=machine)
+         self._set_ok(True)
+         return
+
       bmc_conn        = task.get_bmc_conn()
 
       self._set_ok(False)
 
+      profiler.switch_to("submit")
+      short_task_name = task.get_short_task_name()
+      started_at = self.clock.now()
       try:
+         self.deadlines.apply(bmc_conn, "submit")
          task_target = task.get_task_target()
          task_body   = task.get_task_body()
 
@@ -531,7 +1946,6 @@ class _TR_RunTask(Thread):
             self._set_ok(False)
          else:
             if self.announce_actions:
-               short_task_name = task.get_short_task_name()
                blurt("Submitting %s task." % short_task_name, prefix=machine)
             if not self._testing:
                task_id = bmc_conn.start_task(task_target, task_body)
@@ -540,6 +1954,8 @@ class _TR_RunTask(Thread):
                task_id = self.dummy_task_id
             dbg("Task id: %s" % task_id, level=3)
             task.set_task_id(task_id)
+            self.submitted_at = self.clock.now()
+            self.journal.record(machine, RunJournal.phase_submitted, task_id=task_id)
             self._set_ok(True)
 
       except BMCRequestError as exc:
@@ -547,14 +1963,26 @@ class _TR_RunTask(Thread):
          reason = "Could not submit %s task" % short_task_name
          blurt("Abaonding further action: %s." % reason, prefix=machine)
          self._set_ok(False)
+         self.journal.record(machine, RunJournal.phase_failed, status="submit")
+      finally:
+         bmc_conn.set_deadline(self.deadlines.get_deadline())
+         _task_phase_secs.observe(self.clock.now() - started_at, task=task.get_short_task_name(), phase="submit")
 
    def do_post_submit(self):
 
       # Perform post-submit pass, intnedned to niudge the machine in whatever
       # way needed to get it to run the pending tasks, for example powering them on.
 
+      if self.resume_phase in RunJournal.post_submitted_phases:
+         self._set_ok(True)
+         return False
+
       task = self._task
-      return self._do_pre_or_post_phase("post-submit", task.announce_post_submit_pass, task.post_submit)
+      pause = self._do_pre_or_post_phase("post-submit", task.announce_post_submit_pass, task.post_submit,
+                                         RunJournal.phase_post_submitted)
+      if self._ok:
+         self.post_submitted_at = self.clock.now()
+      return pause
 
    # For Testing: Returns a dummy BMC Task resource, sufficient for the
    #  completion/status checking we do.
@@ -592,11 +2020,98 @@ class _TR_RunTask(Thread):
 
       return bmc_task_res
 
+   def _estimate_duration(self):
+
+      # Looks up how long tasks like ours have taken before on machines like this one, to
+      # know when to expect it to end.
+
+      task = self._task
+      if self.duration_history is None or self._testing:
+         return
+      try:
+         bmc_conn = task.get_bmc_conn()
+         model = bmc_conn.get_system_resource().get("Model")
+         firmware = bmc_conn.get_system_manager_resource().get("FirmwareVersion")
+      except (BMCError, requests.exceptions.RequestException) as exc:
+         dbg("[%s] Couldn't get model/firmware for duration estimate: %s" % (self.machine, exc), level=3)
+         return
+
+      self.duration_key = (task.get_short_task_name(), model, firmware)
+      self.duration_estimate = self.duration_history.estimate(*self.duration_key)
+      est = self.duration_estimate
+      if est is not None:
+         blurt("Task usually takes about %s (%d seen on %s), so expecting it to end around %s." %
+               (describe_secs(est["expected"]), est["samples"], est["basis"],
+                time.strftime("%H:%M", time.localtime(self.task_started_at + est["expected"]))),
+               prefix=self.machine)
+
+   def _record_duration(self, bmc_task_res):
+
+      # The task ended sometime since we last saw it hadn't, so split the difference
+      # rather than have the durations recorded all be rounded up to a check.
+
+      if self.duration_key is None or self.post_submitted_at is None or bmc_task_res["TaskStatus"] != "OK":
+         return
+      ended_at = self.clock.now() if self.last_seen_at is None else (self.last_seen_at + self.clock.now()) / 2
+      self.duration_history.record(*self.duration_key, ended_at - self.post_submitted_at)
+
+   def _describe_eta(self):
+      est = self.duration_estimate
+      if est is None:
+         return ""
+      remaining = self.task_started_at + est["expected"] - self.clock.now()
+      if remaining <= 0:
+         return ""
+      return "  (ETA %s, in about %s)" % (time.strftime("%H:%M", time.localtime(self.clock.now() + remaining)),
+                                          describe_secs(remaining))
+
+   def _check_for_outlier(self):
+      est = self.duration_estimate
+      if est is None or self.is_outlier:
+         return
+      elapsed = self.clock.now() - self.task_started_at
+      if elapsed > est["outlier_after"]:
+         self.is_outlier = True
+         _task_outliers.inc(task=self._task.get_short_task_name())
+         wmsg("Task is taking abnormally long: %s so far vs. usually %s (on %s)." %
+              (describe_secs(elapsed), describe_secs(est["expected"]), est["basis"]), prefix=self.machine)
+
+   def get_check_status_pause(self):
+
+      # Returns how long to wait before next checking on the task:  Until its expected
+      # to end, checks are spaced out as far as max_check_status_pause.  But while a
+      # task that isn't yet running might be holding a power-on place others are
+      # waiting for, and once its expected to have ended, we check at the usual rate.
+
+      pause = self.check_status_pause_time if not self._testing else 2
+      est = self.duration_estimate
+      if est is None:
+         return pause
+      if self.power_on_scheduler is not None and (self.task_state or "").rstrip("*") != "Running":
+         return pause
+      remaining = self.task_started_at + est["expected"] - self.clock.now()
+      return max(pause, min(remaining, self.max_check_status_pause))
+
    def check_task_status(self):
 
       if self._task_has_ended:
          return self._task_has_ended
 
+      # (If only the post-completion phase is left to do, the task ended in a previous
+      # run and there's no need to check on it.)
+      if self.resume_phase == RunJournal.phase_post_completion_failed:
+         self._set_ok(True)
+         self._task_has_ended = True
+         return self._task_has_ended
+
+      profiler.switch_to("task")
+      try:
+         return self._check_task_status()
+      finally:
+         self.next_check_at = self.clock.now() + self.get_check_status_pause()
+
+   def _check_task_status(self):
+
       task    = self._task
       machine = self.machine
 
@@ -605,7 +2120,25 @@ class _TR_RunTask(Thread):
 
       self._set_ok(True)
 
+      # The task has to end within the task-phase timeout of when we started checking on
+      # it, and then the requests checking on it have to be done with by then too.
+
+      if self.task_deadline is None:
+         self.task_deadline = self.deadlines.get_deadline("task")
+         self.task_started_at = self.post_submitted_at if self.post_submitted_at is not None else self.clock.now()
+         self._estimate_duration()
+      if self.task_deadline is not None and self.clock.now() >= self.task_deadline:
+         emsg("Task has not ended by its deadline.", prefix=machine)
+         self._task_has_ended = True
+         self.release_power_on_place()
+         task.ending_task_res = None
+         blurt("Abaonding further action: Timed out waiting for task to end.", prefix=machine)
+         self._set_ok(False)
+         self.journal.record(machine, RunJournal.phase_failed, status="timed-out")
+         return self._task_has_ended
+
       try:
+         bmc_conn.set_deadline(self.task_deadline)
          if task_id != self.dummy_task_id:
             bmc_task_res = bmc_conn.get_task(task_id)
          else:
@@ -615,7 +2148,13 @@ class _TR_RunTask(Thread):
             blurt("Task has ended.", prefix=task.machine)
             dbg_echo_resource("Ended Task", bmc_task_res, level=9)
             self._task_has_ended = True
+            self.release_power_on_place()
             task.ending_task_res = bmc_task_res ## Should use a setter ##
+            if self.submitted_at is not None:
+               _task_job_secs.observe(self.clock.now() - self.submitted_at, task=task.get_short_task_name(),
+                                      status=bmc_task_res["TaskStatus"])
+            self._record_duration(bmc_task_res)
+            self.journal.record(machine, RunJournal.phase_ended, task_status=bmc_task_res["TaskStatus"])
          else:
             bmc_task_state = bmc_task_res["TaskState"]
 
@@ -629,24 +2168,36 @@ class _TR_RunTask(Thread):
                except KeyError:
                   bmc_task_state = "???"
 
+            # Once the task is running, the machine is past its power-on rush.
+            self.task_state = bmc_task_state
+            self.last_seen_at = self.clock.now()
+            if bmc_task_state.rstrip("*") == "Running":
+               self.release_power_on_place()
+
+            eta = self._describe_eta()
             if bmc_task_state == "Pending":
-               blurt("Task is scheduled/pending.", prefix=machine)
+               blurt("Task is scheduled/pending.%s" % eta, prefix=machine)
             elif bmc_task_state == "Starting":
                # On Dell iDRAC, it seems tasks remaining in Starting while the system is
                # going through its power-on initialization.  Then the task transitions
                # to running when LC has control.
-               blurt("Machine is still starting up.", prefix=machine)
+               blurt("Machine is still starting up.%s" % eta, prefix=machine)
             else:
                bmc_tasK_pct_complete = bmc_task_res["PercentComplete"]
-               blurt("Task still in progress: %s (%d%% complete)." %
-                     (bmc_task_state, bmc_tasK_pct_complete), prefix=machine)
+               blurt("Task still in progress: %s (%d%% complete).%s" %
+                     (bmc_task_state, bmc_tasK_pct_complete, eta), prefix=machine)
+            self._check_for_outlier()
 
       except BMCRequestError as exc:
          emsg("BMC request error: %s" % exc, prefix=machine)
          self._task_has_ended = True
+         self.release_power_on_place()
          task.ending_task_res = None
-         blurt("Abaonding further action: %s." % reason, prefix=machine)
+         blurt("Abaonding further action: Could not check on task.", prefix=machine)
          self._set_ok(False)
+         self.journal.record(machine, RunJournal.phase_failed, status="task")
+      finally:
+         bmc_conn.set_deadline(self.deadlines.get_deadline())
 
       return self._task_has_ended
 
@@ -654,12 +2205,16 @@ class _TR_RunTask(Thread):
 
       task    = self._task
       machine = self.machine
+      short_task_name = task.get_short_task_name()
+
+      if self.resume_phase == RunJournal.phase_post_completion_failed:
+         blurt("Task %s had already ended in a previous run." % short_task_name, prefix=machine)
+         return
 
       bmc_task_res = task.ending_task_res
       if bmc_task_res is not None:
          bmc_task_status = bmc_task_res["TaskStatus"]
          bmc_task_state = bmc_task_res["TaskState"]
-         short_task_name = task.get_short_task_name()
          if bmc_task_status == "OK":
             blurt("Task %s has comopleted successfully." % short_task_name, prefix=machine)
          else:
@@ -675,13 +2230,52 @@ class _TR_RunTask(Thread):
       # leave the machine powered on.
 
       task = self._task
-      return self._do_pre_or_post_phase("post-completion", task.announce_post_completion_pass, task.post_completion)
+      return self._do_pre_or_post_phase("post-completion", task.announce_post_completion_pass, task.post_completion,
+                                        RunJournal.phase_completed, RunJournal.phase_post_completion_failed)
 
 
 class TaskRunner:
 
+   # Default timeouts (secs) for each phase of a machine's run.  The "task" phase is
+   # waiting for the BMC task to end once submitted.  (See _TR_Deadlines.)
+
+   default_phase_timeouts = {
+      "connect-and-validate": 300,
+      "prepare":              300,
+      "pre-submit":           900,
+      "submit":               300,
+      "post-submit":          900,
+      "task":                 4 * 3600,
+      "post-completion":      900
+   }
+
+   # How long past its deadline a machine's thread gets to notice and give up, before
+   # the machine is abandoned without it.
+   deadline_grace_secs = 30
+
+   @staticmethod
+   def add_argument_definitions(parser, resumable=True):
+
+      # Options controlling the runner itself, for tools that use a TaskRunner.  Those
+      # for resuming an earlier run are left out if not resumable (eg. simulated runs).
+
+      if resumable:
+         parser.add_argument("--resume", dest="resume_run", action="store_true")
+         parser.add_argument("--journal", dest="run_journal")
+      parser.add_argument("--workers", dest="dist_workers", type=int)
+      parser.add_argument("--listen", dest="dist_listen")
+      parser.add_argument("--worker-of", dest="dist_worker_of")
+      parser.add_argument("--machine-timeout", dest="machine_timeout", type=int)
+      parser.add_argument("--phase-timeout", dest="phase_timeouts", action="append", metavar="PHASE=SECS")
+      PowerOnScheduler.add_argument_definitions(parser)
+      AdaptiveConcurrencyLimiter.add_argument_definitions(parser)
+      MachineResultReporter.add_argument_definitions(parser)
+
    def __init__(self, machines, connection_args, the_task_class,
-                task_arg=None, default_to_admin=False):
+                task_arg=None, default_to_admin=False, clock=system_clock, power_groups=None):
+
+      # Power_groups gives the power group of each machine (see PowerOnScheduler) if
+      # not as per the machine-info db.
 
       self.machines         = machines
       self.connection_args  = connection_args
@@ -690,39 +2284,145 @@ class TaskRunner:
       self.default_to_admin = default_to_admin
 
       self.multi_threaded = the_task_class.is_multi_thread_safe()
+      self.power_groups   = power_groups
+
+      start_profiling(connection_args)
+
+      # The clock everything is timed and paced by, and how BMC connections are made.
+      # (Both are replaced when simulating, see task_sim_common.)
+      self.clock = clock
+      self.create_connection = LabBMCConnection.create_connection
+
+      # Max time to wait for the BMCs to catch up after passes that ask us to.
+      self.bmc_ready_timeout = 300
+
+      # How often to check on tasks (when not expecting them to end later, see
+      # _TR_RunTask.get_check_status_pause), and for room for more machines to power on.
+      self.check_status_pause_time = 15
 
       self._testing = False
 
       self.tasks = dict()
 
+      # Phase and machine timeouts, and the deadlines of each machine (set when the
+      # run starts).
+
+      self.phase_timeouts = dict(TaskRunner.default_phase_timeouts)
+      for spec in getattr(connection_args, "phase_timeouts", None) or []:
+         phase, secs = split_at(spec, "=")
+         if phase not in self.phase_timeouts or secs is None or not secs.isdigit():
+            die("Phase timeout \"%s\" is not of the form PHASE=SECS with PHASE one of: %s." %
+                (spec, ", ".join(self.phase_timeouts.keys())))
+         self.phase_timeouts[phase] = int(secs)
+      self.machine_timeout = getattr(connection_args, "machine_timeout", None)
+      self.deadlines = dict()
+
+      # How long tasks have taken before, to know when to expect them to end.
+      self.duration_history = TaskDurationHistory()
+
+      # Limit on the BMC requests in flight at once, adjusted as we see how the BMCs are
+      # coping.  It applies to all of the process's BMC connections while we run.
+      self.concurrency_limiter = AdaptiveConcurrencyLimiter.create_limiter(connection_args, clock=self.clock)
+
+      # Settings for distributing the run across worker processes.  (See _TR_Coordinator.)
+      self.dist_workers   = getattr(connection_args, "dist_workers", None)
+      self.dist_listen    = getattr(connection_args, "dist_listen", None)
+      self.dist_worker_of = getattr(connection_args, "dist_worker_of", None)
+      self.dist_coordinator = None
+
+      # Journal recording each machine's progress.  Tools that don't add our argument
+      # definitions (or not those for resuming) get one that is only kept in memory, as
+      # they can't ask to resume from it.  Workers get theirs from the coordinator with
+      # each shard of machines.
+
+      if self.dist_worker_of is not None:
+         self.journal = None
+         self.power_on_scheduler = None
+         # The coordinator reports the results, but our chatter still has to be kept
+         # off (the coordinator's) stdout.
+         if getattr(connection_args, "output_format", "table") != "table":
+            set_blurt_to_stderr()
+         return
+
+      resume = getattr(connection_args, "resume_run", False)
+      journal_pathname = getattr(connection_args, "run_journal", None)
+      if journal_pathname is None and hasattr(connection_args, "resume_run"):
+         tool_name = os.path.basename(sys.argv[0])
+         journal_pathname = RunJournal.default_pathname(tool_name, machines)
+      self.journal = RunJournal(journal_pathname, the_task_class.get_short_task_name(), resume=resume)
+
+      # Result records for each machine are reported as it reaches the end of the road.
+      self.reporter = MachineResultReporter.create_reporter(connection_args)
+      self.journal.on_final_phase = self._machine_finished
+
+      # Scheduler to stagger the post-submit (power-on) phase in waves, if requested.
+      self.power_on_scheduler = PowerOnScheduler.create_scheduler(machines, connection_args, clock=clock,
+                                                                  groups=power_groups)
+
    # Run all of the run() methods of a collection of thread objects, either
    # seriall or on parallel threads if multi_threading is enabled.
 
-   def _run_threads(self, threads):
+   #
+   # Threads are given until the deadline for the phase they run (or overall, if phase
+   # is None) to finish.  Machines whose threads don't are abandoned and dropped from
+   # threads.  (Their threads are daemon threads, so don't keep us from exiting.)
+
+   def _run_threads(self, threads, phase=None):
       if self.multi_threaded:
+         join_deadlines = dict()
          for machine in list(threads.keys()):
-            threads[machine].start()
+            join_deadlines[machine] = self._get_machine_deadlines(machine).get_deadline(phase)
+            threads[machine].daemon = True
+            self.clock.start(threads[machine])
          for machine in list(threads.keys()):
-            threads[machine].join()
+            deadline = join_deadlines[machine]
+            if deadline is None:
+               self.clock.join(threads[machine])
+            else:
+               self.clock.join(threads[machine], max(deadline + self.deadline_grace_secs - self.clock.now(), 0))
+               if threads[machine].is_alive():
+                  self._abandon_machine(machine, phase)
+                  del threads[machine]
       else:
          for machine in list(threads.keys()):
             threads[machine].run()
       return threads
 
+   def _get_machine_deadlines(self, machine):
+      deadlines = self.deadlines.get(machine)
+      if deadlines is None:
+         deadlines = _TR_Deadlines(self.phase_timeouts, self.machine_timeout, clock=self.clock)
+         self.deadlines[machine] = deadlines
+      return deadlines
+
+   def _abandon_machine(self, machine, phase):
+
+      # Gives up on a machine whose thread is stuck past its deadline, telling the thread
+      # to give up too should it ever get unstuck.
+
+      emsg("Abandoning machine as it is not done with %s by its deadline." %
+           ("the %s phase" % phase if phase is not None else "its task"), prefix=machine)
+      self.deadlines[machine].cancel()
+      if self.power_on_scheduler is not None:
+         self.power_on_scheduler.release(machine)
+      self.journal.record(machine, RunJournal.phase_failed, status="timed-out")
+
    # Create thread objects for all of the specified tasks.
 
    def _create_threads_for_tasks(self, thread_class, tasks):
       threads = dict()
       for machine in list(tasks.keys()):
-         threads[machine] = thread_class(tasks[machine], self.multi_threaded)
+         threads[machine] = thread_class(tasks[machine], self.multi_threaded, journal=self.journal)
+         threads[machine].deadlines = self._get_machine_deadlines(machine)
+         threads[machine].clock = self.clock
       return threads
 
    # Create thread objects for all of the specified tasks, running their run() methods
    # either serially or in paralle if multi-threading is enabled.
 
-   def _create_and_run_threads_for_tasks(self, thread_class, tasks):
+   def _create_and_run_threads_for_tasks(self, thread_class, tasks, phase=None):
       threads = self._create_threads_for_tasks( thread_class, tasks)
-      self._run_threads(threads)
+      self._run_threads(threads, phase=phase)
       return threads
 
    @staticmethod
@@ -738,43 +2438,180 @@ class TaskRunner:
          if machine not in threads:
             del tasks[machine]
 
-   def _do_pass(self, threads, phase_name, announce_method, phase_method, idrac_pause_time=None):
+   def _wait_for_bmcs_to_catch_up(self, threads, after_phase):
+
+      # Waits (concurrently) for the BMCs of the machines to catch up after a pass.
+      # (See _TR_RunTask.wait_for_bmc_to_catch_up.)
+
+      if not threads:
+         return
+
+      if self._testing:
+         blurt("TESTING: Pausing instead of waiting for BMCs.")
+         self.clock.sleep(2)
+         return
+
+      profiler.switch_to("wait-for-bmc")
+      probes = dict()
+      what = None
+      for machine, t in threads.items():
+         probes[machine], what = t.get_readiness_probe(after_phase)
+
+      blurt("Waiting for the BMCs to catch up (%s)." % what)
+      started_at = self.clock.now()
+      results = wait_until_all_ready(probes, what, timeout=self.bmc_ready_timeout, progress=blurt,
+                                     clock=self.clock)
+      _task_bmc_wait_secs.observe(self.clock.now() - started_at, task=self.the_task_class.get_short_task_name(),
+                                  after_phase=after_phase)
+      for machine in sorted(results.keys()):
+         if results[machine] is not None:
+            wmsg("%s  Continuing anyway." % results[machine], prefix=machine)
+
+   def _do_pass(self, threads, phase_name, announce_method, phase_method, wait_for_bmcs=False):
 
       # Blurt out info on the pass we are about to run.
       announce_method()
 
-      pause_after_pass = False
+      paused_threads = dict()
       for machine in list(threads.keys()):
          t = threads[machine]
          pause = phase_method(t)
-         pause_after_pass = pause_after_pass or (pause and t.ok())
+         if pause and t.ok():
+            paused_threads[machine] = t
 
       # Abandon threads/tasks that didn't successfully perform pre-submit().
       self._absndon_failed_threads(threads)
 
-      if idrac_pause_time and pause_after_pass and threads:
-         blurt("Pausing a bit to allow the iDRACs to catch up.")
-         time.sleep(idrac_pause_time)  # Really gross.
+      if wait_for_bmcs:
+         self._wait_for_bmcs_to_catch_up(paused_threads, phase_name)
+
+   def _do_post_submit_wave(self, threads, waiting_threads, pending_tasks):
+
+      # Runs the post-submit pass for the next wave of waiting machines, ie. those for
+      # which the power-on scheduler now has room, moving them on to pending_tasks.
+
+      scheduler = self.power_on_scheduler
+
+      wave = dict()
+      for machine in sorted(waiting_threads.keys()):
+         if scheduler.try_admit(machine):
+            wave[machine] = waiting_threads.pop(machine)
+      if not wave:
+         return
+
+      blurt("Starting post-submit pass for a wave of %d machines (%d still waiting)." %
+            (len(wave), len(waiting_threads)))
+      wave_machines = list(wave.keys())
+      self._do_pass(wave, "post-submit", self.the_task_class.announce_post_submit_pass,
+                    _TR_RunTask.do_post_submit, wait_for_bmcs=True)
+
+      # _do_pass drops the machines that failed from the wave.  (Machines of earlier
+      # waves whose tasks have ended are no longer pending but still to be finished up.)
+      for machine in wave_machines:
+         if machine in wave:
+            pending_tasks[machine] = wave[machine]
+         else:
+            del threads[machine]
+
+   def _machine_finished(self, machine, entry, **fields):
+      if not fields.get("skipped"):
+         _task_results.inc(task=self.the_task_class.get_short_task_name(), phase=entry.get("phase"),
+                           status=RunJournal.get_outcome_status(entry))
+      self._report_machine(machine, entry, **fields)
+
+   def _report_machine(self, machine, entry, **fields):
+      phase  = entry.get("phase")
+      status = RunJournal.get_outcome_status(entry)
+      ok = phase in RunJournal.final_phases and status in [None, "OK"]
+      self.reporter.report(machine, ok=ok, task=self.the_task_class.get_short_task_name(),
+                           phase=phase, task_id=entry.get("task_id"), status=status, **fields)
+
+   def _report_unfinished_machines(self):
+
+      # Reports on the machines that didn't get to a final phase (eg. because another
+      # machine failed verification), then finishes off the reporting.
+
+      for machine in self.machines:
+         if not self.reporter.was_reported(machine):
+            entry = self.journal.get_entry(machine)
+            if entry is None:
+               entry = {"phase": "not-started"}
+            self._report_machine(machine, entry, unfinished=True)
+      self.reporter.finish()
 
    def run(self):
+      prev_limiter = BMCConnection.request_concurrency_limiter
+      BMCConnection.request_concurrency_limiter = self.concurrency_limiter
+      try:
+         self._run()
+      finally:
+         BMCConnection.request_concurrency_limiter = prev_limiter
+
+   def _run(self):
+      if self.dist_worker_of is not None:
+         _TR_Worker(self, self.dist_worker_of).run()
+         return
+      try:
+         if self.dist_workers is not None or self.dist_listen is not None:
+            self.dist_coordinator = _TR_Coordinator(self)
+            self.dist_coordinator.run()
+         else:
+            # (Serial runs do the machines' phases on this thread, see _run_machines.)
+            with profiler.in_phase("main"):
+               self._run_machines()
+      finally:
+         self._report_unfinished_machines()
+         if self.concurrency_limiter is not None:
+            dbg("Limit on BMC requests in flight ended at %s." % self.concurrency_limiter.describe(), level=1)
+
+   def _run_machines(self):
 
       the_task_class = self.the_task_class
 
-      idrac_pause_time        = 15 if not self._testing else 2
-      check_status_pause_time = 15 if not self._testing else 2
+      # (How often to check for room for more machines to power on.)
+      check_status_pause_time = self.check_status_pause_time if not self._testing else 2
+
+      # If resuming, figure out where each machine had gotten to in the previous run.
+      # Machines that were done are skipped, and machines for which a task had been
+      # submitted are reattached to that task.
+
+      machines = []
+      resume_entries = dict()
+      for machine in self.machines:
+         entry = self.journal.get_entry(machine)
+         phase = entry["phase"] if entry is not None else None
+         if phase in RunJournal.final_phases:
+            status = RunJournal.get_outcome_status(entry)
+            status_msg = " (ending status: %s)" % status if status is not None else ""
+            blurt("Skipping machine, already %s in previous run%s." % (phase, status_msg), prefix=machine)
+            if self.journal.on_final_phase is not None:
+               self.journal.on_final_phase(machine, entry, skipped=True)
+            continue
+         if phase in RunJournal.task_submitted_phases:
+            resume_entries[machine] = entry
+         machines.append(machine)
+      #
+      if not machines:
+         blurt("All machines were already done in the previous run.")
+         return
 
       # Open BMC connections to each of the machines and do quick pre-checks.
       # If pre-checks fail for any machine, we abort the whole thing.
 
       threads = dict()
-      for machine in self.machines:
+      for machine in machines:
          threads[machine] = _TR_ConnectAndValidate(machine, self.connection_args, self.the_task_class,
-                                                   self.task_arg, default_to_admin=self.default_to_admin)
+                                                   self.task_arg, default_to_admin=self.default_to_admin,
+                                                   journal=self.journal,
+                                                   resume_entry=resume_entries.get(machine))
+         threads[machine].deadlines = self._get_machine_deadlines(machine)
+         threads[machine].clock = self.clock
+         threads[machine].create_connection = self.create_connection
       #
 
-      self._run_threads(threads)
+      self._run_threads(threads, phase="connect-and-validate")
 
-      errors_occurred = False
+      errors_occurred = len(threads) < len(machines)
       for machine in list(threads.keys()):
          t = threads[machine]
          if t.pre_check_ok():
@@ -787,14 +2624,15 @@ class TaskRunner:
          return
 
       # Give all the tasks a chance to prepare input, or decline to do so, before
-      # we start any real work.
+      # we start any real work.  (Tasks we're reattaching to are long past that.)
 
-      threads = self._create_and_run_threads_for_tasks(_TR_PrepareTaskRequest, self.tasks)
+      new_tasks = {m: t for m, t in self.tasks.items() if m not in resume_entries}
+      threads = self._create_and_run_threads_for_tasks(_TR_PrepareTaskRequest, new_tasks, phase="prepare")
 
-      tasks_are_needed = False
-      for machine in list(threads.keys()):
-         t = threads[machine]
-         if t.task_is_needed():
+      tasks_are_needed = len(resume_entries) > 0
+      for machine in new_tasks.keys():
+         t = threads.get(machine)
+         if t is not None and t.task_is_needed():
             tasks_are_needed = True
          else:
             del self.tasks[machine]
@@ -804,6 +2642,12 @@ class TaskRunner:
          return
 
       threads = self._create_threads_for_tasks(_TR_RunTask, self.tasks)
+      for machine, entry in resume_entries.items():
+         threads[machine].resume_phase = entry["phase"]
+      for t in threads.values():
+         t.power_on_scheduler = self.power_on_scheduler
+         t.duration_history = self.duration_history
+         t.check_status_pause_time = self.check_status_pause_time
 
       if self.multi_threaded:
 
@@ -823,7 +2667,7 @@ class TaskRunner:
          # Perform pre-submit pass across all machines.
 
          self._do_pass(threads, "pre-submit", the_task_class.announce_pre_submit_pass,
-                       the_tr_class.do_pre_submit, idrac_pause_time)
+                       the_tr_class.do_pre_submit, wait_for_bmcs=True)
          if not threads:
             blurt("No machines successfully estbalished pre-submit conditions.")
             return
@@ -842,29 +2686,42 @@ class TaskRunner:
             blurt("No %s tasks were started." % short_task_name)
             return
 
-         blurt("Pausing a bit to allow the iDRACs to catch up.")
-         time.sleep(idrac_pause_time)  # Really gross.
+         # (Only for the tasks submitted just now; those reattached to may be long gone.)
+         submitted_threads = {m: t for m, t in threads.items() if t.resume_phase is None}
+         self._wait_for_bmcs_to_catch_up(submitted_threads, "submit")
 
-         # Perforom post-submit pass across all of the machines.
+         # Perforom post-submit pass across all of the machines, or in waves as there's
+         # room for them to power on if staggering.
 
-         self._do_pass(threads, "post-submit", the_task_class.announce_post_submit_pass,
-                       the_tr_class.do_post_submit, idrac_pause_time)
-         if not threads:
-            blurt("No machines successfully estbalished post-submit conditions.")
-            return
+         if self.power_on_scheduler is None:
+            self._do_pass(threads, "post-submit", the_task_class.announce_post_submit_pass,
+                          the_tr_class.do_post_submit, wait_for_bmcs=True)
+            if not threads:
+               blurt("No machines successfully estbalished post-submit conditions.")
+               return
+            waiting_threads = dict()
+         else:
+            waiting_threads = {m: t for m, t in threads.items() if t.needs_power_on_place()}
 
-         print("Waiting for submmitted %s tasks to complete." % short_task_name)
-         pending_tasks = {m:t for m, t in threads.items()}
+         blurt("Waiting for submmitted %s tasks to complete." % short_task_name)
+         pending_tasks = {m:t for m, t in threads.items() if m not in waiting_threads}
 
-         while pending_tasks:
+         while pending_tasks or waiting_threads:
             for machine in list(pending_tasks.keys()):
                t = pending_tasks[machine]
+               if self.clock.now() < t.next_check_at:
+                  continue
                t_has_ended = t.check_task_status()
                if t_has_ended:
                   del pending_tasks[machine]
             #
-            if len(pending_tasks) > 0:
-               time.sleep(check_status_pause_time)
+            if waiting_threads:
+               self._do_post_submit_wave(threads, waiting_threads, pending_tasks)
+            if len(pending_tasks) > 0 or waiting_threads:
+               # Sleep until the next check on a task is due.
+               next_check_at = min([t.next_check_at for t in pending_tasks.values()] +
+                                   ([self.clock.now() + check_status_pause_time] if waiting_threads else []))
+               self.clock.sleep(max(next_check_at - self.clock.now(), 1))
 
          # Abandon threads/tasks that didn't get to end-of-task cleanly.
          self._absndon_failed_threads(threads)
@@ -883,6 +2740,463 @@ class TaskRunner:
 
       blurt("Finished.")
 
+
+# --- Distributing a TaskRunner run across worker processes ---
+#
+# A coordinator hands out shards of the machines to worker processes, either ones it
+# starts on this host (--workers N) or ones started on other hosts (--listen) by running
+# the same tool command with --worker-of pointing at the coordinator.  Each worker runs
+# an ordinary TaskRunner on its shard, reporting every journal record back, so the
+# coordinator keeps the run journal for the whole run.  If a local worker dies or goes
+# quiet, it is killed and its unfinished machines are handed to another worker along with
+# their journal entries so that tasks already submitted are reattached to by task id
+# rather than redone.  (Those of a worker on another host, which can't be made to stop,
+# are given up on instead.)  With a power-on budget, shards are made up of whole power
+# groups, so that the budget holds per switch across workers.
+#
+# Messages are dicts (pickled by multiprocessing.connection) with an "op" of:
+#
+#   worker to coordinator:  hello, progress, heartbeat, shard-done
+#   coordinator to worker:  shard, done
+#
+# Connections are authenticated with the shared secret in ACM_LAB_DIST_AUTHKEY.
+
+def _get_dist_authkey(generate=False):
+   authkey = os.getenv("ACM_LAB_DIST_AUTHKEY")
+   if authkey is None:
+      if not generate:
+         die("Environment variable ACM_LAB_DIST_AUTHKEY must be set for distributed runs.")
+      # Local workers inherit it from us.
+      authkey = os.urandom(16).hex()
+      os.environ["ACM_LAB_DIST_AUTHKEY"] = authkey
+   return authkey.encode("utf-8")
+
+def _parse_dist_address(addr):
+   host, port = split_at(addr, ":", favor_right=True)
+   try:
+      return (host if host else "0.0.0.0", int(port))
+   except ValueError:
+      die("Address \"%s\" is not of the form [host]:port." % addr)
+
+def _worker_argv(argv, coordinator_addr):
+
+   # Returns the command line for a local worker: ours, less the options that only
+   # make sense for the coordinator (or that the workers would fight over, like the
+   # metrics ones, see _TR_Coordinator._start_local_worker), plus the one that makes it
+   # a worker.
+
+   valued_opts = ["--workers", "--listen", "--worker-of", "--journal", "--metrics-file", "--metrics-listen"]
+   flag_opts   = ["--resume"]
+
+   worker_argv = [sys.executable, argv[0]]
+   skip_next = False
+   for arg in argv[1:]:
+      if skip_next:
+         skip_next = False
+      elif arg in valued_opts:
+         skip_next = True
+      elif arg in flag_opts or arg.split("=")[0] in valued_opts:
+         pass
+      else:
+         worker_argv.append(arg)
+   return worker_argv + ["--worker-of", "%s:%d" % coordinator_addr]
+
+class _TR_WorkerLost(Exception):
+   pass
+
+class _TR_WorkerJournal(RunJournal):
+
+   # A worker's journal for its shard.  Starts out with the coordinator's entries for
+   # the machines and reports every record back to it rather than saving to a file.
+
+   def __init__(self, task_name, entries, send):
+      super(_TR_WorkerJournal, self).__init__(None, task_name)
+      self.journal["machines"] = entries
+      self.send = send
+
+   def _entry_recorded(self, machine, entry):
+      self.send({"op": "progress", "machine": machine, "entry": entry})
+
+class _TR_Coordinator:
+
+   heartbeat_timeout  = 120
+   progress_interval  = 30
+   max_reassignments  = 2
+
+   def __init__(self, runner):
+
+      self.runner  = runner
+      self.journal = runner.journal
+      self.local_mode  = runner.dist_listen is None
+      self.num_workers = max(runner.dist_workers if runner.dist_workers is not None else 1, 1)
+
+      self.cond = Condition()
+
+      # Shards (lists of machines) waiting for a worker, and the machines that aren't
+      # yet finished with one way or another.
+      self.queue     = []
+      self.unsettled = set()
+
+      # Number of times each machine has been handed on after losing its worker, and
+      # the number of workers lost while running a shard.
+      self.reassignments = dict()
+      self.workers_lost = 0
+
+      # Number of shards being run by a worker.
+      self.running_shards = 0
+
+      # The local workers we started, the slot of each (a replacement taking the slot of
+      # a worker lost), and the metrics file they each get one of their own of, if any.
+      self.local_procs = []
+      self.local_slots = dict()
+      self.metrics_file = (getattr(runner.connection_args, "metrics_file", None) or
+                           os.getenv("ACM_LAB_METRICS_FILE"))
+
+   def run(self):
+
+      runner = self.runner
+
+      machines = []
+      for machine in runner.machines:
+         entry = self.journal.get_entry(machine)
+         if entry is not None and entry["phase"] in RunJournal.final_phases:
+            blurt("Skipping machine, already %s in previous run." % entry["phase"], prefix=machine)
+            runner._report_machine(machine, entry, skipped=True)
+            continue
+         machines.append(machine)
+      #
+      if not machines:
+         blurt("All machines were already done in the previous run.")
+         return
+
+      self.queue = self._make_shards(machines)
+      self.unsettled = set(machines)
+
+      if self.local_mode:
+         address = ("127.0.0.1", 0)
+      else:
+         address = _parse_dist_address(runner.dist_listen)
+      listener = Listener(address, authkey=_get_dist_authkey(generate=self.local_mode))
+      self.address = listener.address
+
+      acceptor = Thread(target=self._accept_workers, args=(listener,))
+      acceptor.daemon = True
+      acceptor.start()
+
+      short_task_name = runner.the_task_class.get_short_task_name()
+      blurt("Distributing %s tasks for %d machines across %d shards." %
+            (short_task_name, len(machines), len(self.queue)))
+
+      with self.cond:
+         if self.local_mode:
+            for i in range(len(self.queue)):
+               self._start_local_worker()
+         else:
+            blurt("Waiting for workers to connect to %s:%d." % self.address)
+
+         last_progress_time = now()
+         while self.unsettled:
+            self.cond.wait(5)
+            if self.local_mode:
+               self._replace_lost_local_workers()
+            if now() - last_progress_time >= self.progress_interval:
+               self._report_progress()
+               last_progress_time = now()
+         #
+         # Let any idle workers know we're done.
+         self.cond.notify_all()
+
+      for proc in self.local_procs:
+         proc.wait()
+      listener.close()
+
+      self._report_results(machines)
+
+   def _make_shards(self, machines):
+
+      # Splits the machines into (at most) num_workers shards of about the same size.
+      # Each worker keeps its own power-on budget, so with one the machines of each
+      # power group (switch) are kept together in a shard, so that the budget still
+      # holds per switch.  (With few switches, that means fewer, bigger shards.)
+
+      runner = self.runner
+      if getattr(runner.connection_args, "power_on_budget", None) is None:
+         shard_size = -(-len(machines) // self.num_workers)
+         return [machines[i:i + shard_size] for i in range(0, len(machines), shard_size)]
+
+      groups = dict()
+      for machine in machines:
+         if runner.power_groups is not None:
+            group = runner.power_groups[machine]
+         else:
+            group = get_machine_power_group(machine)
+         groups.setdefault(group, []).append(machine)
+      shards = [[] for i in range(min(self.num_workers, len(groups)))]
+      for group in sorted(groups.keys(), key=lambda g: (-len(groups[g]), g)):
+         min(shards, key=len).extend(groups[group])
+      return shards
+
+   def _start_local_worker(self):
+
+      # Starts a worker, in the slot of a worker that was lost if there is one.  Workers
+      # don't serve metrics (they'd all want the same port), but each writes them to a
+      # file of its own if we're writing them to one.
+
+      used_slots = {self.local_slots[p] for p in self.local_procs if p.poll() is None}
+      slot = min(i for i in range(len(used_slots) + 1) if i not in used_slots)
+      argv = _worker_argv(sys.argv, self.address)
+      env = dict(os.environ, PYTHONUNBUFFERED="1")
+      env.pop("ACM_LAB_METRICS_LISTEN", None)
+      env.pop("ACM_LAB_METRICS_FILE", None)
+      if self.metrics_file is not None:
+         base, ext = os.path.splitext(self.metrics_file)
+         env["ACM_LAB_METRICS_FILE"] = "%s-worker-%d%s" % (base, slot + 1, ext)
+      proc = subprocess.Popen(argv, env=env)
+      self.local_procs.append(proc)
+      self.local_slots[proc] = slot
+
+   def _replace_lost_local_workers(self):
+
+      # Called with the cond lock held.  The machines of workers that died were put back
+      # on the queue, so start replacements for the workers lost, enough for each shard
+      # running or queued to have a worker (idle workers take queued shards too).
+
+      if not self.queue:
+         return
+      live_cnt = len([p for p in self.local_procs if p.poll() is None])
+      for i in range(self.running_shards + len(self.queue) - live_cnt):
+         blurt("Starting a replacement worker.")
+         self._start_local_worker()
+
+   def _accept_workers(self, listener):
+      while True:
+         try:
+            conn = listener.accept()
+         except AuthenticationError:
+            wmsg("Rejected a worker connection that failed authentication.")
+            continue
+         except OSError:
+            # Listener closed.
+            return
+         t = Thread(target=self._serve_worker, args=(conn,))
+         t.daemon = True
+         t.start()
+
+   def _serve_worker(self, conn):
+
+      try:
+         hello = conn.recv()
+         name = "%s:%d" % (hello["host"], hello["pid"])
+      except (EOFError, OSError, KeyError, TypeError):
+         conn.close()
+         return
+      dbg("Worker %s connected." % name, level=2)
+
+      shard = None
+      lost_reason = None
+      try:
+         while True:
+            shard = self._next_shard(conn)
+            if shard is None:
+               conn.send({"op": "done"})
+               break
+            blurt("Assigning %d machines to worker %s: %s" % (len(shard), name, " ".join(shard)))
+            conn.send({"op": "shard", "machines": shard, "entries": self.journal.get_entries(shard)})
+            self._follow_worker(conn)
+            self._settle(shard)
+            shard = None
+
+      except (EOFError, OSError):
+         lost_reason = "connection lost"
+      except _TR_WorkerLost as exc:
+         lost_reason = str(exc)
+      finally:
+         conn.close()
+      if lost_reason is None:
+         return
+
+      # A worker that we started is stopped for sure before its machines are handed on,
+      # so that it can't carry on with them alongside another worker.  One on another
+      # host may well still be running them (eg. if it's the network that failed), and
+      # we can't stop it, so its machines are given up on rather than risk their tasks
+      # being submitted twice.
+      was_local = self._stop_local_worker(hello)
+      if shard is not None:
+         self._hand_on_shard(shard, name, lost_reason, hand_on=was_local)
+
+   def _next_shard(self, conn):
+
+      # Waits for a shard for an idle worker, returning None once there won't be any.
+      # Shards can appear until all machines are settled because a lost worker's
+      # machines are handed on.
+
+      with self.cond:
+         while True:
+            if self.queue:
+               self.running_shards += 1
+               return self.queue.pop(0)
+            if not self.unsettled:
+               return None
+            self.cond.wait(5)
+            while conn.poll(0):
+               conn.recv()  # Heartbeats.
+
+   def _follow_worker(self, conn):
+
+      # Records the progress a worker reports until it says its done with its shard.
+
+      while True:
+         if not conn.poll(self.heartbeat_timeout):
+            raise _TR_WorkerLost("nothing heard for %d secs" % self.heartbeat_timeout)
+         msg = conn.recv()
+         op = msg.get("op")
+         if op == "progress":
+            entry = msg["entry"]
+            self.journal.record(msg["machine"], entry["phase"],
+                                task_id=entry.get("task_id"), status=entry.get("status"),
+                                task_status=entry.get("task_status"))
+         elif op == "shard-done":
+            return
+
+   def _settle(self, shard):
+      with self.cond:
+         self.running_shards -= 1
+         self.unsettled.difference_update(shard)
+         self.cond.notify_all()
+
+   def _hand_on_shard(self, shard, name, reason, hand_on=True):
+
+      # Puts a lost worker's unfinished machines back on the queue for another worker,
+      # or if not hand_on, gives up on them.
+
+      with self.cond:
+         wmsg("Lost worker %s (%s)." % (name, reason))
+         self.workers_lost += 1
+         self.running_shards -= 1
+         orphans = []
+         for machine in shard:
+            entry = self.journal.get_entry(machine)
+            phase = entry["phase"] if entry is not None else None
+            if phase in RunJournal.final_phases or phase in RunJournal.failed_phases:
+               self.unsettled.discard(machine)
+               continue
+            if not hand_on:
+               emsg("Not handing machine on, as worker %s on another host may still be running it." % name,
+                    prefix=machine)
+               self.unsettled.discard(machine)
+               continue
+            cnt = self.reassignments.get(machine, 0) + 1
+            self.reassignments[machine] = cnt
+            if cnt > self.max_reassignments:
+               emsg("Giving up on machine after losing %d workers running it." % cnt, prefix=machine)
+               self.unsettled.discard(machine)
+               continue
+            orphans.append(machine)
+         #
+         if orphans:
+            blurt("Handing on %d machines: %s" % (len(orphans), " ".join(orphans)))
+            self.queue.append(orphans)
+         self.cond.notify_all()
+
+   def _stop_local_worker(self, hello):
+
+      # Stops (and waits for) the worker that said hello, if it's one we started.
+      # Returns whether it was.
+
+      if hello["host"] != socket.gethostname():
+         return False
+      for proc in list(self.local_procs):
+         if proc.pid == hello["pid"]:
+            if proc.poll() is None:
+               proc.kill()
+            proc.wait()
+            return True
+      return False
+
+   def _report_progress(self):
+      entries = self.journal.get_entries(self.unsettled)
+      phase_cnts = dict()
+      for machine in self.unsettled:
+         phase = entries[machine]["phase"] if machine in entries else "waiting"
+         phase_cnts[phase] = phase_cnts.get(phase, 0) + 1
+      blurt("Progress: %d machines still running (%s)." %
+            (len(self.unsettled), ", ".join("%d %s" % (c, p) for p, c in sorted(phase_cnts.items()))))
+
+   def _report_results(self, machines):
+      entries = self.journal.get_entries(machines)
+      blurt("Results:")
+      for machine in sorted(machines):
+         entry = entries.get(machine)
+         if entry is None:
+            blurt("   %s: not started" % machine)
+            continue
+         status = RunJournal.get_outcome_status(entry)
+         status_msg = " (ending status: %s)" % status if status is not None else ""
+         blurt("   %s: %s%s" % (machine, entry["phase"], status_msg))
+      blurt("Finished.")
+
+class _TR_Worker:
+
+   heartbeat_interval = 15
+
+   def __init__(self, runner, coordinator_addr):
+      self.runner = runner
+      self.coordinator_addr = coordinator_addr
+      self.send_lock = Lock()
+
+   def _send(self, msg):
+      with self.send_lock:
+         try:
+            self.conn.send(msg)
+         except OSError:
+            # Coordinator is gone.  Carry on with what we were doing regardless.
+            pass
+
+   def _send_heartbeats(self, stopper):
+      while not stopper.wait(self.heartbeat_interval):
+         self._send({"op": "heartbeat"})
+
+   def run(self):
+
+      runner = self.runner
+      task_name = runner.the_task_class.get_short_task_name()
+
+      address = _parse_dist_address(self.coordinator_addr)
+      try:
+         self.conn = Client(address, authkey=_get_dist_authkey())
+      except (OSError, AuthenticationError) as exc:
+         die("Could not connect to coordinator at %s: %s" % (self.coordinator_addr, exc))
+      self._send({"op": "hello", "host": socket.gethostname(), "pid": os.getpid()})
+
+      stopper = Event()
+      heartbeats = Thread(target=self._send_heartbeats, args=(stopper,))
+      heartbeats.daemon = True
+      heartbeats.start()
+
+      while True:
+         try:
+            msg = self.conn.recv()
+         except (EOFError, OSError):
+            wmsg("Lost contact with the coordinator.")
+            break
+         if msg.get("op") != "shard":
+            break
+
+         machines = msg["machines"]
+         blurt("Running %s tasks for machines: %s" % (task_name, " ".join(machines)))
+         runner.machines = machines
+         runner.tasks    = dict()
+         runner.journal  = _TR_WorkerJournal(task_name, msg["entries"], self._send)
+         runner.power_on_scheduler = PowerOnScheduler.create_scheduler(machines, runner.connection_args,
+                                                                       clock=runner.clock,
+                                                                       groups=runner.power_groups)
+         runner._run_machines()
+         self._send({"op": "shard-done"})
+      #
+      stopper.set()
+      self.conn.close()
+
+
 # Base class for task classes that TaskRunner can run.
 
 class RunnableTask:
@@ -0,0 +1,243 @@
+# A small Prometheus-style metrics registry.
+#
+# The lab tools record what they see of BMC responsiveness (request latencies, iDRAC
+# not-ready retries, sessions) and of task health (phase and job durations by task type)
+# in the process-wide registry here.  If asked to, a tool exposes the metrics in the
+# Prometheus text exposition format via an HTTP endpoint or by dumping them to a file
+# (eg. for node_exporter's textfile collector) periodically and at exit.
+#
+# Deliberately self-contained rather than depending on the prometheus_client package.
+
+# Assumes: Python 3.6+
+
+import atexit
+import os
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from misc_utils import *
+
+# Histogram bucket upper bounds (secs) for BMC request latencies and for task/job
+# durations respectively.
+
+request_latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+task_duration_buckets   = [5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200]
+
+def _escape_label_value(value):
+   return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_value(value):
+   if isinstance(value, float):
+      if value == float("inf"):
+         return "+Inf"
+      return repr(value)
+   return str(value)
+
+class _Metric:
+
+   def __init__(self, name, help_text, label_names, metric_type):
+      self.name        = name
+      self.help_text   = help_text
+      self.label_names = tuple(label_names)
+      self.metric_type = metric_type
+
+      # Values indexed by tuple of label values.
+      self.values = dict()
+      self.lock = threading.Lock()
+
+   def _key(self, labels):
+      unknown = set(labels.keys()) - set(self.label_names)
+      if unknown:
+         raise ValueError("Unknown labels for metric %s: %s" % (self.name, ", ".join(sorted(unknown))))
+      return tuple("" if labels.get(n) is None else str(labels[n]) for n in self.label_names)
+
+   def _label_str(self, key, extra=None):
+      pairs = list(zip(self.label_names, key))
+      if extra is not None:
+         pairs.append(extra)
+      if not pairs:
+         return ""
+      return "{%s}" % ",".join("%s=\"%s\"" % (n, _escape_label_value(v)) for n, v in pairs)
+
+   def get(self, **labels):
+      with self.lock:
+         return self.values.get(self._key(labels))
+
+   def render(self):
+      lines = ["# HELP %s %s" % (self.name, self.help_text),
+               "# TYPE %s %s" % (self.name, self.metric_type)]
+      with self.lock:
+         for key in sorted(self.values.keys()):
+            lines.extend(self._render_value(key, self.values[key]))
+      return lines
+
+   def _render_value(self, key, value):
+      return ["%s%s %s" % (self.name, self._label_str(key), _format_value(value))]
+
+class Counter(_Metric):
+
+   def __init__(self, name, help_text, label_names=()):
+      super().__init__(name, help_text, label_names, "counter")
+
+   def inc(self, amount=1, **labels):
+      key = self._key(labels)
+      with self.lock:
+         self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(_Metric):
+
+   def __init__(self, name, help_text, label_names=()):
+      super().__init__(name, help_text, label_names, "gauge")
+
+   def set(self, value, **labels):
+      key = self._key(labels)
+      with self.lock:
+         self.values[key] = value
+
+   def inc(self, amount=1, **labels):
+      key = self._key(labels)
+      with self.lock:
+         self.values[key] = self.values.get(key, 0) + amount
+
+   def dec(self, amount=1, **labels):
+      self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+
+   def __init__(self, name, help_text, label_names=(), buckets=None):
+      super().__init__(name, help_text, label_names, "histogram")
+      self.buckets = sorted(buckets if buckets is not None else request_latency_buckets)
+
+   def observe(self, value, **labels):
+
+      # Values are [per-bucket counts..., sum, count].  Bucket counts are made cumulative
+      # when rendered.
+
+      key = self._key(labels)
+      with self.lock:
+         v = self.values.get(key)
+         if v is None:
+            v = [0] * len(self.buckets) + [0.0, 0]
+            self.values[key] = v
+         for i, upper in enumerate(self.buckets):
+            if value <= upper:
+               v[i] += 1
+               break
+         v[-2] += value
+         v[-1] += 1
+
+   def _render_value(self, key, value):
+      lines = []
+      cumulative = 0
+      for i, upper in enumerate(self.buckets):
+         cumulative += value[i]
+         lines.append("%s_bucket%s %d" % (self.name, self._label_str(key, ("le", _format_value(float(upper)))),
+                                          cumulative))
+      lines.append("%s_bucket%s %d" % (self.name, self._label_str(key, ("le", "+Inf")), value[-1]))
+      lines.append("%s_sum%s %s" % (self.name, self._label_str(key), _format_value(value[-2])))
+      lines.append("%s_count%s %d" % (self.name, self._label_str(key), value[-1]))
+      return lines
+
+class MetricsRegistry:
+
+   def __init__(self):
+      self.metrics = dict()
+      self.lock = threading.Lock()
+
+   def _get_or_create(self, metric_class, name, help_text, label_names, **kwargs):
+      with self.lock:
+         metric = self.metrics.get(name)
+         if metric is None:
+            metric = metric_class(name, help_text, label_names, **kwargs)
+            self.metrics[name] = metric
+         elif not isinstance(metric, metric_class):
+            raise ValueError("Metric %s already registered as a %s." % (name, metric.metric_type))
+         return metric
+
+   def counter(self, name, help_text, label_names=()):
+      return self._get_or_create(Counter, name, help_text, label_names)
+
+   def gauge(self, name, help_text, label_names=()):
+      return self._get_or_create(Gauge, name, help_text, label_names)
+
+   def histogram(self, name, help_text, label_names=(), buckets=None):
+      return self._get_or_create(Histogram, name, help_text, label_names, buckets=buckets)
+
+   def render(self):
+      with self.lock:
+         metrics = [self.metrics[n] for n in sorted(self.metrics.keys())]
+      lines = []
+      for metric in metrics:
+         lines.extend(metric.render())
+      return "\n".join(lines) + "\n"
+
+   def dump(self, pathname):
+
+      # Written to a temp file and renamed into place so that a collector never reads a
+      # partially written file.
+
+      tmp_pathname = "%s.tmp.%d" % (pathname, os.getpid())
+      with open(tmp_pathname, "w") as f:
+         f.write(self.render())
+      os.replace(tmp_pathname, pathname)
+
+# The process-wide registry everything records into.
+metrics = MetricsRegistry()
+
+# --- Exposing the metrics ---
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+   registry = metrics
+
+   def do_GET(self):
+      if self.path.split("?")[0] not in ["/", "/metrics"]:
+         self.send_error(404)
+         return
+      body = self.registry.render().encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, format, *args):
+      dbg("Metrics endpoint: %s" % (format % args), level=5)
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+   daemon_threads = True
+
+def start_metrics_server(host, port):
+
+   # Serves the metrics at http://host:port/metrics from a background thread for as long
+   # as the process runs.  Returns the server.
+
+   server = _ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+   t = threading.Thread(target=server.serve_forever)
+   t.daemon = True
+   t.start()
+   dbg("Serving metrics on %s:%d." % server.server_address[:2], level=2)
+   return server
+
+def start_metrics_file_dumps(pathname, interval=15):
+
+   # Dumps the metrics to a file every interval secs and once more at exit.
+
+   def dump():
+      try:
+         metrics.dump(pathname)
+      except OSError as exc:
+         wmsg("Could not write metrics file %s: %s" % (pathname, exc))
+
+   def dump_periodically():
+      while True:
+         time.sleep(interval)
+         dump()
+
+   t = threading.Thread(target=dump_periodically)
+   t.daemon = True
+   t.start()
+   atexit.register(dump)
@@ -5,12 +5,54 @@
 
 import json
 import sys
+import threading
 import time
 
 
 def now():
    return time.time()
 
+class Clock:
+
+   # The time, and the ways of waiting for time to pass, that the task-running code
+   # uses, so that it can be run against a simulated clock (see task_sim_common) rather
+   # than real time.  This is the real thing.
+   #
+   # Threads that wait on the clock have to be started with its start(), and work handed
+   # to other threads (eg. a thread pool) wrapped with held(), so that a simulated clock
+   # knows when everything is waiting and time can move on.  Events waited on with wait()
+   # are best made with event(), so that a simulated clock hears of them being set.
+
+   def now(self):
+      return time.time()
+
+   def event(self):
+      return threading.Event()
+
+   def sleep(self, secs):
+      if secs > 0:
+         time.sleep(secs)
+
+   def wait(self, event, timeout=None):
+      return event.wait(timeout)
+
+   def wait_condition(self, cond, timeout=None):
+      return cond.wait(timeout)
+
+   def notify_all(self, cond):
+      cond.notify_all()
+
+   def start(self, thread):
+      thread.start()
+
+   def join(self, thread, timeout=None):
+      thread.join(timeout)
+
+   def held(self, func):
+      return func
+
+system_clock = Clock()
+
 # Some message-emitting utilities.
 
 dbg_volume_level = 0
@@ -43,11 +85,20 @@ def nmsg(msg, *args, prefix=None):
    else:
       eprint("Note: %s" % msg, *args)
 
+# Tools that write machine-readable output to stdout send what they blurt to stderr.
+blurt_to_stderr = False
+
+def set_blurt_to_stderr(on=True):
+   global blurt_to_stderr
+   blurt_to_stderr = on
+
 def blurt(*args, **kwargs):
    prefix = None
    if "prefix" in kwargs:
       prefix = kwargs["prefix"]
       del kwargs["prefix"]
+   if blurt_to_stderr and "file" not in kwargs:
+      kwargs["file"] = sys.stderr
    if prefix:
       print("[%s]" % prefix, *args, **kwargs)
    else:
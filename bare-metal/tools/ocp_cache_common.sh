@@ -0,0 +1,284 @@
+#
+# Some common functions for the get-ocp-* scripts, sourced by them:  Fetching files
+# from the OCP mirror site through a local cache, so that a client or installer that
+# has been fetched before (by any of the scripts, or by anyone sharing the cache) isn't
+# downloaded again.
+#
+# - Files are kept in the cache by their sha256, as listed in the sha256sum.txt of the
+#   mirror directory they come from.  So a file is only downloaded once however many
+#   versions or aliases it's fetched as, and what's in the cache is known to be intact.
+#   Installers extracted from a release image are kept by the image's digest.
+#
+# - Floating versions (eg. latest-4.9, stable-4.9) are resolved to the fixed version
+#   they are an alias of (as per the alias's release.txt) once per run, and what they
+#   resolved to is cached for a while (see ACM_LAB_OCP_ALIAS_TTL).  Everything else is
+#   looked up in, and fetched from, the fixed version's mirror directory, so that the
+#   sha256sum.txt and release.txt used always go together.  Those (of fixed versions)
+#   don't change, so are cached for good.
+#
+# - Downloads go to a partial file which is resumed (with a ranged request) if an
+#   earlier download was interrupted.  Files are hashed as they are streamed in
+#   rather than read again afterwards.
+#
+# - Fetches of the same file are serialized with flock, so that concurrent runs (eg.
+#   get-ocp-cli and get-ocp-install both wanting the client tarball) fetch it once.
+#
+# Environment variables:
+#
+# ACM_LAB_OCP_CACHE_DIR   Cache directory.  Defaults to ocp-cache in the lab state dir
+#                         (ACM_LAB_STATE_DIR, or ~/.cache/acm-lab).  Point the users of
+#                         a host at the same (group-writable) directory to share it.
+# ACM_LAB_OCP_MIRROR      URL of the mirror site (the scripts' -m option overrides it),
+#                         eg. a local mirror or a stand-in for testing.
+# ACM_LAB_OCP_ALIAS_TTL   How long (secs) floating versions stay resolved as they were.
+#                         Defaults to 3600.  Use 0 to always check with the mirror.
+
+ocp_default_mirror_site="https://mirror.openshift.com/pub/openshift-v4"
+
+ocp_die() {
+   >&2 echo "Error: $*"
+   exit 1
+}
+
+ocp_cache_init() {
+
+   # Sets up to use the cache, and the mirror site $1 if not empty.
+
+   ocp_mirror_site=${1:-${ACM_LAB_OCP_MIRROR:-$ocp_default_mirror_site}}
+   ocp_mirror_site=${ocp_mirror_site%/}
+   ocp_alias_ttl=${ACM_LAB_OCP_ALIAS_TTL:-3600}
+
+   local state_dir=${ACM_LAB_STATE_DIR:-$HOME/.cache/acm-lab}
+   ocp_cache_dir=${ACM_LAB_OCP_CACHE_DIR:-$state_dir/ocp-cache}
+
+   mkdir -p "$ocp_cache_dir"/{aliases,listings,by-sha256,partial,extracted,locks} ||
+      ocp_die "Could not create cache directory $ocp_cache_dir."
+}
+
+ocp_is_floating_version() {
+   [[ $1 == latest-* || $1 == stable-* || $1 == fast-* || $1 == candidate-* ]]
+}
+
+_ocp_with_lock() {
+
+   # Runs the command (args 2 onward) holding the cache lock named $1.
+
+   local lock_name=$1
+   shift
+   (
+      flock 9 || exit 1
+      "$@"
+   ) 9> "$ocp_cache_dir/locks/$lock_name.lock"
+}
+
+_ocp_refresh_alias() {
+
+   local alias=$1 resolved=$2
+
+   # (Re-check, another run may have just refreshed it.)
+   if [[ -f $resolved && $(( $(date +%s) - $(stat -c %Y "$resolved") )) -lt $ocp_alias_ttl ]]; then
+      return 0
+   fi
+
+   local url="$ocp_mirror_site/clients/ocp/$alias/release.txt"
+   local version
+   version=$(curl -sSfL "$url" | awk '$1 == "Name:" {print $2; exit}')
+   if [[ -n $version ]]; then
+      echo "$version" > "$resolved.tmp.$$" && mv -f "$resolved.tmp.$$" "$resolved"
+   elif [[ -f $resolved ]]; then
+      >&2 echo "Warning: Could not resolve $alias with $url, using what it was as of $(date -r "$resolved")."
+   else
+      return 1
+   fi
+}
+
+ocp_resolve_version() {
+
+   # Prints the fixed version that version $1 is (an alias of, if it's floating).
+
+   local version=$1
+   if ! ocp_is_floating_version "$version"; then
+      echo "$version"
+      return 0
+   fi
+
+   local resolved="$ocp_cache_dir/aliases/$version"
+   if [[ ! -f $resolved || $(( $(date +%s) - $(stat -c %Y "$resolved") )) -ge $ocp_alias_ttl ]]; then
+      _ocp_with_lock "alias-$version" _ocp_refresh_alias "$version" "$resolved" ||
+         ocp_die "Could not resolve version $version with $ocp_mirror_site."
+   fi
+   cat "$resolved"
+}
+
+_ocp_fetch_listing() {
+
+   local url=$1 listing=$2
+
+   # (Re-check, another run may have just fetched it.)
+   [[ -f $listing ]] && return 0
+
+   local tmp="$listing.tmp.$$"
+   if curl -sSfL -o "$tmp" "$url"; then
+      mv -f "$tmp" "$listing"
+   else
+      rm -f "$tmp"
+      return 1
+   fi
+}
+
+ocp_get_listing() {
+
+   # Prints the pathname of a cached copy of the file $2 (eg. sha256sum.txt) of the
+   # fixed version $1's mirror directory, fetching it if need be.  (They don't change,
+   # so are never refreshed.)
+
+   local version=$1 file=$2
+   local listing="$ocp_cache_dir/listings/$version/$file"
+
+   ocp_is_floating_version "$version" &&
+      ocp_die "Listings of floating version $version are not cached, resolve it first."
+   if [[ -f $listing ]]; then
+      echo "$listing"
+      return 0
+   fi
+   mkdir -p "$ocp_cache_dir/listings/$version"
+   _ocp_with_lock "listing-$version-$file" _ocp_fetch_listing \
+      "$ocp_mirror_site/clients/ocp/$version/$file" "$listing" ||
+      ocp_die "Could not fetch $file for version $version from $ocp_mirror_site."
+   echo "$listing"
+}
+
+ocp_lookup_file() {
+
+   # Prints the sha256 and name of the first file in the fixed version $1's mirror
+   # directory whose name matches the (extended) regex $2, as "<sha256> <name>".
+
+   local version=$1 pattern=$2
+   local listing
+   listing=$(ocp_get_listing "$version" sha256sum.txt) || exit 1
+   local entry
+   entry=$(awk '{print $1, $2}' "$listing" | grep -E " $pattern\$" | head -1)
+   [[ -n $entry ]] || ocp_die "No file matching $pattern listed for version $version."
+   echo "$entry"
+}
+
+_ocp_download() {
+
+   # Downloads url $1 to partial file $2 (resuming it if there's already some of it),
+   # printing the sha256 of the whole file.  Fails with curl's exit status.
+
+   local url=$1 partial=$2
+   local offset
+   offset=$(stat -c %s "$partial" 2>/dev/null || echo 0)
+   if [[ $offset -gt 0 ]]; then
+      >&2 echo "Resuming download of $(basename "$url") at byte $offset."
+   fi
+
+   # What we already have is hashed on the way by, followed by the rest as it comes in.
+   (
+      set -o pipefail
+      { head -c "$offset" "$partial" 2>/dev/null; curl -sSfL -C "$offset" "$url" | tee -a "$partial"; } |
+         sha256sum | awk '{print $1}'
+   )
+}
+
+_ocp_fetch_into_cache() {
+
+   local url=$1 sha=$2
+   local cached="$ocp_cache_dir/by-sha256/$sha"
+   local partial="$ocp_cache_dir/partial/$sha"
+
+   # (Re-check, another run may have just fetched it.)
+   [[ -f $cached ]] && return 0
+   >&2 echo "Downloading $(basename "$url")."
+
+   local attempt actual rc
+   for attempt in 1 2; do
+      actual=$(_ocp_download "$url" "$partial")
+      rc=$?
+      if [[ $actual == "$sha" ]]; then
+         # (Even if curl failed, eg. as the partial file was already complete.)
+         mv -f "$partial" "$cached"
+         return 0
+      elif [[ $rc -eq 33 ]]; then
+         # The mirror doesn't do ranged requests, so start over.
+         rm -f "$partial"
+         continue
+      elif [[ $rc -ne 0 ]]; then
+         >&2 echo "Error: Download of $url failed (curl status $rc).  Run again to resume it."
+         return 1
+      else
+         # Maybe what we resumed from was bad, so start over (once).
+         >&2 echo "Warning: Download of $url has sha256 $actual rather than $sha."
+         rm -f "$partial"
+         continue
+      fi
+   done
+   >&2 echo "Error: Could not download an intact copy of $url."
+   return 1
+}
+
+ocp_fetch_file() {
+
+   # Prints the pathname of the cached copy of the file $2 (with sha256 $3) from the
+   # fixed version $1's mirror directory, downloading it if need be.
+
+   local version=$1 file=$2 sha=$3
+   local cached="$ocp_cache_dir/by-sha256/$sha"
+
+   if [[ -f $cached ]]; then
+      >&2 echo "Using cached $file."
+   else
+      _ocp_with_lock "sha256-$sha" _ocp_fetch_into_cache "$ocp_mirror_site/clients/ocp/$version/$file" "$sha" ||
+         exit 1
+   fi
+   echo "$cached"
+}
+
+_ocp_extract_into_cache() {
+
+   local oc=$1 pullsecret_file=$2 release_image=$3 cmd=$4 extracted_dir=$5
+
+   # (Re-check, another run may have just extracted it.)
+   [[ -f $extracted_dir/$cmd ]] && return 0
+
+   local tmp_dir="$extracted_dir.tmp.$$"
+   mkdir -p "$tmp_dir"
+   if ! "$oc" adm release extract --registry-config "$pullsecret_file" --command="$cmd" \
+           --to "$tmp_dir" "$release_image" >&2; then
+      rm -rf "$tmp_dir"
+      return 1
+   fi
+   mkdir -p "$extracted_dir"
+   mv -f "$tmp_dir/$cmd" "$extracted_dir/$cmd"
+   rm -rf "$tmp_dir"
+}
+
+ocp_extract_command() {
+
+   # Prints the pathname of the cached copy of command $4 (eg. openshift-install)
+   # extracted from release image $3 using oc $1 and pull secret file $2, extracting it
+   # if need be.  Extracted commands are kept by the release image's digest, so if the
+   # image isn't given by digest (as it is in release.txt), the command is extracted
+   # into directory $5 instead.
+
+   local oc=$1 pullsecret_file=$2 release_image=$3 cmd=$4 work_dir=$5
+   local digest=${release_image##*@sha256:}
+
+   if [[ $digest == "$release_image" ]]; then
+      "$oc" adm release extract --registry-config "$pullsecret_file" --command="$cmd" \
+         --to "$work_dir" "$release_image" >&2 || ocp_die "Could not extract $cmd from $release_image."
+      echo "$work_dir/$cmd"
+      return 0
+   fi
+
+   local extracted_dir="$ocp_cache_dir/extracted/$digest"
+   if [[ -f $extracted_dir/$cmd ]]; then
+      >&2 echo "Using cached $cmd."
+   else
+      _ocp_with_lock "extract-$digest-$cmd" _ocp_extract_into_cache \
+         "$oc" "$pullsecret_file" "$release_image" "$cmd" "$extracted_dir" ||
+         ocp_die "Could not extract $cmd from $release_image."
+   fi
+   echo "$extracted_dir/$cmd"
+}
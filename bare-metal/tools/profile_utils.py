@@ -0,0 +1,284 @@
+
+# Profiling of where the lab tools' time goes, for telling Python overhead apart from
+# waiting on BMCs when a run over the fleet is slow.
+#
+# The process-wide PhaseProfiler here keeps a cProfile profile for each phase of the
+# work (eg. TaskRunner's per-machine phases) in each thread that does some of it.  A
+# thread says which phase it's in with switch_to() or in_phase(), and only one of its
+# profiles is enabled at a time.  Once a thread is in no phase anymore, what it was
+# profiled doing is folded into the per-phase totals.  It does nothing until started.
+#
+# When saved, the threads' profiles of each phase are merged and written to a file per
+# phase (<phase>.prof, for pstats or the like) and a summary.txt that attributes each
+# phase's wall time to:
+#
+# - network:  Waiting on sockets (connecting, sending, receiving, SSL and select), ie.
+#   mostly waiting for BMCs to answer,
+#
+# - sleeping: Sleeps and waits on locks, events, conditions and other threads (eg. for
+#   a turn under the in-flight request limit, or while waiting for a task to end),
+#
+# - cpu:      CPU time of the threads (including the profiler's own overhead),
+#
+# with whatever is left over (mostly waiting for the GIL) as other.  The summary also
+# lists the functions of the tools themselves (eg. classify_dell_boot_entries) that
+# took the most time of their own.
+#
+# Deliberately uses cProfile rather than a sampling profiler, as sleeps and waits in C
+# don't show up in samples of Python frames.
+
+# Assumes: Python 3.6+
+
+import atexit
+import cProfile
+import os
+import pstats
+import threading
+import time
+
+from contextlib import contextmanager
+
+from misc_utils import *
+
+# How profiled functions are told apart (by their pstats function name) as waiting on
+# the network or sleeping.
+
+_network_func_markers = ["_socket.socket", "_ssl._SSLSocket", "_socket.getaddrinfo",
+                         "select.select", "select.poll", "select.epoll"]
+_sleep_func_markers   = ["time.sleep", "_thread.lock", "_thread.RLock"]
+
+def _classify_func(func):
+   filename, _, funcname = func
+   if filename != "~":
+      return "cpu"
+   for marker in _network_func_markers:
+      if marker in funcname:
+         return "network"
+   for marker in _sleep_func_markers:
+      if marker in funcname:
+         return "sleeping"
+   return "cpu"
+
+def _thread_cpu_time():
+   # (time.thread_time is Python 3.7+.)
+   return time.thread_time() if hasattr(time, "thread_time") else None
+
+class _PhaseSegment:
+
+   # A thread's profile of a phase, and the wall and CPU time it spent in it.
+
+   def __init__(self, phase):
+      self.phase = phase
+      self.profile = cProfile.Profile()
+      self.profiled = False
+      self.wall_secs = 0.0
+      self.cpu_secs = 0.0
+      self.entered_at = None
+      self.entered_cpu = None
+
+class PhaseProfiler:
+
+   def __init__(self):
+
+      self.lock = threading.Lock()
+      self.dirname = None
+
+      # The segments of the threads that are still going, indexed by thread id and then
+      # phase, and each thread's current phase.
+      self.segments = dict()
+      self.current = dict()
+
+      # What's been collected from threads that are done, by phase:  Merged pstats.Stats
+      # (None if nothing was profiled), the wall and CPU times and the number of threads.
+      self.phase_stats = dict()
+      self.phase_times = dict()
+
+      self.enable_failed = False
+
+   def is_active(self):
+      return self.dirname is not None
+
+   def start(self, dirname):
+
+      # Starts profiling, to be saved in dirname (and at exit), with the main thread in
+      # the "main" phase if it's the one calling.  If already started, the profiles are
+      # just saved in dirname instead.
+
+      with self.lock:
+         os.makedirs(dirname, exist_ok=True)
+         started = self.dirname is not None
+         self.dirname = dirname
+         if started:
+            return
+      if threading.current_thread() is threading.main_thread():
+         self.switch_to("main")
+      atexit.register(self.save)
+
+   def current_phase(self):
+      return self.current.get(threading.get_ident())
+
+   def _leave(self, tid):
+      phase = self.current.pop(tid, None)
+      # (The segment is gone if the thread was collected by save() while in the phase.)
+      seg = self.segments.get(tid, {}).get(phase)
+      if seg is None:
+         return
+      if seg.profiled:
+         seg.profile.disable()
+      seg.wall_secs += time.perf_counter() - seg.entered_at
+      cpu = _thread_cpu_time()
+      if cpu is not None:
+         seg.cpu_secs += cpu - seg.entered_cpu
+
+   def switch_to(self, phase):
+
+      # Puts the calling thread into the phase (None for none, eg. when it's done with
+      # its part of the work), returning the phase it was in.
+
+      if self.dirname is None:
+         return None
+      tid = threading.get_ident()
+      prev_phase = self.current.get(tid)
+      if phase == prev_phase:
+         return prev_phase
+      self._leave(tid)
+      if phase is None:
+         with self.lock:
+            self._collect(tid)
+         return prev_phase
+
+      with self.lock:
+         seg = self.segments.setdefault(tid, dict()).get(phase)
+         if seg is None:
+            seg = self.segments[tid][phase] = _PhaseSegment(phase)
+      seg.entered_at = time.perf_counter()
+      seg.entered_cpu = _thread_cpu_time()
+      self.current[tid] = phase
+
+      # (From Python 3.12 cProfile can only profile one thread at a time, so other
+      # threads just get their times totalled up.)
+      try:
+         seg.profile.enable()
+         seg.profiled = True
+      except ValueError as exc:
+         seg.profiled = False
+         if not self.enable_failed:
+            self.enable_failed = True
+            wmsg("Can only time rather than profile some threads: %s" % exc)
+      return prev_phase
+
+   @contextmanager
+   def in_phase(self, phase):
+      prev_phase = self.switch_to(phase)
+      try:
+         yield
+      finally:
+         self.switch_to(prev_phase)
+
+   def _collect(self, tid, live=False):
+
+      # Folds a thread's segments into the per-phase totals.  The thread's profiles
+      # mustn't be enabled, unless it's live (still in a phase, as some threads are at
+      # exit), in which case only its times are counted, its wall time in the current
+      # phase up to now.  (A live profile can't be looked at from another thread.)
+
+      current_phase = self.current.pop(tid, None) if live else None
+      for phase, seg in self.segments.pop(tid, {}).items():
+         times = self.phase_times.setdefault(phase, {"wall": 0.0, "cpu": 0.0, "threads": 0})
+         times["wall"] += seg.wall_secs
+         if phase == current_phase:
+            times["wall"] += time.perf_counter() - seg.entered_at
+         times["cpu"] += seg.cpu_secs
+         times["threads"] += 1
+         if seg.profiled and not live:
+            seg.profile.create_stats()
+            if self.phase_stats.get(phase) is None:
+               self.phase_stats[phase] = pstats.Stats(seg.profile)
+            else:
+               self.phase_stats[phase].add(seg.profile)
+
+   def _attribute(self, phase):
+
+      # Returns the phase's wall time split up as described at the top.
+
+      times = self.phase_times[phase]
+      split = {"network": 0.0, "sleeping": 0.0}
+      stats = self.phase_stats.get(phase)
+      if stats is not None:
+         for func, (_, _, tottime, _, _) in stats.stats.items():
+            kind = _classify_func(func)
+            if kind != "cpu":
+               split[kind] += tottime
+      split["cpu"] = times["cpu"]
+      split["other"] = max(times["wall"] - split["network"] - split["sleeping"] - split["cpu"], 0)
+      return split
+
+   def _top_local_funcs(self, cnt=15):
+
+      # Returns (own secs, cumulative secs, calls, description) tuples for the functions
+      # of the tools themselves that took most time of their own, across all phases.
+
+      tools_dir = os.path.dirname(os.path.abspath(__file__))
+      totals = dict()
+      for stats in self.phase_stats.values():
+         if stats is None:
+            continue
+         for func, (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            filename, lineno, funcname = func
+            # (Builtins are "~", and frozen modules "<frozen os>" and the like.)
+            if filename.startswith(("~", "<")) or os.path.dirname(os.path.abspath(filename)) != tools_dir:
+               continue
+            t = totals.setdefault(func, [0.0, 0.0, 0])
+            t[0] += tottime
+            t[1] += cumtime
+            t[2] += ncalls
+      top = sorted(totals.items(), key=lambda ft: ft[1][0], reverse=True)[:cnt]
+      return [(t[0], t[1], t[2], "%s (%s:%d)" % (f[2], os.path.basename(f[0]), f[1])) for f, t in top]
+
+   def summary(self):
+
+      # Returns the summary of where the time went, as lines of text.
+
+      lines = ["%-22s %7s %9s %9s %9s %9s %9s" %
+               ("Phase", "Threads", "Wall", "Network", "Sleeping", "CPU", "Other")]
+      for phase in sorted(self.phase_times.keys()):
+         times = self.phase_times[phase]
+         split = self._attribute(phase)
+         lines.append("%-22s %7d %9.1f %9.1f %9.1f %9.1f %9.1f" %
+                      (phase, times["threads"], times["wall"], split["network"], split["sleeping"],
+                       split["cpu"], split["other"]))
+      lines.append("")
+      lines.append("Functions of the tools taking most time of their own (secs):")
+      lines.append("%9s %9s %9s  %s" % ("Own", "Cum", "Calls", "Function"))
+      for own, cum, calls, desc in self._top_local_funcs():
+         lines.append("%9.2f %9.2f %9d  %s" % (own, cum, calls, desc))
+      return lines
+
+   def save(self):
+
+      # Writes the per-phase profiles and the summary.  The calling thread stops being
+      # profiled, and other threads still in a phase just have their times counted.
+
+      if self.dirname is None:
+         return
+      self._leave(threading.get_ident())
+      with self.lock:
+         for tid in list(self.segments.keys()):
+            self._collect(tid, live=tid in self.current)
+
+      try:
+         for phase, stats in self.phase_stats.items():
+            if stats is not None:
+               stats.dump_stats(os.path.join(self.dirname, "%s.prof" % phase))
+         lines = self.summary()
+         with open(os.path.join(self.dirname, "summary.txt"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+      except OSError as exc:
+         wmsg("Could not write profiles to %s: %s" % (self.dirname, exc))
+         return
+      eprint("Profiles written to %s.  Where the time went (secs, summed across threads):" % self.dirname)
+      for line in lines:
+         eprint("   %s" % line)
+
+# The process-wide profiler.
+profiler = PhaseProfiler()
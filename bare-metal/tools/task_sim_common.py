@@ -0,0 +1,634 @@
+
+# Some common functions for simulating TaskRunner runs against a synthetic fleet of
+# machines, so that scheduling policies (power-on budgets and staggering, how often
+# task status is checked, multi-threaded vs. serial runs, timeouts) can be tried out
+# and compared at scale, eg. 1,000 machines, in seconds rather than hours.
+#
+# A simulation runs the real TaskRunner code, but on a VirtualClock rather than real
+# time, with connections to simulated BMCs (SimBMCConnection) running a synthetic task
+# (SimTask).  Each simulated machine has a timeline drawn up front from a seeded random
+# number generator: how long its BMC takes to answer requests, how long it takes to
+# boot (longer when too many machines on its switch are booting at once) and how long
+# its task runs once it has booted, and whether the task fails or hangs.
+#
+# A simulated run can also be distributed across worker processes (--workers N), each
+# simulating the whole fleet (from the same seed) but running only the shards of
+# machines it is handed, on a virtual clock of its own.  The coordinator and the
+# workers talk as in a real distributed run, so this exercises that locally.  Use
+# --crash-workers N to have the first N workers to check on a task die then, as if
+# killed, so that their machines are handed on to other workers.  A worker taking over
+# a machine whose task was submitted by the one that died reattaches to the task, which
+# the machine's simulated BMC (fresh in the new worker) adopts as if just powered on.
+#
+# The VirtualClock is a discrete-event clock:  Time stands still while any of the
+# threads taking part in the run has something to do, and when they are all waiting
+# (sleeping, or waiting on an event, condition or thread with a timeout) it jumps to
+# when the first of them is due to wake.
+
+# Assumes: Python 3.6+
+
+import heapq
+import random
+import shutil
+import tempfile
+import threading
+import zlib
+
+from lab_common import *
+
+class _VirtualWait:
+
+   # A wait on a VirtualClock (see VirtualClock._wait).
+
+   __slots__ = ["wake_at", "event", "thread", "cond", "notified", "ended", "wakeup"]
+
+   def __init__(self, wake_at, event, thread, cond):
+      self.wake_at  = wake_at
+      self.event    = event
+      self.thread   = thread
+      self.cond     = cond
+      self.notified = False
+      self.ended    = False
+      self.wakeup   = threading.Event()
+
+class _VirtualEvent(threading.Event):
+
+   # An event that tells its VirtualClock when it is set.
+
+   def __init__(self, clock):
+      super().__init__()
+      self.clock = clock
+
+   def set(self):
+      super().set()
+      self.clock._event_set(self)
+
+class VirtualClock(Clock):
+
+   # The threads taking part are the one that made the clock, those started with
+   # start() and the work wrapped with held().  Each is either busy, or waiting on the
+   # clock.  When none are busy, waits whose event is set, thread has finished or
+   # condition was notified end first.  If there are none of those, time moves on to
+   # when the first timed wait ends (and all that end then do).
+   #
+   # The timed waits are kept in a heap, and the others are indexed by what they're
+   # waiting for, so that moving on doesn't mean looking through every wait.  Only waits
+   # on events not made by event() have to be checked each time.
+
+   def __init__(self, start_time=None):
+
+      self.lock = threading.Lock()
+      self.time = start_time if start_time is not None else now()
+      self.started_at = self.time
+
+      # Number of threads taking part that aren't waiting on us.
+      self.busy = 1
+
+      # The waits in progress:  All of them, those with a timeout as (wake_at, seq, wait)
+      # tuples in a heap, and the others by event, thread and condition.  Ended waits are
+      # left in the heap until they come to the top.
+      self.waits = set()
+      self.timed_waits = []
+      self.wait_seq = 0
+      self.event_waits = dict()
+      self.thread_waits = dict()
+      self.cond_waits = dict()
+
+      # Waits on events we didn't make, and waits that are due to end as what they were
+      # waiting for has happened.
+      self.polled_waits = set()
+      self.ready_waits = []
+
+      # Threads started with start() that have finished.
+      self.finished_threads = set()
+
+      # Number of times time moved on, and whether we ever got stuck with nothing to
+      # move on to.
+      self.advances = 0
+      self.stalls = 0
+
+   def now(self):
+      return self.time
+
+   def elapsed(self):
+      return self.time - self.started_at
+
+   def event(self):
+      return _VirtualEvent(self)
+
+   def _make_ready(self, waits):
+      for w in waits:
+         if not w.ended:
+            self.ready_waits.append(w)
+
+   def _event_set(self, event):
+      with self.lock:
+         self._make_ready(self.event_waits.get(event, ()))
+
+   def _end(self, w):
+
+      # Ends a wait, making its thread busy again.
+
+      w.ended = True
+      self.waits.discard(w)
+      self.polled_waits.discard(w)
+      for index, key in [(self.event_waits, w.event), (self.thread_waits, w.thread), (self.cond_waits, w.cond)]:
+         if key is not None:
+            waits = index[key]
+            waits.discard(w)
+            if not waits:
+               del index[key]
+      self.busy += 1
+      w.wakeup.set()
+
+   def _move_on(self):
+
+      # Called (with the lock held) when nothing is busy anymore.
+
+      ending = self.ready_waits + [w for w in self.polled_waits if w.event.is_set()]
+      self.ready_waits = []
+      if not ending:
+         while self.timed_waits and self.timed_waits[0][2].ended:
+            heapq.heappop(self.timed_waits)
+         if self.timed_waits:
+            self.time = max(self.time, self.timed_waits[0][0])
+            self.advances += 1
+            while self.timed_waits and self.timed_waits[0][0] <= self.time:
+               ending.append(heapq.heappop(self.timed_waits)[2])
+         elif self.waits:
+            # Everything is waiting for something that can't happen.  Let the waits
+            # end (as if timed out) rather than hang.
+            wmsg("Virtual clock stalled with %d waits that have no timeout." % len(self.waits))
+            self.stalls += 1
+            ending = list(self.waits)
+
+      for w in ending:
+         if not w.ended:
+            self._end(w)
+
+   def _not_busy(self):
+      self.busy -= 1
+      if self.busy == 0:
+         self._move_on()
+
+   def _wait(self, timeout=None, event=None, thread=None, cond=None):
+
+      # Waits until the timeout (virtual secs) passes or the event is set, thread
+      # finishes or condition is notified, returning the wait.
+
+      w = _VirtualWait(self.time + max(timeout, 0) if timeout is not None else None, event, thread, cond)
+      with self.lock:
+         self.waits.add(w)
+         if w.wake_at is not None:
+            self.wait_seq += 1
+            heapq.heappush(self.timed_waits, (w.wake_at, self.wait_seq, w))
+         if event is not None:
+            if isinstance(event, _VirtualEvent) and event.clock is self:
+               self.event_waits.setdefault(event, set()).add(w)
+            else:
+               self.polled_waits.add(w)
+            if event.is_set():
+               self._make_ready([w])
+         if thread is not None:
+            self.thread_waits.setdefault(thread, set()).add(w)
+            if thread in self.finished_threads:
+               self._make_ready([w])
+         if cond is not None:
+            self.cond_waits.setdefault(cond, set()).add(w)
+         self._not_busy()
+      if cond is not None:
+         cond.release()
+      w.wakeup.wait()
+      if cond is not None:
+         cond.acquire()
+      return w
+
+   def sleep(self, secs):
+      if secs > 0:
+         self._wait(timeout=secs)
+
+   def wait(self, event, timeout=None):
+      if not event.is_set():
+         self._wait(timeout=timeout, event=event)
+      return event.is_set()
+
+   def wait_condition(self, cond, timeout=None):
+      return self._wait(timeout=timeout, cond=cond).notified
+
+   def notify_all(self, cond):
+      with self.lock:
+         waits = self.cond_waits.get(cond, ())
+         for w in waits:
+            w.notified = True
+         self._make_ready(waits)
+
+   def start(self, thread):
+      run = thread.run
+      def run_then_finish():
+         try:
+            run()
+         finally:
+            with self.lock:
+               self.finished_threads.add(thread)
+               self._make_ready(self.thread_waits.get(thread, ()))
+               self._not_busy()
+      thread.run = run_then_finish
+      with self.lock:
+         self.busy += 1
+      thread.start()
+
+   def join(self, thread, timeout=None):
+      with self.lock:
+         finished = thread in self.finished_threads
+      if not finished:
+         self._wait(timeout=timeout, thread=thread)
+      with self.lock:
+         finished = thread in self.finished_threads
+      if finished:
+         thread.join()
+
+   def held(self, func):
+      with self.lock:
+         self.busy += 1
+      def run_then_release(*args, **kwargs):
+         try:
+            return func(*args, **kwargs)
+         finally:
+            with self.lock:
+               self._not_busy()
+      return run_then_release
+
+class SimFleet:
+
+   # The simulated machines and their BMCs.  Machines are named sim0001 etc. and spread
+   # evenly across switches sw01 etc.
+
+   models    = ["PowerEdge R640", "PowerEdge R740"]
+   firmwares = ["6.10.30.00", "7.00.00.00"]
+
+   # How long a BMC is unresponsive after a power action, and how long a submitted task
+   # takes to become visible.
+   bmc_busy_secs       = 3
+   task_visible_secs   = 1
+
+   # Environment variable giving (distributed runs' workers) the directory holding a
+   # token for each worker still to crash.  (See crash_if_due.)
+   crash_dir_env_var = "ACM_LAB_SIM_CRASH_DIR"
+
+   @staticmethod
+   def add_argument_definitions(parser):
+      parser.add_argument("--machines", "-m", dest="machine_cnt", type=int, default=1000)
+      parser.add_argument("--switches", dest="switch_cnt", type=int, default=25)
+      parser.add_argument("--request-secs", dest="request_secs", type=float, default=0.3)
+      parser.add_argument("--boot-secs", dest="boot_secs", type=float, default=240)
+      parser.add_argument("--boots-per-switch", dest="boots_per_switch", type=int, default=8)
+      parser.add_argument("--run-secs", dest="run_secs", type=float, default=600)
+      parser.add_argument("--run-jitter", dest="run_jitter", type=float, default=0.25)
+      parser.add_argument("--fail-rate", dest="fail_rate", type=float, default=0.0)
+      parser.add_argument("--hang-rate", dest="hang_rate", type=float, default=0.0)
+      parser.add_argument("--seed", dest="seed", type=int, default=1)
+      parser.add_argument("--crash-workers", dest="crash_worker_cnt", type=int, default=0)
+
+   def __init__(self, args, clock):
+
+      self.args  = args
+      self.clock = clock
+      self.lock  = threading.Lock()
+
+      self.machines = ["sim%04d" % (i + 1) for i in range(args.machine_cnt)]
+      self.groups = {m: "sw%02d" % (i % max(args.switch_cnt, 1) + 1) for i, m in enumerate(self.machines)}
+
+      # Each machine's timeline is drawn from its own generator, so that it doesn't
+      # depend on the order in which the machines' threads happen to run.
+
+      self.bmcs = dict()
+      for i, m in enumerate(self.machines):
+         rng = random.Random(args.seed * 1000003 + zlib.crc32(m.encode("utf-8")))
+         self.bmcs[m] = {
+            "machine":     m,
+            "group":       self.groups[m],
+            "model":       self.models[i % len(self.models)],
+            "firmware":    self.firmwares[(i // len(self.models)) % len(self.firmwares)],
+            "rng":         rng,
+            "boot_secs":   args.boot_secs * rng.uniform(0.8, 1.2),
+            "run_secs":    args.run_secs * rng.lognormvariate(0, args.run_jitter),
+            "fails":       rng.random() < args.fail_rate,
+            "hangs":       rng.random() < args.hang_rate,
+            "power":       "On",
+            "busy_until":  None,
+            "powered_on_at": None,
+            "booted_at":   None,
+            "task_id":     None,
+            "submitted_at": None,
+            "ended_at":    None,
+            "seen_ended_at": None,
+            "requests":    0,
+            "task_checks": 0
+         }
+
+      # Most machines seen booting at once on any one switch.
+      self.peak_booting = 0
+
+      # Whether we're a worker process that has yet to see if it should crash.
+      self.crash_pending = (getattr(args, "dist_worker_of", None) is not None and
+                            os.getenv(SimFleet.crash_dir_env_var) is not None)
+
+   def create_connection(self, machine, args, default_to_admin=False, deadline=None):
+      bmc_conn = SimBMCConnection(self, machine)
+      bmc_conn.set_deadline(deadline)
+      return bmc_conn
+
+   def _booting_on_switch(self, group, at):
+      return sum(1 for b in self.bmcs.values()
+                 if b["group"] == group and b["booted_at"] is not None and b["powered_on_at"] <= at < b["booted_at"])
+
+   def power_on(self, bmc):
+
+      # Boots take longer when more than boots_per_switch machines on the switch are
+      # booting at once (PXE and image download contention).
+
+      at = self.clock.now()
+      booting = self._booting_on_switch(bmc["group"], at) + 1
+      self.peak_booting = max(self.peak_booting, booting)
+      slowdown = max(booting / max(self.args.boots_per_switch, 1), 1.0)
+      bmc["power"] = "On"
+      bmc["powered_on_at"] = at
+      bmc["booted_at"] = at + bmc["boot_secs"] * slowdown
+      bmc["busy_until"] = at + self.bmc_busy_secs
+
+   def power_off(self, bmc):
+      bmc["power"] = "Off"
+      bmc["booted_at"] = None
+      bmc["busy_until"] = self.clock.now() + self.bmc_busy_secs
+
+   def crash_if_due(self):
+
+      # Called when a task is first checked on.  If we're a worker and can claim one of
+      # the crash tokens, we die right away as if killed (so the coordinator hears of
+      # what we've done so far, but not of our having ended).
+
+      with self.lock:
+         if not self.crash_pending:
+            return
+         self.crash_pending = False
+      crash_dir = os.getenv(SimFleet.crash_dir_env_var)
+      for token in sorted(os.listdir(crash_dir)):
+         try:
+            os.unlink(os.path.join(crash_dir, token))
+         except FileNotFoundError:
+            # Another worker got it first.
+            continue
+         os._exit(1)
+
+   def adopt_task(self, bmc, task_id):
+
+      # Takes on a task submitted by a worker that has since died.  As far as we know the
+      # machine was powered on to run it just now.
+
+      at = self.clock.now()
+      bmc["task_id"] = task_id
+      bmc["submitted_at"] = at
+      if bmc["power"] == "On" and bmc["booted_at"] is None:
+         bmc["powered_on_at"] = at
+         bmc["booted_at"] = at + bmc["boot_secs"]
+
+   def task_res(self, bmc):
+
+      # Returns the task resource for the machine's task as it stands now:  Pending until
+      # the machine is powered on, Starting while it boots and then Running.
+
+      at = self.clock.now()
+      state, status, pct = "Pending", "OK", 0
+      if bmc["ended_at"] is not None:
+         state, status, pct = "Completed", "Critical" if bmc["fails"] else "OK", 100
+      elif bmc["power"] == "On" and bmc["booted_at"] is not None:
+         if at < bmc["booted_at"]:
+            state = "Starting"
+         else:
+            ran = at - bmc["booted_at"]
+            if ran >= bmc["run_secs"] and not bmc["hangs"]:
+               bmc["ended_at"] = bmc["booted_at"] + bmc["run_secs"]
+               state, status, pct = "Completed", "Critical" if bmc["fails"] else "OK", 100
+            else:
+               state, pct = "Running", min(int(100 * ran / bmc["run_secs"]), 99)
+      if state == "Completed" and bmc["seen_ended_at"] is None:
+         bmc["seen_ended_at"] = at
+      return {"@odata.id": bmc["task_id"], "Id": bmc["task_id"].rsplit("/", 1)[-1],
+              "TaskState": state, "TaskStatus": status, "PercentComplete": pct}
+
+   def get_results(self):
+
+      # Returns a summary of how the run went, as far as the simulated machines saw it.
+
+      bmcs = list(self.bmcs.values())
+      lags = sorted(b["seen_ended_at"] - b["ended_at"] for b in bmcs if b["seen_ended_at"] is not None)
+      ended = sorted(b["ended_at"] - self.clock.started_at for b in bmcs if b["ended_at"] is not None)
+
+      def pct(values, p):
+         return round(values[int(p * (len(values) - 1))], 1) if values else None
+
+      return {
+         "machines":          len(bmcs),
+         "tasks_ended":       len(ended),
+         "tasks_failed":      sum(1 for b in bmcs if b["ended_at"] is not None and b["fails"]),
+         "tasks_hung":        sum(1 for b in bmcs if b["hangs"] and b["task_id"] is not None),
+         "last_task_end":     round(ended[-1], 1) if ended else None,
+         "end_noticed_p50":   pct(lags, 0.5),
+         "end_noticed_p90":   pct(lags, 0.9),
+         "end_noticed_max":   pct(lags, 1.0),
+         "task_checks":       sum(b["task_checks"] for b in bmcs),
+         "bmc_requests":      sum(b["requests"] for b in bmcs),
+         "peak_booting_per_switch": self.peak_booting
+      }
+
+class SimBMCConnection:
+
+   # Stands in for a LabBMCConnection to a simulated machine's BMC, providing what
+   # TaskRunner and SimTask use.  Every request takes about request_secs (virtual).
+
+   def __init__(self, fleet, machine):
+      self.fleet    = fleet
+      self.clock    = fleet.clock
+      self.bmc      = fleet.bmcs[machine]
+      self.host     = machine
+      self.deadline = None
+
+   def set_deadline(self, deadline):
+      self.deadline = deadline
+
+   def get_deadline(self):
+      return self.deadline
+
+   def _request(self):
+
+      # Accounts for a request and lets the time it takes pass, raising as a real
+      # connection would if the deadline passes first.
+
+      bmc = self.bmc
+      with self.fleet.lock:
+         bmc["requests"] += 1
+         secs = self.fleet.args.request_secs * bmc["rng"].uniform(0.7, 1.3)
+      if self.deadline is not None and self.clock.now() + secs > self.deadline:
+         self.clock.sleep(self.deadline - self.clock.now())
+         raise BMCTimeoutError(self, "Request to simulated BMC %s timed out." % self.host)
+      self.clock.sleep(secs)
+
+   def _is_busy(self):
+      busy_until = self.bmc["busy_until"]
+      return busy_until is not None and self.clock.now() < busy_until
+
+   def get_power_state(self):
+      self._request()
+      return self.bmc["power"]
+
+   def system_power_on(self):
+      self._request()
+      with self.fleet.lock:
+         self.fleet.power_on(self.bmc)
+
+   def system_power_off(self):
+      self._request()
+      with self.fleet.lock:
+         self.fleet.power_off(self.bmc)
+
+   def start_task(self, task_target, task_body):
+      self._request()
+      with self.fleet.lock:
+         self.bmc["task_id"] = "/redfish/v1/TaskService/Tasks/JID_%s" % self.host
+         self.bmc["submitted_at"] = self.clock.now()
+      return self.bmc["task_id"]
+
+   def get_task(self, task_id):
+      self.fleet.crash_if_due()
+      self._request()
+      with self.fleet.lock:
+         if self.bmc["task_id"] is None:
+            self.fleet.adopt_task(self.bmc, task_id)
+         self.bmc["task_checks"] += 1
+         return self.fleet.task_res(self.bmc)
+
+   def get_system_resource(self):
+      self._request()
+      return {"Id": "System.Embedded.1", "Model": self.bmc["model"], "PowerState": self.bmc["power"]}
+
+   def get_system_manager_resource(self):
+      self._request()
+      return {"Id": "iDRAC.Embedded.1", "FirmwareVersion": self.bmc["firmware"]}
+
+   def probe_redfish_ready(self):
+      self._request()
+      return not self._is_busy()
+
+   def probe_ready_for_tasks(self):
+      return self.probe_redfish_ready()
+
+   def probe_resource(self, res_id):
+      self._request()
+      submitted_at = self.bmc["submitted_at"]
+      return submitted_at is not None and self.clock.now() >= submitted_at + self.fleet.task_visible_secs
+
+   def release(self):
+      pass
+
+   def close(self):
+      pass
+
+class SimTask(RunnableTask):
+
+   # A task along the lines of fog-wipe-first-disk:  Power the machine off, submit the
+   # task, power the machine on to run it, and power it off again once done.
+
+   multi_thread_safe = True
+
+   def __init__(self, machine, bmc_conn, task_arg=None):
+      super(SimTask, self).__init__(machine, bmc_conn, task_arg)
+
+   @classmethod
+   def get_short_task_name(self):
+      return "sim-task"
+
+   @classmethod
+   def is_multi_thread_safe(self):
+      return self.multi_thread_safe
+
+   def prepare_task_request(self):
+      self.task_target = "/redfish/v1/Systems/System.Embedded.1/Actions/Oem/SimTask"
+      self.task_body   = {}
+      return True
+
+   def pre_submit(self):
+      self.do_power_action("Off")
+      return True
+
+   def post_submit(self):
+      self.do_power_action("On")
+      return True
+
+   def post_completion(self):
+      self.do_power_action("Off")
+
+def run_simulation(args, history_pathname=None):
+
+   # Runs TaskRunner for a simulated fleet as per args (see SimFleet and the TaskRunner
+   # argument definitions), returning a dict summarizing how it went.  Duration history
+   # is kept in history_pathname, if specified, or not kept at all.  Workers of a
+   # distributed run return None, the coordinator having the results.
+
+   clock = VirtualClock()
+   fleet = SimFleet(args, clock)
+   SimTask.multi_thread_safe = not args.serial
+
+   runner = TaskRunner(fleet.machines, args, SimTask, clock=clock, power_groups=fleet.groups)
+   runner.create_connection = fleet.create_connection
+   runner.duration_history = TaskDurationHistory(history_pathname) if history_pathname is not None else None
+   if args.check_interval is not None:
+      runner.check_status_pause_time = args.check_interval
+
+   # Local workers see which of them are to crash via tokens in a directory of ours.
+   crash_dir = None
+   if args.crash_worker_cnt > 0 and args.dist_worker_of is None:
+      crash_dir = tempfile.mkdtemp(prefix="sim-crashes-")
+      for i in range(args.crash_worker_cnt):
+         open(os.path.join(crash_dir, "crash-%03d" % i), "w").close()
+      os.environ[SimFleet.crash_dir_env_var] = crash_dir
+
+   real_started_at = now()
+   try:
+      runner.run()
+   finally:
+      if crash_dir is not None:
+         del os.environ[SimFleet.crash_dir_env_var]
+         shutil.rmtree(crash_dir, ignore_errors=True)
+
+   if args.dist_worker_of is not None:
+      return None
+
+   coordinator = runner.dist_coordinator
+   if coordinator is None:
+      results = {"makespan": round(clock.elapsed(), 1)}
+      results.update(fleet.get_results())
+   else:
+      # The simulated machines (and virtual clocks) were the workers', so there's only
+      # what the coordinator saw to go on.
+      bmcs = fleet.bmcs.values()
+      results = {
+         "machines":           len(bmcs),
+         "workers":            coordinator.num_workers,
+         "workers_lost":       coordinator.workers_lost,
+         "machines_handed_on": sum(coordinator.reassignments.values()),
+         "tasks_failed":       sum(1 for b in bmcs if b["fails"] and not b["hangs"]),
+         "tasks_hung":         sum(1 for b in bmcs if b["hangs"])
+      }
+
+   phases = dict()
+   for entry in runner.journal.get_entries().values():
+      outcome = entry.get("phase")
+      status = RunJournal.get_outcome_status(entry)
+      if status not in [None, "OK"]:
+         outcome = "%s/%s" % (outcome, status)
+      phases[outcome] = phases.get(outcome, 0) + 1
+   results["outcomes"]      = phases
+   results["clock_advances"] = clock.advances
+   results["clock_stalls"]   = clock.stalls
+   results["real_secs"]      = round(now() - real_started_at, 1)
+   return results